@@ -28,8 +28,14 @@ We ran
 Above, --gtex-dir is the path to the directory with the batch_* subdirs.
 """
 import os
-import csv
-import gzip
+import sys
+
+# Counts and run metadata are read by the same code as for SRA
+sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), os.pardir, 'sra', 'v2'
+    ))
+from metadata_db import read_run_info
+from batch_counts import read_batch_counts, reconcile_read_count
 
 if __name__ == '__main__':
     import argparse
@@ -38,74 +44,40 @@ if __name__ == '__main__':
     parser.add_argument('--gtex-dir', required=True,
         help='path to GTEx output files; this is where the batch_* '
              'subdirectories are')
+    parser.add_argument('--counts-cache', required=False, default=None,
+        help='.npz file in which ../sra/v2/batch_counts.py caches read '
+             'counts from counts.tsv.gz files')
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+        default=1,
+        help='maximum number of processes reading counts.tsv.gz files '
+             'simultaneously')
     args = parser.parse_args()
     containing_dir = os.path.dirname(os.path.realpath(__file__))
     srr_to_read_count = {}
     srr_to_line = {}
     srr_to_paired_status = {}
-    with open(os.path.join(containing_dir, 'SraRunInfo.csv')) as run_stream:
-        run_stream.readline()
-        run_reader = csv.reader(run_stream, delimiter=',', quotechar='"')
-        for tokens in run_reader:
-            if not tokens or (len(tokens) == 1 and tokens[0] == ''): continue
-            srr_to_line[tokens[0]] = '\t'.join(
-                    [tokens[20], tokens[24], tokens[10], tokens[0]]
-                )
-            if tokens[15] == 'PAIRED':
-                srr_to_read_count[tokens[0]] = int(tokens[3]) * 2
-                srr_to_paired_status[tokens[0]] = '1'
-            elif tokens[15] == 'SINGLE':
-                srr_to_read_count[tokens[0]] = int(tokens[3])
-                srr_to_paired_status[tokens[0]] = '0'
-            else:
-                raise RuntimeError(
-                        'Fail: {} is neither SINGLE nor PAIRED'.format(
-                                                                    tokens[15]
-                                                                )
-                    )
+    for (run, project, sample, experiment, _, read_count,
+            paired) in read_run_info(
+                os.path.join(containing_dir, 'SraRunInfo.csv')
+            ):
+        srr_to_line[run] = '\t'.join([project, sample, experiment, run])
+        srr_to_read_count[run] = read_count
+        srr_to_paired_status[run] = str(paired)
     print '\t'.join(['project', 'sample', 'experiment', 'run',
                         'read count as reported by SRA', 'reads aligned',
                         'proportion of reads reported by SRA aligned',
                         'paired-end', 'SRA misreported paired-end'])
-    for i in xrange(30):
-        with gzip.open(
-                os.path.join(args.gtex_dir,
-                                'batch_{}'.format(i),
-                                'cross_sample_results',
-                                'counts.tsv.gz')
-            ) as count_stream:
-            count_stream.readline()
-            for line in count_stream:
-                srr = line.partition('\t')[0].partition('_')[0]
-                read_count = int(
-                        line.rpartition('\t')[2].partition(',')[0]
-                    )
-                mislabeled = False
-                try:
-                    ratio = float(read_count) / srr_to_read_count[srr]
-                    if ratio > 1:
-                        '''Mislabeled sample; whp recorded as SINGLE
-                        when PAIRED'''
-                        srr_to_read_count[srr] *= 2
-                        ratio = float(read_count) / srr_to_read_count[srr]
-                        srr_to_paired_status[srr] = '1'
-                        mislabeled = True
-                    elif ratio == 0.5:
-                        '''Mislabeled sample; whp recorded as PAIRED
-                        when SINGLE'''
-                        srr_to_read_count[srr] /= 2
-                        ratio = float(read_count) / srr_to_read_count[srr]
-                        srr_to_paired_status[srr] = '0'
-                        mislabeled = True
-                except ZeroDivisionError:
-                    ratio = 'NA'
-                if read_count == srr_to_read_count[srr]:
-                    # We got this one right
-                    continue
-                else:
-                    print '\t'.join(map(str, [srr_to_line[srr],
-                                        srr_to_read_count[srr],
-                                        read_count, ratio,
-                                        srr_to_paired_status[srr],
-                                        '1' if mislabeled
-                                        else '0']))
+    for srr, read_count, _ in read_batch_counts(
+                args.gtex_dir, batch_count=30,
+                num_processes=args.num_processes, cache=args.counts_cache
+            ):
+        sra_read_count, ratio, paired, mislabeled = reconcile_read_count(
+                srr_to_read_count[srr], srr_to_paired_status[srr], read_count
+            )
+        if read_count == sra_read_count:
+            # We got this one right
+            continue
+        else:
+            print '\t'.join(map(str, [srr_to_line[srr], sra_read_count,
+                                        read_count, ratio, paired,
+                                        '1' if mislabeled else '0']))
@@ -6,12 +6,34 @@ Constructs GTEx table of phenotypes and sample stats (read length, etc.)
 Requires SRA Tools. We used v2.5.4-1. The script also has dependencies
 in the runs/gtex directory, including the manifest files, so don't move it.
 
+Presence of sample bigWigs is verified with one listing of each
+batch_*/coverage_bigwigs directory, with --threads directories listed at a
+time; bigWigs aren't stat'ed individually. If --bigwig-cache is specified,
+each listed bigWig is also stat'ed so its size and mtime can be stored
+there, and on later runs a directory is listed again only if its own mtime has
+changed, so repeated pheno builds skip the walk over the bigWigs. The cache is
+a tab-separated file with fields
+
+1. coverage_bigwigs directory
+2. mtime of directory
+3. bigWig filename
+4. size of bigWig in bytes
+5. mtime of bigWig
+
 Dumps pheno table to stdout.
 """
 import os
 from csv import reader
+from multiprocessing.pool import ThreadPool
 import subprocess
 import sys
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 def blank_to_NA(it):
     """ Converts blank fields to NAs in some list it
@@ -22,6 +44,118 @@ def blank_to_NA(it):
     """
     return [(el if el else 'NA') for el in it]
 
+def list_bigwigs(bigwig_dir, stat=False):
+    """ Lists bigWigs in a directory with one directory read
+
+        bigwig_dir: directory with bigWigs
+        stat: True iff each bigWig should be stat'ed for its size and mtime,
+            which costs a call per file
+
+        Return value: tuple (mtime of bigwig_dir, dictionary mapping each
+            bigWig filename to a tuple (size in bytes, mtime), or to None
+            if stat is False); the dictionary is empty if bigwig_dir
+            doesn't exist
+    """
+    try:
+        dir_mtime = os.stat(bigwig_dir).st_mtime
+    except OSError:
+        return None, {}
+    bigwigs = {}
+    if scandir is not None:
+        # is_file() uses the file type from the listing where available
+        for entry in scandir(bigwig_dir):
+            if entry.name.endswith('.bw') and entry.is_file():
+                bigwigs[entry.name] = entry.stat() if stat else None
+    else:
+        for filename in os.listdir(bigwig_dir):
+            if filename.endswith('.bw'):
+                bigwigs[filename] = os.stat(
+                        os.path.join(bigwig_dir, filename)
+                    ) if stat else None
+    if stat:
+        for filename in bigwigs:
+            bigwigs[filename] = (bigwigs[filename].st_size,
+                                    bigwigs[filename].st_mtime)
+    return dir_mtime, bigwigs
+
+def read_bigwig_cache(cache):
+    """ Reads cache of bigWig listings
+
+        cache: path to cache file
+
+        Return value: dictionary mapping each coverage_bigwigs directory to
+            a tuple as returned by list_bigwigs()
+    """
+    listings = {}
+    if cache is None or not os.path.exists(cache):
+        return listings
+    with open(cache) as cache_stream:
+        for line in cache_stream:
+            bigwig_dir, dir_mtime, filename, size, mtime = line.rstrip(
+                    '\n'
+                ).split('\t')
+            listings.setdefault(bigwig_dir, (float(dir_mtime), {}))[1][
+                    filename
+                ] = (int(size), float(mtime))
+    return listings
+
+def write_bigwig_cache(cache, listings):
+    """ Writes cache of bigWig listings
+
+        cache: path to cache file
+        listings: dictionary as returned by read_bigwig_cache()
+
+        No return value.
+    """
+    partial_cache = cache + '.partial'
+    with open(partial_cache, 'w') as cache_stream:
+        for bigwig_dir in sorted(listings):
+            dir_mtime, bigwigs = listings[bigwig_dir]
+            for filename in sorted(bigwigs):
+                print >>cache_stream, '\t'.join(
+                        [bigwig_dir, repr(dir_mtime), filename,
+                         str(bigwigs[filename][0]),
+                         repr(bigwigs[filename][1])]
+                    )
+    os.rename(partial_cache, cache)
+
+def bigwig_listings(bigwig_dirs, threads=8, cache=None):
+    """ Lists bigWigs in directories concurrently, reusing cached listings
+
+        bigwig_dirs: list of coverage_bigwigs directories
+        threads: number of directories to list simultaneously
+        cache: path to cache file or None; bigWigs are stat'ed only if it
+            is specified
+
+        Return value: dictionary mapping each directory in bigwig_dirs to a
+            set of the bigWig filenames it contains
+    """
+    listings = read_bigwig_cache(cache)
+    def refresh(bigwig_dir):
+        if bigwig_dir in listings:
+            try:
+                if os.stat(bigwig_dir).st_mtime == listings[bigwig_dir][0]:
+                    return bigwig_dir, listings[bigwig_dir]
+            except OSError:
+                pass
+        return bigwig_dir, list_bigwigs(bigwig_dir,
+                                        stat=(cache is not None))
+    pool = ThreadPool(threads)
+    try:
+        refreshed = dict(pool.map(refresh, sorted(set(bigwig_dirs))))
+    finally:
+        pool.close()
+        pool.join()
+    if cache is not None:
+        listings.update(refreshed)
+        write_bigwig_cache(cache, {
+                bigwig_dir : listing
+                for bigwig_dir, listing in listings.items()
+                if listing[0] is not None
+            })
+    return {bigwig_dir : set(refreshed[bigwig_dir][1])
+                for bigwig_dir in refreshed}
+
 if __name__ == '__main__':
     import argparse
     # Print file's docstring if -h is invoked
@@ -40,6 +174,13 @@ if __name__ == '__main__':
                  'various batch_k files for k a batch number; this script '
                  'verifies that all sample bigwigs are present and includes '
                  'paths to sample bigwigs in the table it dumps')
+    parser.add_argument('--threads', type=int, required=False, default=8,
+            help='number of bigwig directories to list simultaneously'
+        )
+    parser.add_argument('--bigwig-cache', type=str, required=False,
+            default=None,
+            help='where to cache sizes and mtimes of sample bigwigs'
+        )
     args = parser.parse_args()
 
     current_dir = os.path.dirname(os.path.realpath(__file__))
@@ -56,25 +197,34 @@ if __name__ == '__main__':
             run_to_sra_info[tokens[0]] = tokens[1:]
     run_to_batch = {}
     run_to_bw_file = {}
+    batch_to_bigwigs = {}
     for batch_number, manifest in [
             (filename.split('_')[-1][:-9], filename)
             for filename in os.listdir(current_dir)
             if filename[-9:] == '.manifest'
         ]:
-        with open(manifest) as manifest_stream:
-            for line in manifest_stream:
-                tokens = line.strip().split('\t')
-                run = tokens[0][6:]
-                bw_file = os.path.join(args.bigwig_out_dir,
-                                        'batch_%s' % batch_number,
-                                        'coverage_bigwigs',
-                                        tokens[2] + '.bw')
-                if not os.path.exists(bw_file):
-                    raise RuntimeError(
-                            'BigWig file {} was not found.'.format(bw_file)
-                        )
-                run_to_batch[run] = batch_number
-                run_to_bw_file[run] = bw_file
+        with open(os.path.join(current_dir, manifest)) as manifest_stream:
+            batch_to_bigwigs[batch_number] = [
+                    (line.strip().split('\t')[0][6:],
+                     line.strip().split('\t')[2] + '.bw')
+                    for line in manifest_stream
+                ]
+    batch_to_dir = {batch_number : os.path.join(args.bigwig_out_dir,
+                                                'batch_%s' % batch_number,
+                                                'coverage_bigwigs')
+                        for batch_number in batch_to_bigwigs}
+    present = bigwig_listings(batch_to_dir.values(), threads=args.threads,
+                                cache=args.bigwig_cache)
+    for batch_number in sorted(batch_to_bigwigs, key=int):
+        bigwig_dir = batch_to_dir[batch_number]
+        for run, bw_filename in batch_to_bigwigs[batch_number]:
+            bw_file = os.path.join(bigwig_dir, bw_filename)
+            if bw_filename not in present[bigwig_dir]:
+                raise RuntimeError(
+                        'BigWig file {} was not found.'.format(bw_file)
+                    )
+            run_to_batch[run] = batch_number
+            run_to_bw_file[run] = bw_file
     with open(os.path.join(args.pheno_dir,
             'phs000424.v6.pht002741.v6.p1.GTEx_Sample.MULTI.txt'
         )) as id_stream:
@@ -17,24 +17,116 @@ We ran gzip -cd intropolis.v1.hg19.tsv.gz
         | pypy unique_and_total_junctions.py | sort -k8,8n
         >junction_stats.tsv
 
-junction_stats.tsv in this directory is the output.
+junction_stats.tsv in this directory is the output. Note that field 8 of
+that file is wrong: it was computed with the number of samples seen so far in
+place of the number of samples expressing each junction.
 
 We also executed
 
-awk '$6 >= 100000 {print $0 "\t" $7/$6}' junction_stats.tsv 
+awk '$6 >= 100000 {print $0 "\t" $7/$6}' junction_stats.tsv
     | sort -k9,9gr >junction_stats_with_unique_to_total_ratio.tsv
 
 to add an extra column giving the ratio of unique junctions contributed to
 total junctions contributed in those samples with over 100,000 junctions.
+
+Junctions are read in chunks whose sample lists are decoded into NumPy arrays
+and tallied per sample, in parallel if -p is more than 1; per-chunk tallies
+are then summed.
 """
 import argparse
+import itertools
+import multiprocessing
 import os
 import sys
-from collections import defaultdict
+import numpy as np
+
+_sample_count = None
+
+def _init_tally(sample_count):
+    """ Sets number of samples in a worker process """
+    global _sample_count
+    _sample_count = sample_count
+
+def tally_chunk(sample_lists):
+    """ Tallies junction stats of a chunk of junctions by sample
+
+        sample_lists: list of comma-separated lists of the indexes of samples
+            expressing each junction
+
+        Return value: tuple of NumPy arrays indexed by sample (number of
+            junctions, number of junctions expressed by only that sample, sum
+            over junctions of number of samples expressing junction)
+    """
+    samples = np.fromstring(','.join(sample_lists), dtype=np.int64, sep=',')
+    sample_counts = np.fromiter(
+            (sample_list.count(',') + 1 for sample_list in sample_lists),
+            dtype=np.int64, count=len(sample_lists)
+        )
+    if samples.size and samples.max() >= _sample_count:
+        raise RuntimeError(
+                'Sample index {} is not in the ID map.'.format(samples.max())
+            )
+    sharing = np.repeat(sample_counts, sample_counts)
+    return (np.bincount(samples, minlength=_sample_count),
+            np.bincount(samples[sharing == 1], minlength=_sample_count),
+            np.bincount(samples, weights=sharing,
+                        minlength=_sample_count).astype(np.int64))
+
+def sample_list_chunks(junction_stream, chunk_size):
+    """ Extracts sample lists of junctions in chunks
+
+        junction_stream: iterable over lines of junctions file
+        chunk_size: number of junctions per chunk
+
+        Yield value: list of comma-separated lists of sample indexes
+    """
+    while True:
+        chunk = [line.rsplit('\t', 2)[-2]
+                    for line in itertools.islice(junction_stream, chunk_size)]
+        if not chunk:
+            break
+        yield chunk
+
+def junction_stats(junction_stream, sample_count, num_processes=1,
+                    chunk_size=100000):
+    """ Computes junction stats by sample
+
+        junction_stream: iterable over lines of junctions file, with a
+            comma-separated list of sample indexes as the second-to-last
+            field
+        sample_count: number of samples
+        num_processes: number of processes tallying chunks simultaneously
+        chunk_size: number of junctions per chunk
+
+        Return value: tuple of NumPy arrays as returned by tally_chunk()
+            for all junctions
+    """
+    totals = [np.zeros(sample_count, dtype=np.int64) for _ in xrange(3)]
+    chunks = sample_list_chunks(junction_stream, chunk_size)
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes, initializer=_init_tally,
+                                        initargs=(sample_count,))
+        tallies = pool.imap_unordered(tally_chunk, chunks)
+    else:
+        pool = None
+        _init_tally(sample_count)
+        tallies = itertools.imap(tally_chunk, chunks)
+    try:
+        for k, tally in enumerate(tallies):
+            print >>sys.stderr, (
+                    '\x1b[KTallied {} chunks...\r'.format(k + 1)
+                ),
+            for total, chunk_total in zip(totals, tally):
+                total += chunk_total
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return tuple(totals)
 
 if __name__ == '__main__':
     # Print file's docstring if -h is invoked
-    parser = argparse.ArgumentParser(description=__doc__, 
+    parser = argparse.ArgumentParser(description=__doc__,
                 formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument(
             '--idmap', type=str, required=False,
@@ -42,25 +134,29 @@ if __name__ == '__main__':
                                  'intropolis.idmap.v1.hg19.tsv'),
             help='path to intropolis v1 ID map'
         )
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+            default=1,
+            help='maximum number of processes to run simultaneously'
+        )
+    parser.add_argument('--chunk-size', type=int, required=False,
+            default=100000,
+            help='number of junctions tallied at once by a process'
+        )
     args = parser.parse_args()
     idmap = {}
     with open(args.idmap) as idmap_stream:
         for line in idmap_stream:
             current_id = line.partition('\t')[0]
-            idmap[current_id] = line.strip()
-    (total_junctions, unique_junctions,
-        total_samples) = (defaultdict(int), defaultdict(int), defaultdict(int))
-    for line in sys.stdin:
-        tokens = line.strip().split('\t')
-        samples = tokens[-2].split(',')
-        num_samples = len(total_samples)
-        for sample in samples:
-            total_junctions[sample] += 1
-            total_samples[sample] += num_samples
-        if len(samples) == 1:
-            unique_junctions[sample] += 1
-    for sample in total_samples:
-        print '\t'.join([idmap[sample]] + map(str, [total_junctions[sample],
-                                              unique_junctions[sample],
-                                              float(total_samples[sample])
-                                                / total_junctions[sample]]))
+            idmap[int(current_id)] = line.strip()
+    total_junctions, unique_junctions, total_samples = junction_stats(
+            sys.stdin, max(idmap) + 1, num_processes=args.num_processes,
+            chunk_size=args.chunk_size
+        )
+    print >>sys.stderr, '\x1b[KDone.'
+    for sample in np.flatnonzero(total_junctions):
+        print '\t'.join([idmap[sample]] + map(str, [
+                    int(total_junctions[sample]),
+                    int(unique_junctions[sample]),
+                    float(total_samples[sample])
+                    / int(total_junctions[sample])
+                ]))
@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+"""
+junction_pca.py
+
+Computes principal components of samples from junction coverages on one
+machine, replacing splitJunctionsByBlock.R, createAta_ann.R,
+createAta_una.R, and createSVD.R, which build A^T A from blocks of
+junctions in cluster jobs.
+
+If --junctions is specified, the junctions file is streamed once. Each
+junction found in at least --min-samples samples is written to a CSR shard
+on disk: a scipy.sparse matrix holding coverages of --shard-size junctions
+(rows) across all samples (columns). Annotated and unannotated junctions are
+written to separate shards. Total junction coverage of each sample over all
+junctions is also recorded. Files written to --shard-dir:
+
+manifest.json
+1. number of samples
+2. --min-samples
+3. shard file names for annotated ("ann") and unannotated ("una") junctions
+
+[ann or una].[index].npz: a shard
+sample_coverage.npy: total junction coverage of each sample
+
+Then, unless --no-pca is invoked, the top --components right singular
+vectors of the junction x sample matrix A of each junction set are computed:
+1. samples whose library size is at most --min-library-size are dropped;
+2. each coverage x is normalized to log2(x / (library size / 10^7) + 1);
+3. each junction (row) is centered by subtracting its mean.
+
+Library sizes are computed as normalized_filtered_junctions.R computes
+totalReadsPred only if --read-counts is specified: it is the SRA metadata
+prep_junctions_sra.R reads (all_SRA_metadata.tsv), and a sample's library
+size is its sra_spots, doubled if its sra_layout is PAIRED. Where that is
+under 1000, it is predicted by a least-squares line fit to samples with more
+than 10000 reads, relating reads to coverage summed over the junctions in
+the shards. Runs missing from --read-counts get library size 0. The other
+choices do NOT match the R scripts: --auc uses each run's AUC from auc.tsv,
+and otherwise each sample's total coverage over all junctions in
+--junctions is used. splitJunctionsByBlock.R drops samples with
+totalReadsPred <= 1e5 after loading the normalized N1000 data, which the
+default --min-library-size of 1e5 reproduces; runs missing from
+--read-counts are dropped along with them.
+Normalization and centering are applied as each shard is read, so only one
+shard per process is held in memory. The singular vectors are found by
+randomized subspace iteration on A^T A: every pass reads all shards once
+and multiplies them by a block of --components + --oversampling vectors.
+
+Output: [out-prefix].annotated.tsv and [out-prefix].unannotated.tsv, each
+with a header line PC1, PC2, ... followed by one line per sample: its run
+accession number and its coordinates along each principal component.
+These can be read by prepare_pca_data.R in place of
+extdata/sra_junctions_pcmatrix_cutoff1000_[annotated or unannotated].tsv.
+[out-prefix].[annotated or unannotated].var.tsv has one line per component
+with its eigenvalue of A^T A (the squared singular value of A, which is
+what fsvd(ata)$d holds in createSVD.R) and getVar() of createSVD.R's svd
+as a percentage. Because getVar() squares d again, that percentage is the
+fourth power of the singular value over the total of fourth powers across
+computed components, not a proportion of variance.
+"""
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import numpy as np
+import scipy.sparse
+
+_MANIFEST = 'manifest.json'
+_JUNCTION_SETS = [('ann', 'annotated'), ('una', 'unannotated')]
+
+def build_shards(junction_file, annotated_file, shard_dir, sample_count,
+                    min_samples=1000, shard_size=10000):
+    """ Streams junctions once into sparse CSR shards
+
+        junction_file: gzipped junctions file with chromosome, start, end,
+            and strand as fields 1-4, a comma-separated list of sample
+            indexes as field 7, and a comma-separated list of coverages as
+            field 8; this is intropolis.v1.hg19.tsv.gz
+        annotated_file: path to annotated_junctions.tsv.gz
+        shard_dir: directory in which to write shards; it is created if it
+            does not exist
+        sample_count: number of samples
+        min_samples: min number of samples in which a junction must be
+            found to be written to a shard
+        shard_size: max number of junctions per shard
+
+        No return value.
+    """
+    try:
+        os.makedirs(shard_dir)
+    except OSError:
+        if not os.path.isdir(shard_dir):
+            raise
+    with gzip.open(annotated_file) as annotated_stream:
+        annotated_junctions = set(
+                tuple(line.strip().split('\t')[:4])
+                for line in annotated_stream
+            )
+    shards = {junction_set : [] for junction_set, _ in _JUNCTION_SETS}
+    buffers = {junction_set : ([], []) for junction_set, _ in _JUNCTION_SETS}
+    sample_coverage = np.zeros(sample_count, dtype=np.int64)
+
+    def flush_shard(junction_set):
+        """ Writes buffered junctions of a set to a shard """
+        sample_lists, coverage_lists = buffers[junction_set]
+        if not sample_lists:
+            return
+        indices = np.fromstring(
+                ','.join(sample_lists), dtype=np.int64, sep=','
+            )
+        data = np.fromstring(
+                ','.join(coverage_lists), dtype=np.float64, sep=','
+            )
+        indptr = np.zeros(len(sample_lists) + 1, dtype=np.int64)
+        np.cumsum([sample_list.count(',') + 1
+                    for sample_list in sample_lists], out=indptr[1:])
+        shard = scipy.sparse.csr_matrix(
+                (data, indices, indptr),
+                shape=(len(sample_lists), sample_count)
+            )
+        shard_file = '{}.{}.npz'.format(junction_set,
+                                            len(shards[junction_set]))
+        scipy.sparse.save_npz(os.path.join(shard_dir, shard_file), shard)
+        shards[junction_set].append(shard_file)
+        del sample_lists[:], coverage_lists[:]
+
+    sample_lists, coverage_lists = [], []
+
+    def tally_coverage():
+        """ Adds buffered coverages to samples' total junction coverage """
+        samples = np.fromstring(
+                ','.join(sample_lists), dtype=np.int64, sep=','
+            )
+        if samples.size and samples.max() >= sample_count:
+            raise RuntimeError(
+                    'Sample index {} is not in the id map.'.format(
+                            samples.max()
+                        )
+                )
+        sample_coverage[:] += np.bincount(
+                samples, weights=np.fromstring(
+                        ','.join(coverage_lists), dtype=np.float64, sep=','
+                    ), minlength=sample_count
+            ).astype(np.int64)
+        del sample_lists[:], coverage_lists[:]
+
+    with gzip.open(junction_file) as junction_stream:
+        for k, line in enumerate(junction_stream):
+            if not k % 100000:
+                print >>sys.stderr, (
+                        '\x1b[KRead {} junctions...\r'.format(k)
+                    ),
+            tokens = line.strip().split('\t')
+            sample_lists.append(tokens[6])
+            coverage_lists.append(tokens[7])
+            if len(sample_lists) >= 100000:
+                tally_coverage()
+            if tokens[6].count(',') + 1 < min_samples:
+                continue
+            junction_set = ('ann' if tuple(tokens[:4]) in annotated_junctions
+                                else 'una')
+            buffers[junction_set][0].append(tokens[6])
+            buffers[junction_set][1].append(tokens[7])
+            if len(buffers[junction_set][0]) >= shard_size:
+                flush_shard(junction_set)
+    tally_coverage()
+    for junction_set, _ in _JUNCTION_SETS:
+        flush_shard(junction_set)
+    np.save(os.path.join(shard_dir, 'sample_coverage.npy'), sample_coverage)
+    with open(os.path.join(shard_dir, _MANIFEST), 'w') as manifest_stream:
+        json.dump({
+                'sample_count' : sample_count,
+                'min_samples' : min_samples,
+                'shards' : shards
+            }, manifest_stream, indent=4, sort_keys=True)
+
+def read_total_reads(metadata_file, runs):
+    """ Computes numbers of reads as normalized_filtered_junctions.R does
+
+        metadata_file: tab-separated SRA metadata with a header line
+            including the fields run_accession, sra_spots, and sra_layout,
+            like all_SRA_metadata.tsv
+        runs: list of run accession numbers, one per sample index
+
+        Return value: 1D NumPy array with sra_spots of each sample, doubled
+            if it is paired-end, or NaN if its run is not in metadata_file
+    """
+    run_to_reads = {}
+    with open(metadata_file) as metadata_stream:
+        header = metadata_stream.readline().rstrip('\n').split('\t')
+        try:
+            run_field, spots_field, layout_field = [
+                    header.index(field) for field in
+                    ['run_accession', 'sra_spots', 'sra_layout']
+                ]
+        except ValueError:
+            raise RuntimeError(
+                    '{} lacks a run_accession, sra_spots, or sra_layout '
+                    'field.'.format(metadata_file)
+                )
+        for line in metadata_stream:
+            tokens = line.rstrip('\n').split('\t')
+            reads = float(tokens[spots_field])
+            if tokens[layout_field] == 'PAIRED':
+                reads *= 2
+            run_to_reads[tokens[run_field]] = reads
+    return np.array([run_to_reads.get(run, np.nan) for run in runs])
+
+def predict_total_reads(total_reads, junction_coverage):
+    """ Fills in small read counts as normalized_filtered_junctions.R does
+
+        A line is fit by least squares to the read counts over 10000 as a
+        function of junction coverage, and read counts under 1000 are
+        replaced by its predictions.
+
+        total_reads: 1D NumPy array of numbers of reads per sample; NaN
+            values are left alone
+        junction_coverage: 1D NumPy array of coverage per sample summed over
+            the junctions being analyzed
+
+        Return value: 1D NumPy array of predicted numbers of reads
+    """
+    predicted = total_reads.copy()
+    with np.errstate(invalid='ignore'):
+        fit, small = total_reads > 10000, total_reads < 1000
+    if small.any():
+        if fit.sum() < 2:
+            raise RuntimeError(
+                    'Too few samples have more than 10000 reads to predict '
+                    'read counts.'
+                )
+        slope, intercept = np.polyfit(junction_coverage[fit],
+                                        total_reads[fit], 1)
+        predicted[small] = intercept + slope * junction_coverage[small]
+    return predicted
+
+def shard_coverage(shard_files, sample_count):
+    """ Sums coverages of each sample over the junctions in shards
+
+        shard_files: paths to shards written by build_shards()
+        sample_count: number of samples
+
+        Return value: 1D NumPy array of summed coverage per sample
+    """
+    coverage = np.zeros(sample_count, dtype=np.float64)
+    for shard_file in shard_files:
+        coverage += np.asarray(
+                scipy.sparse.load_npz(shard_file).sum(axis=0)
+            ).ravel()
+    return coverage
+
+_columns, _scales = None, None
+
+def _init_gram(columns, scales):
+    """ Sets samples and their normalization in a worker process
+
+        columns: 1D NumPy array of indexes of samples to keep
+        scales: 1D NumPy array with each kept sample's library size divided
+            by 10^7
+
+        No return value.
+    """
+    global _columns, _scales
+    _columns, _scales = columns, scales
+
+def load_shard(shard_file):
+    """ Loads a shard with kept samples and normalized coverages
+
+        shard_file: path to shard written by build_shards()
+
+        Return value: tuple (CSR matrix with normalized coverages of kept
+            samples, 1D NumPy array of the mean of each row)
+    """
+    shard = scipy.sparse.load_npz(shard_file)[:, _columns]
+    shard.data = np.log2(
+            shard.data / _scales[shard.indices] + 1
+        )
+    return shard, np.asarray(shard.sum(axis=1)).ravel() / shard.shape[1]
+
+def gram_product(task):
+    """ Multiplies a block of vectors by a shard's contribution to A^T A
+
+        For the centered shard C = S - m 1^T, where S is the normalized shard
+        and m holds its row means, C^T C X = S^T (S X - m (1^T X))
+        - 1 (m^T (S X - m (1^T X))).
+
+        task: tuple (path to shard, 2D NumPy array X with one row per kept
+            sample)
+
+        Return value: 2D NumPy array C^T C X
+    """
+    shard_file, vectors = task
+    shard, means = load_shard(shard_file)
+    product = shard.dot(vectors) - np.outer(means, vectors.sum(axis=0))
+    return shard.T.dot(product) - means.dot(product)[None, :]
+
+def gram_multiply(shard_files, vectors, pool=None):
+    """ Computes A^T A X for the centered matrix A stored across shards
+
+        shard_files: paths to shards
+        vectors: 2D NumPy array X with one row per kept sample
+        pool: multiprocessing pool of workers initialized by _init_gram(),
+            or None to multiply in this process
+
+        Return value: 2D NumPy array A^T A X
+    """
+    tasks = ((shard_file, vectors) for shard_file in shard_files)
+    if pool is None:
+        products = itertools.imap(gram_product, tasks)
+    else:
+        products = pool.imap_unordered(gram_product, tasks)
+    result = np.zeros(vectors.shape, dtype=np.float64)
+    for product in products:
+        result += product
+    return result
+
+def randomized_svd(shard_files, sample_count, components=100,
+                    oversampling=10, power_iterations=4, seed=0, pool=None):
+    """ Finds top right singular vectors of the matrix stored across shards
+
+        Randomized subspace iteration on A^T A; each iteration reads every
+        shard once.
+
+        shard_files: paths to shards
+        sample_count: number of kept samples
+        components: number of singular vectors to find
+        oversampling: number of extra vectors in the block to improve
+            accuracy
+        power_iterations: number of subspace iterations
+        seed: random seed
+        pool: multiprocessing pool of workers initialized by _init_gram(),
+            or None to compute in this process
+
+        Return value: tuple (1D NumPy array of singular values in descending
+            order, 2D NumPy array whose columns are the corresponding right
+            singular vectors)
+    """
+    block_size = min(components + oversampling, sample_count)
+    random_state = np.random.RandomState(seed)
+    basis = random_state.normal(size=(sample_count, block_size))
+    for iteration in xrange(power_iterations + 1):
+        print >>sys.stderr, '\x1b[KPass {}/{} over shards...'.format(
+                iteration + 1, power_iterations + 2
+            )
+        basis, _ = np.linalg.qr(gram_multiply(shard_files, basis, pool=pool))
+    print >>sys.stderr, '\x1b[KPass {0}/{0} over shards...'.format(
+            power_iterations + 2
+        )
+    projected = basis.T.dot(gram_multiply(shard_files, basis, pool=pool))
+    eigenvalues, eigenvectors = np.linalg.eigh(
+            (projected + projected.T) / 2
+        )
+    order = np.argsort(eigenvalues)[::-1][:components]
+    return (np.sqrt(np.maximum(eigenvalues[order], 0)),
+                basis.dot(eigenvectors[:, order]))
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shard-dir', type=str, required=True,
+            help='directory holding shards'
+        )
+    parser.add_argument('--junctions', type=str, required=False,
+            default=None,
+            help=('junctions file from which to build shards; this should '
+                  'be intropolis.v1.hg19.tsv.gz. If unspecified, shards in '
+                  '--shard-dir are reused')
+        )
+    parser.add_argument('--annotated', type=str, required=False,
+            default=os.path.join(os.path.dirname(__file__), os.pardir,
+                                    'annotated_junctions.tsv.gz'),
+            help='path to annotated_junctions.tsv.gz'
+        )
+    parser.add_argument('--idmap', type=str, required=False,
+            default=os.path.join(os.path.dirname(__file__), 'metadata',
+                                    'index_to_SRA_accession.tsv'),
+            help='map from sample indexes to SRA accession numbers'
+        )
+    parser.add_argument('--min-samples', type=int, required=False,
+            default=1000,
+            help='min number of samples in which a junction is found'
+        )
+    parser.add_argument('--shard-size', type=int, required=False,
+            default=10000,
+            help='max number of junctions per shard'
+        )
+    parser.add_argument('--no-pca', action='store_const', const=True,
+            default=False,
+            help='only build shards'
+        )
+    parser.add_argument('--read-counts', type=str, required=False,
+            default=None,
+            help=('SRA metadata with run_accession, sra_spots, and '
+                  'sra_layout fields, like all_SRA_metadata.tsv; library '
+                  'sizes are then computed as in '
+                  'normalized_filtered_junctions.R')
+        )
+    parser.add_argument('--auc', type=str, required=False, default=None,
+            help=('auc.tsv from AUC.sh for the same alignments as '
+                  '--junctions; used for library sizes instead of total '
+                  'junction coverage')
+        )
+    parser.add_argument('--min-library-size', type=float, required=False,
+            default=1e5,
+            help='samples with at most this library size are dropped'
+        )
+    parser.add_argument('--components', type=int, required=False,
+            default=100,
+            help='number of principal components'
+        )
+    parser.add_argument('--oversampling', type=int, required=False,
+            default=10,
+            help='number of extra vectors used by the randomized SVD'
+        )
+    parser.add_argument('--power-iterations', type=int, required=False,
+            default=4,
+            help='number of subspace iterations of the randomized SVD'
+        )
+    parser.add_argument('--seed', type=int, required=False, default=0,
+            help='seed of the randomized SVD'
+        )
+    parser.add_argument('--out-prefix', type=str, required=False,
+            default='sra_junctions_pcmatrix',
+            help='prefix of output files'
+        )
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+            default=1,
+            help='maximum number of processes to run simultaneously'
+        )
+    args = parser.parse_args()
+    index_to_run = {}
+    with open(args.idmap) as idmap_stream:
+        for line in idmap_stream:
+            tokens = line.strip().split('\t')
+            index_to_run[int(tokens[0])] = tokens[4]
+    if args.junctions is not None:
+        build_shards(args.junctions, args.annotated, args.shard_dir,
+                        max(index_to_run) + 1, min_samples=args.min_samples,
+                        shard_size=args.shard_size)
+        print >>sys.stderr, '\x1b[KWrote shards.'
+    if args.no_pca:
+        sys.exit(0)
+    with open(os.path.join(args.shard_dir, _MANIFEST)) as manifest_stream:
+        manifest = json.load(manifest_stream)
+    sample_count = manifest['sample_count']
+    if args.read_counts is not None and args.auc is not None:
+        raise RuntimeError('Specify at most one of --read-counts and --auc.')
+    if args.read_counts is not None:
+        library_sizes = predict_total_reads(
+                read_total_reads(args.read_counts,
+                                    [index_to_run.get(index)
+                                        for index in xrange(sample_count)]),
+                shard_coverage(
+                        [os.path.join(args.shard_dir, str(shard_file))
+                            for junction_set, _ in _JUNCTION_SETS
+                            for shard_file
+                            in manifest['shards'][junction_set]],
+                        sample_count
+                    )
+            )
+        library_sizes[np.isnan(library_sizes)] = 0
+    elif args.auc is not None:
+        run_to_auc = {}
+        with open(args.auc) as auc_stream:
+            for line in auc_stream:
+                run, auc = line.split()
+                if run.endswith('.bw'):
+                    run = run[:-3]
+                run_to_auc[run] = float(auc)
+        library_sizes = np.array(
+                [run_to_auc.get(index_to_run.get(index), 0.)
+                    for index in xrange(sample_count)]
+            )
+    else:
+        library_sizes = np.load(
+                os.path.join(args.shard_dir, 'sample_coverage.npy')
+            ).astype(np.float64)
+    columns = np.flatnonzero(library_sizes > args.min_library_size)
+    print >>sys.stderr, 'Kept {} of {} samples.'.format(
+            columns.size, sample_count
+        )
+    # normalized_filtered_junctions.R divides by 10e6, which is 10^7
+    scales = library_sizes[columns] / 1e7
+    if args.num_processes > 1:
+        pool = multiprocessing.Pool(args.num_processes,
+                                        initializer=_init_gram,
+                                        initargs=(columns, scales))
+    else:
+        pool = None
+        _init_gram(columns, scales)
+    try:
+        for junction_set, name in _JUNCTION_SETS:
+            shard_files = [os.path.join(args.shard_dir, str(shard_file))
+                            for shard_file in manifest['shards'][junction_set]]
+            if not shard_files:
+                print >>sys.stderr, 'No {} junctions; skipping.'.format(name)
+                continue
+            print >>sys.stderr, 'Computing PCs of {} junctions...'.format(
+                    name
+                )
+            singular_values, vectors = randomized_svd(
+                    shard_files, columns.size, components=args.components,
+                    oversampling=args.oversampling,
+                    power_iterations=args.power_iterations, seed=args.seed,
+                    pool=pool
+                )
+            with open('.'.join([args.out_prefix, name, 'tsv']), 'w') \
+                    as output_stream:
+                print >>output_stream, '\t'.join(
+                        'PC{}'.format(i + 1)
+                        for i in xrange(vectors.shape[1])
+                    )
+                for run, row in zip(
+                        (index_to_run[index] for index in columns), vectors
+                    ):
+                    print >>output_stream, '\t'.join(
+                            [run] + ['{:.10g}'.format(value) for value in row]
+                        )
+            with open('.'.join([args.out_prefix, name, 'var', 'tsv']), 'w') \
+                    as output_stream:
+                # getVar() in createSVD.R squares fsvd(ata)$d, which is
+                # already squared singular values
+                eigenvalues = singular_values ** 2
+                fourth_powers = eigenvalues ** 2
+                for i, eigenvalue in enumerate(eigenvalues):
+                    print >>output_stream, '\t'.join(
+                            ['PC{}'.format(i + 1),
+                             '{:.10g}'.format(eigenvalue),
+                             '{:.2f}'.format(100 * fourth_powers[i]
+                                                / fourth_powers.sum())]
+                        )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -6,17 +6,93 @@ Ranks projects by the range in the absolute difference between the
 sample with the highest number of splice sites in ALK and the sample with the
 lowest number of splice sites in ALK. Excludes all partially aligned samples
 from consideration.
+
+More precisely, a project's samples are divided into two clusters by
+splice site count so that the total absolute deviation of counts from their
+cluster medians is minimized, and the project's rank is the difference
+between the cluster medians.
+
+If --junctions is specified, projects are instead ranked for every gene in
+--gtf to screen for ALK^ATI-like events genome-wide. Junctions lying in a
+gene on its strand are assigned to it in one sweep over the junctions file
+(see junction_query.py), and each sample's splice sites in the gene are
+accumulated as bitsets. Output is then tab-separated with fields
+
+1. gene name
+2. gene ID
+3. rank
+4. project
+5. number of samples in project
+6. number of samples in project with at least one splice site in gene
+
+with projects in order of descending rank for each gene. Projects none of
+whose samples have a splice site in a gene are omitted.
 """
 import sys
 import os
 import gzip
+import heapq
+import multiprocessing
 from collections import defaultdict
+import numpy as np
+from sample_mask import SampleMask
+
+# Number of set bits in every byte
+_POPCOUNT = np.array([bin(byte).count('1') for byte in xrange(256)],
+                        dtype=np.uint8)
 
 def median(lst):
-    quotient, remainder = divmod(len(lst), 2)
+    sorted_lst = sorted(lst)
+    quotient, remainder = divmod(len(sorted_lst), 2)
     if remainder:
-        return sorted(lst)[quotient]
-    return float(sum(sorted(lst)[quotient - 1:quotient + 1]) / 2)
+        return sorted_lst[quotient]
+    return float(sum(sorted_lst[quotient - 1:quotient + 1]) / 2)
+
+def two_median_split(counts):
+    """ Finds optimal split of sorted counts into two clusters
+
+        The cost of a split is the sum of absolute deviations of counts from
+        their cluster medians. Cluster costs for all split points are
+        computed at once from prefix sums of counts.
+
+        counts: list or 1D NumPy array of integers in descending order;
+            must have at least two elements
+
+        Return value: number of counts in first cluster; the first minimal
+            cost split is chosen
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    count_size = counts.size
+    prefix_sums = np.concatenate(([0], np.cumsum(counts)))
+    splits = np.arange(1, count_size)
+    # Medians of clusters counts[:split] and counts[split:] are at
+    # these indexes; counts above a median precede it
+    left_medians = splits // 2
+    right_medians = splits + (count_size - splits) // 2
+    left_values = counts[left_medians]
+    right_values = counts[right_medians]
+    costs = (
+            prefix_sums[left_medians] - left_medians * left_values
+            + (splits - left_medians) * left_values
+            - (prefix_sums[splits] - prefix_sums[left_medians])
+            + prefix_sums[right_medians] - prefix_sums[splits]
+            - (right_medians - splits) * right_values
+            + (count_size - right_medians) * right_values
+            - (prefix_sums[count_size] - prefix_sums[right_medians])
+        )
+    return int(np.argmin(costs)) + 1
+
+def _sorted_median(sorted_lst):
+    """ Computes median() of a list that is already sorted
+
+        sorted_lst: list of integers sorted in ascending or descending order
+
+        Return value: median as median() returns it
+    """
+    quotient, remainder = divmod(len(sorted_lst), 2)
+    if remainder:
+        return sorted_lst[quotient]
+    return float(sum(sorted_lst[quotient - 1:quotient + 1]) / 2)
 
 def kmedian(to_cluster):
     to_cluster_size = len(to_cluster)
@@ -27,23 +103,300 @@ def kmedian(to_cluster):
     else:
         to_cluster.sort(key=lambda x: x[1], reverse=True)
         counts = [el[1] for el in to_cluster]
-        costs = [sum(
-                [abs(el - counts[:i][i / 2])
-                    for el in counts[:i]]
-            ) + sum(
-                [abs(el - counts[i:][(to_cluster_size - i) / 2])
-                    for el in counts[i:]]
-            ) for i in xrange(1, to_cluster_size)]
-        partition_index = costs.index(min(costs)) + 1
-        left_median = median(counts[:partition_index])
-        right_median = median(counts[partition_index:])
+        partition_index = two_median_split(counts)
+        left_median = _sorted_median(counts[:partition_index])
+        right_median = _sorted_median(counts[partition_index:])
         return left_median - right_median
 
+def read_samples(idmap, incomplete, excluded=()):
+    """ Reads samples to consider, excluding partially aligned samples
+
+        idmap: path to map from sample indexes to SRA accession numbers
+        incomplete: path to output of incomplete.py
+        excluded: paths to other lists of runs to exclude, such as
+            hg38/excluded.txt; see sample_mask.py
+
+        Return value: tuple (dictionary mapping sample indexes to runs,
+            dictionary mapping projects to lists of runs)
+    """
+    sample_mask = SampleMask(idmap).exclude_run_file(incomplete)
+    for excluded_file in excluded:
+        sample_mask.exclude_run_file(excluded_file)
+    project_to_sample = defaultdict(list)
+    index_to_sample = {}
+    for index in sample_mask.kept():
+        project_to_sample[sample_mask.projects[index]].append(
+                sample_mask.runs[index]
+            )
+        index_to_sample[str(index)] = sample_mask.runs[index]
+    return index_to_sample, project_to_sample
+
+def rank_alk(alk_junctions, index_to_sample, project_to_sample):
+    """ Ranks projects by splice site counts of samples in ALK
+
+        alk_junctions: path to junctions in ALK computed in alk.sh
+        index_to_sample: dictionary mapping sample indexes to runs
+        project_to_sample: dictionary mapping projects to lists of runs
+
+        No return value.
+    """
+    sample_to_5p_splice_sites = defaultdict(set)
+    sample_to_3p_splice_sites = defaultdict(set)
+    totalexp = defaultdict(int)
+    with gzip.open(alk_junctions) as alk_stream:
+        for line in alk_stream:
+            tokens = line.strip().split('\t')
+            chrom, start, end, strand = (tokens[0], tokens[1], tokens[2],
+                                            tokens[3])
+            coverages = [int(token) for token in tokens[-1].split(',')]
+            for i, sample_index in enumerate(tokens[-2].split(',')):
+                try:
+                    if strand == '-':
+                        sample_to_5p_splice_sites[
+                                            index_to_sample[sample_index]
+                                        ].add((chrom, end))
+                        sample_to_3p_splice_sites[
+                                            index_to_sample[sample_index]
+                                        ].add((chrom, start))
+                    elif strand == '+':
+                        sample_to_5p_splice_sites[
+                                            index_to_sample[sample_index]
+                                        ].add((chrom, start))
+                        sample_to_3p_splice_sites[
+                                            index_to_sample[sample_index]
+                                        ].add((chrom, end))
+                    totalexp[index_to_sample[sample_index]] += coverages[i]
+                except KeyError:
+                    continue
+    for project in project_to_sample:
+        splice_site_counts = [(sample, len(sample_to_5p_splice_sites[sample])
+                                    + len(sample_to_3p_splice_sites[sample]))
+                                for sample in project_to_sample[project]]
+        splice_site_counts.sort(key=lambda x: x[1], reverse=True)
+        rank = kmedian(splice_site_counts)
+        if rank is not None:
+            print '\t'.join([str(rank), project]
+                            + [','.join(
+                                    (sample_and_count[0],
+                                     str(sample_and_count[1]),
+                                     str(totalexp[sample_and_count[0]]))
+                                ) for sample_and_count in splice_site_counts])
+
+def count_splice_sites(samples, five_prime_sites, three_prime_sites):
+    """ Counts distinct splice sites per sample using bitsets
+
+        samples: 1D NumPy array with the sample index of each
+            (junction, sample) pair
+        five_prime_sites: 1D NumPy array with the 5' splice site position of
+            each pair
+        three_prime_sites: 1D NumPy array with the 3' splice site position
+            of each pair
+
+        Return value: tuple (sorted array of distinct sample indexes, array
+            with number of distinct splice sites of each sample)
+    """
+    distinct_samples, sample_rows = np.unique(samples, return_inverse=True)
+    counts = np.zeros(distinct_samples.size, dtype=np.int64)
+    for sites in (five_prime_sites, three_prime_sites):
+        _, site_bits = np.unique(sites, return_inverse=True)
+        bitsets = np.zeros(
+                (distinct_samples.size, (site_bits.max() >> 3) + 1),
+                dtype=np.uint8
+            )
+        np.bitwise_or.at(
+                bitsets, (sample_rows, site_bits >> 3),
+                np.left_shift(1, site_bits & 7).astype(np.uint8)
+            )
+        counts += _POPCOUNT[bitsets].sum(axis=1, dtype=np.int64)
+    return distinct_samples, counts
+
+_sample_projects, _project_sizes = None, None
+
+def _init_ranker(sample_projects, project_sizes):
+    """ Sets sample-to-project map in a worker process
+
+        sample_projects: 1D NumPy array mapping sample indexes to project
+            indexes, or -1 for excluded samples
+        project_sizes: 1D NumPy array with number of samples in each project
+
+        No return value.
+    """
+    global _sample_projects, _project_sizes
+    _sample_projects, _project_sizes = sample_projects, project_sizes
+
+def rank_gene(task):
+    """ Ranks projects by splice site counts of their samples in a gene
+
+        task: tuple (gene index, 1D NumPy array of sample indexes, 1D NumPy
+            array of 5' splice sites, 1D NumPy array of 3' splice sites) as
+            for count_splice_sites()
+
+        Return value: tuple (gene index, list of tuples (rank, project
+            index, number of samples with at least one splice site), in
+            order of descending rank)
+    """
+    gene_index, samples, five_prime_sites, three_prime_sites = task
+    projects = _sample_projects[samples]
+    considered = projects >= 0
+    if not considered.any():
+        return gene_index, []
+    distinct_samples, counts = count_splice_sites(
+            samples[considered], five_prime_sites[considered],
+            three_prime_sites[considered]
+        )
+    projects = _sample_projects[distinct_samples]
+    order = np.lexsort((-counts, projects))
+    projects, counts = projects[order], counts[order]
+    bounds = np.flatnonzero(np.diff(projects)) + 1
+    ranks = []
+    for project_counts, project in zip(
+            np.split(counts, bounds),
+            projects[np.concatenate(([0], bounds))]
+        ):
+        # Samples without splice sites in gene have counts of 0
+        project_counts = [int(count) for count in project_counts] + [0] * (
+                int(_project_sizes[project]) - project_counts.size
+            )
+        rank = kmedian([(None, count) for count in project_counts])
+        ranks.append((rank, int(project), len(project_counts)
+                        - project_counts.count(0)))
+    ranks.sort(key=lambda rank: rank[0], reverse=True)
+    return gene_index, ranks
+
+def gene_tasks(junction_file, queries):
+    """ Gathers (junction, sample) pairs of each gene in one sweep
+
+        A gene's pairs are released as soon as the sweep passes its end, so
+        junction_file must be sorted by chromosome and start position.
+
+        junction_file: junctions file as for junction_query.py
+        queries: list of tuples (chromosome, 1-based start, 1-based end,
+            strand) of genes
+
+        Yield value: tasks for rank_gene()
+    """
+    from junction_query import sweep_junctions
+    pairs = defaultdict(list)
+    # Heap of (end, gene index) for genes with pairs
+    gene_ends = []
+    finished_chroms = set()
+    last_chrom, last_start = None, 0
+
+    def task(gene_index):
+        samples, five_prime_sites, three_prime_sites = zip(
+                *pairs.pop(gene_index)
+            )
+        return (gene_index, np.concatenate(samples),
+                    np.concatenate(five_prime_sites),
+                    np.concatenate(three_prime_sites))
+
+    for matched, line in sweep_junctions(junction_file, queries):
+        tokens = line.rstrip('\n').split('\t')
+        start, end = int(tokens[1]), int(tokens[2])
+        if tokens[0] != last_chrom:
+            if tokens[0] in finished_chroms:
+                raise RuntimeError(
+                        'Junctions file is not sorted by chromosome.'
+                    )
+            finished_chroms.add(last_chrom)
+            while gene_ends:
+                yield task(heapq.heappop(gene_ends)[1])
+            last_chrom = tokens[0]
+        elif start < last_start:
+            raise RuntimeError(
+                    'Junctions file is not sorted by start position.'
+                )
+        last_start = start
+        while gene_ends and gene_ends[0][0] < start:
+            yield task(heapq.heappop(gene_ends)[1])
+        samples = np.fromstring(tokens[6], dtype=np.int64, sep=',')
+        if tokens[3] == '-':
+            five_prime, three_prime = end, start
+        else:
+            five_prime, three_prime = start, end
+        five_prime_sites = np.repeat(five_prime, samples.size)
+        three_prime_sites = np.repeat(three_prime, samples.size)
+        for gene_index in matched:
+            if gene_index not in pairs:
+                heapq.heappush(gene_ends, (queries[gene_index][2],
+                                            gene_index))
+            pairs[gene_index].append(
+                    (samples, five_prime_sites, three_prime_sites)
+                )
+    while gene_ends:
+        yield task(heapq.heappop(gene_ends)[1])
+
+def rank_genes(junction_file, genes, index_to_sample, project_to_sample,
+                num_processes=1, top=None):
+    """ Ranks projects for every gene and writes results to stdout
+
+        junction_file: junctions file as for junction_query.py
+        genes: list of tuples (gene name, gene ID, chromosome, 1-based start,
+            1-based end, strand)
+        index_to_sample: dictionary mapping sample indexes to runs
+        project_to_sample: dictionary mapping projects to lists of runs
+        num_processes: number of processes ranking genes simultaneously
+        top: if not None, number of top-ranked projects to write per gene
+
+        No return value.
+    """
+    projects = sorted(project_to_sample)
+    project_indexes = {project : i for i, project in enumerate(projects)}
+    sample_to_project = {}
+    for project in project_to_sample:
+        for sample in project_to_sample[project]:
+            sample_to_project[sample] = project_indexes[project]
+    sample_projects = np.empty(
+            max(int(index) for index in index_to_sample) + 1, dtype=np.int64
+        )
+    sample_projects.fill(-1)
+    for index, sample in index_to_sample.items():
+        sample_projects[int(index)] = sample_to_project[sample]
+    project_sizes = np.array(
+            [len(project_to_sample[project]) for project in projects],
+            dtype=np.int64
+        )
+    queries = [gene[2:] for gene in genes]
+    tasks = (
+            (gene_index, samples[samples < sample_projects.size],
+                five_prime_sites[samples < sample_projects.size],
+                three_prime_sites[samples < sample_projects.size])
+            for gene_index, samples, five_prime_sites, three_prime_sites
+            in gene_tasks(junction_file, queries)
+        )
+    if num_processes > 1:
+        pool = multiprocessing.Pool(
+                num_processes, initializer=_init_ranker,
+                initargs=(sample_projects, project_sizes)
+            )
+        results = pool.imap_unordered(rank_gene, tasks)
+    else:
+        pool = None
+        _init_ranker(sample_projects, project_sizes)
+        results = (rank_gene(task) for task in tasks)
+    try:
+        for k, (gene_index, ranks) in enumerate(results):
+            if not k % 1000:
+                print >>sys.stderr, (
+                        '\x1b[KRanked projects for {} genes...\r'.format(k)
+                    ),
+            for rank, project, expressing in ranks[:top]:
+                print '\t'.join(
+                        map(str, genes[gene_index][:2] + (
+                                rank, projects[project],
+                                project_sizes[project], expressing
+                            ))
+                    )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
 if __name__ == '__main__':
     containing_dir = os.path.dirname(__file__)
     import argparse
     # Print file's docstring if -h is invoked
-    parser = argparse.ArgumentParser(description=__doc__, 
+    parser = argparse.ArgumentParser(description=__doc__,
                 formatter_class=argparse.RawDescriptionHelpFormatter)
     # Add command-line arguments
     parser.add_argument(
@@ -63,56 +416,53 @@ if __name__ == '__main__':
             help=('output of incomplete.py; used to exclude samples from '
                   'consideration')
         )
+    parser.add_argument('--exclude', type=str, required=False, nargs='+',
+            default=[],
+            help=('other lists of runs to exclude from consideration, such '
+                  'as hg38/excluded.txt')
+        )
+    parser.add_argument('--junctions', type=str, required=False,
+            default=None,
+            help=('rank projects for every gene in --gtf using this sorted '
+                  'junctions file, which should be intropolis.v2.hg38.tsv.gz '
+                  'or a copy of it indexed by junction_query.py, instead of '
+                  'ranking them for ALK')
+        )
+    parser.add_argument('--gtf', type=str, required=False, default=None,
+            help=('GTF with genes to rank projects for; we used '
+                  'ftp://ftp.ensembl.org/pub/release-83/gtf/homo_sapiens/'
+                  'Homo_sapiens.GRCh38.83.gtf.gz')
+        )
+    parser.add_argument('--gene-index', type=str, required=False,
+            default=None,
+            help='where to cache gene intervals read from --gtf'
+        )
+    parser.add_argument('--top', type=int, required=False, default=None,
+            help='number of top-ranked projects to write per gene'
+        )
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+            default=1,
+            help='maximum number of processes to run simultaneously'
+        )
     args = parser.parse_args()
-
-sample_to_5p_splice_sites = defaultdict(set)
-sample_to_3p_splice_sites = defaultdict(set)
-project_to_sample = defaultdict(list)
-totalexp = defaultdict(int)
-index_to_sample = {}
-incomplete_samples = set()
-with open(args.incomplete) as incomplete_stream:
-    incomplete_samples = set([line.strip().split('\t')[3]
-                                for line in incomplete_stream.readlines()[1:]])
-with open(args.idmap) as idmap_stream:
-    for line in idmap_stream:
-        tokens = line.strip().split('\t')
-        if tokens[4] not in incomplete_samples:
-            project_to_sample[tokens[1]].append(tokens[4])
-            index_to_sample[tokens[0]] = tokens[4]
-with gzip.open(args.alk_junctions) as alk_stream:
-    for line in alk_stream:
-        tokens = line.strip().split('\t')
-        chrom, start, end, strand = tokens[0], tokens[1], tokens[2], tokens[3]
-        coverages = [int(token) for token in tokens[-1].split(',')]
-        for i, sample_index in enumerate(tokens[-2].split(',')):
-            try:
-                if strand == '-':
-                    sample_to_5p_splice_sites[
-                                        index_to_sample[sample_index]
-                                    ].add((chrom, end))
-                    sample_to_3p_splice_sites[
-                                        index_to_sample[sample_index]
-                                    ].add((chrom, start))
-                elif strand == '+':
-                    sample_to_5p_splice_sites[
-                                        index_to_sample[sample_index]
-                                    ].add((chrom, start))
-                    sample_to_3p_splice_sites[
-                                        index_to_sample[sample_index]
-                                    ].add((chrom, end))
-                totalexp[index_to_sample[sample_index]] += coverages[i]
-            except KeyError:
-                continue
-for project in project_to_sample:
-    splice_site_counts = [(sample, len(sample_to_5p_splice_sites[sample])
-                                    + len(sample_to_3p_splice_sites[sample]))
-                                for sample in project_to_sample[project]]
-    splice_site_counts.sort(key=lambda x: x[1], reverse=True)
-    rank = kmedian(splice_site_counts)
-    if rank is not None:
-        print '\t'.join([str(rank), project]
-                        + [','.join(
-                                (sample_and_count[0], str(sample_and_count[1]),
-                                 str(totalexp[sample_and_count[0]]))
-                            ) for sample_and_count in splice_site_counts])
+    index_to_sample, project_to_sample = read_samples(
+            args.idmap, args.incomplete, excluded=args.exclude
+        )
+    if args.junctions is None:
+        rank_alk(args.alk_junctions, index_to_sample, project_to_sample)
+    else:
+        from junction_query import read_genes
+        names, loci = {}, {}
+        for name, gene_loci in read_genes(
+                args.gtf, gene_index=args.gene_index
+            ).items():
+            for gene_id, chrom, start, end, strand in gene_loci:
+                loci[gene_id] = (chrom, start, end, strand)
+                if name != gene_id:
+                    names[gene_id] = name
+        genes = sorted(
+                [(names.get(gene_id, gene_id), gene_id) + loci[gene_id]
+                    for gene_id in loci], key=lambda gene: gene[2:]
+            )
+        rank_genes(args.junctions, genes, index_to_sample, project_to_sample,
+                    num_processes=args.num_processes, top=args.top)
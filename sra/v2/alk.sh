@@ -3,13 +3,17 @@
 # According to mysql -h genome-mysql.cse.ucsc.edu -A -u genome -D hg38 -e 'select * from refGene where name="NM_004304"\G'
 # the ALK gene is on "Chromosome 2: 29,192,774-29,921,612 reverse strand."
 # (Note we use 1-based coordinates while 0-based coordinates are returned by the mysql command
-JUNC=$1
-# Select junctions only in ALK
-gzip -cd $JUNC | grep -w chr2 | grep -w "-" | awk '$2 >= 29192774 && $2 <= 29921612 && $3 >= 29192774 && $3 <= 29921612' | gzip >alk_junctions.tsv.gz
 # Now according to the Nature paper http://www.nature.com/nature/journal/v526/n7573/full/nature15258.html,
 # many cancers have an alternative transcription initiation site after intron 19; in other words,
 # for the so-called alternative ALK^{ATI} transcript, no junction with coordinates >= 29,223,529
 # should be expressed. Divide these up into "start" (unexpressed in ATI; exons 1-19) expression and
 # "end" (expressed in ATI; exons 20-29) expression.
-gzip -cd alk_junctions.tsv.gz | awk '$2 >= 29223529' | gzip >alk_start_junctions.tsv.gz
-gzip -cd alk_junctions.tsv.gz | awk '$2 < 29223529' | gzip >alk_end_junctions.tsv.gz
+# junction_query.py reads only the blocks overlapping ALK if the junctions file was indexed with its --build-index.
+JUNC=$1
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+OUT=$(mktemp -d)
+python $DIR/junction_query.py --junctions $JUNC --intervals alk=chr2:29192774-29921612:- --split alk:29223529 --out-dir $OUT
+mv $OUT/alk.tsv.gz alk_junctions.tsv.gz
+mv $OUT/alk.29223529-29921612.tsv.gz alk_start_junctions.tsv.gz
+mv $OUT/alk.29192774-29223528.tsv.gz alk_end_junctions.tsv.gz
+rm -r $OUT
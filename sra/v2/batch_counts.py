@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+batch_counts.py
+
+Reads per-run read counts from the counts.tsv.gz files Rail-RNA writes to
+the cross_sample_results subdirectory of each batch_* directory. Files are
+read concurrently, and the parsed counts are cached in a compact NumPy .npz
+table along with the path, size, and mtime of each counts file read; the
+cache is reused only while the same counts files are requested and none has
+changed, so one cache can't be mistaken for another's. incomplete.py,
+recount2_metadata.py, metadata_db.py, and ../../gtex/incomplete.py all read
+counts through this module, and reconcile_read_count() holds the check of
+SRA's reported paired-end status that incomplete.py and
+recount2_metadata.py share.
+
+Run this script to (re)build a cache; tab-separated output fields are
+
+1. run accession number
+2. number of reads Rail attempted to map
+3. number of reads mapped
+"""
+import glob
+import gzip
+import multiprocessing
+import os
+import re
+import sys
+import numpy as np
+
+def batch_count_files(batch_dir, batch_count=None):
+    """ Lists counts.tsv.gz files in order of batch number
+
+        batch_dir: directory with batch_* subdirectories
+        batch_count: number of batches, numbered from 0; if None, all
+            batch_* subdirectories are used
+
+        Return value: list of paths to counts.tsv.gz files
+    """
+    if batch_count is None:
+        batch_numbers = sorted(
+                int(re.search(r'batch_(\d+)$', batch).group(1))
+                for batch in glob.glob(os.path.join(batch_dir, 'batch_*'))
+                if re.search(r'batch_(\d+)$', batch)
+            )
+    else:
+        batch_numbers = range(batch_count)
+    return [os.path.join(batch_dir, 'batch_{}'.format(i),
+                            'cross_sample_results', 'counts.tsv.gz')
+                for i in batch_numbers]
+
+def read_count_file(count_file):
+    """ Reads a counts.tsv.gz file
+
+        count_file: path to counts.tsv.gz
+
+        Return value: list of tuples (run accession number, number of reads
+            Rail attempted to map, number of reads mapped)
+    """
+    counts = []
+    with gzip.open(count_file) as count_stream:
+        count_stream.readline()
+        for line in count_stream:
+            tokens = line.strip().split('\t')
+            counts.append((tokens[0].partition('_')[0],
+                            int(tokens[-1].partition(',')[0]),
+                            int(tokens[-2].partition(',')[0])))
+    return counts
+
+def read_batch_counts(batch_dir, batch_count=None, num_processes=1,
+                        cache=None):
+    """ Reads counts.tsv.gz files of all batches
+
+        batch_dir: directory with batch_* subdirectories
+        batch_count: number of batches, numbered from 0; if None, all
+            batch_* subdirectories are used
+        num_processes: number of processes reading files simultaneously
+        cache: path to .npz file in which to cache counts or None; if it
+            exists and was built from the same counts files, none of which
+            has since changed size or mtime, counts are read from it instead
+
+        Return value: list of tuples (run accession number, number of reads
+            Rail attempted to map, number of reads mapped) in order of batch
+            number and then line
+    """
+    count_files = batch_count_files(batch_dir, batch_count)
+    paths = np.array([os.path.abspath(count_file)
+                        for count_file in count_files], dtype=str)
+    stats = [os.stat(count_file) for count_file in count_files]
+    sizes = np.array([stat.st_size for stat in stats], dtype=np.int64)
+    mtimes = np.array([stat.st_mtime for stat in stats], dtype=np.float64)
+    if cache is not None and os.path.exists(cache):
+        with np.load(cache) as table:
+            if 'count_files' in table.files and (
+                    np.array_equal(table['count_files'], paths)
+                    and np.array_equal(table['count_file_sizes'], sizes)
+                    and np.array_equal(table['count_file_mtimes'], mtimes)
+                ):
+                return zip(table['runs'].tolist(),
+                            table['reads_aligned'].tolist(),
+                            table['mapped_read_counts'].tolist())
+        print >>sys.stderr, (
+                'Counts cache {} was built from other counts files or they '
+                'have changed; rebuilding it.'.format(cache)
+            )
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes)
+        try:
+            file_counts = pool.map(read_count_file, count_files)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        file_counts = map(read_count_file, count_files)
+    counts = [count for counts in file_counts for count in counts]
+    if cache is not None:
+        partial_cache = cache + '.partial'
+        with open(partial_cache, 'wb') as cache_stream:
+            np.savez(cache_stream,
+                     runs=np.array([count[0] for count in counts], dtype=str),
+                     reads_aligned=np.array(
+                            [count[1] for count in counts], dtype=np.int64
+                        ),
+                     mapped_read_counts=np.array(
+                            [count[2] for count in counts], dtype=np.int64
+                        ),
+                     count_files=paths, count_file_sizes=sizes,
+                     count_file_mtimes=mtimes)
+        os.rename(partial_cache, cache)
+    return counts
+
+def reconcile_read_count(sra_read_count, paired, reads_aligned):
+    """ Corrects paired-end status misreported by SRA
+
+        A run that yields more reads than SRA reports was likely recorded as
+        single-end when it is paired-end, and a run that yields exactly half
+        as many was likely recorded as paired-end when it is single-end.
+
+        sra_read_count: number of reads reported by SRA, with mates counted
+            separately
+        paired: '1' if SRA reports run is paired-end, else '0'
+        reads_aligned: number of reads Rail attempted to map
+
+        Return value: tuple (corrected number of reads, proportion of reads
+            Rail attempted to map or 'NA' if SRA reports no reads,
+            corrected paired-end status '1' or '0', True iff status was
+            misreported)
+    """
+    try:
+        ratio = float(reads_aligned) / sra_read_count
+    except ZeroDivisionError:
+        return sra_read_count, 'NA', paired, False
+    if ratio > 1:
+        '''Mislabeled sample; whp recorded as SINGLE
+        when PAIRED'''
+        sra_read_count *= 2
+        return (sra_read_count, float(reads_aligned) / sra_read_count, '1',
+                True)
+    elif ratio == 0.5:
+        '''Mislabeled sample; whp recorded as PAIRED
+        when SINGLE'''
+        sra_read_count /= 2
+        return (sra_read_count, float(reads_aligned) / sra_read_count, '0',
+                True)
+    return sra_read_count, ratio, paired, False
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-dir', type=str, required=True,
+            help='directory with batch_* subdirectories of Rail-RNA output'
+        )
+    parser.add_argument('--batch-count', type=int, required=False,
+            default=None,
+            help=('number of batches; by default, all batch_* '
+                  'subdirectories are read')
+        )
+    parser.add_argument('--cache', type=str, required=True,
+            help='.npz file in which to cache counts'
+        )
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+            default=1,
+            help='maximum number of processes to run simultaneously'
+        )
+    args = parser.parse_args()
+    for count in read_batch_counts(args.batch_dir,
+                                    batch_count=args.batch_count,
+                                    num_processes=args.num_processes,
+                                    cache=args.cache):
+        print '\t'.join(map(str, count))
+    print >>sys.stderr, 'Done.'
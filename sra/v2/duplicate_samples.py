@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""
+duplicate_samples.py
+
+Finds pairs of samples whose sets of junctions are identical or nearly so,
+as for resubmitted or technically duplicated runs, without comparing all
+pairs of samples.
+
+One pass over the junctions file builds a MinHash signature of each sample's
+junction set: each of --hashes hash functions is evaluated on every junction
+once, and each sample keeps the minimum value of each function over its
+junctions. The fraction of signature entries two samples share estimates the
+Jaccard similarity of their junction sets. Signatures are split into --bands
+bands, and samples whose signatures agree in every entry of some band are
+candidate pairs. Pairs of samples with Jaccard similarity s become candidates
+with probability 1 - (1 - s^r)^b for b bands of r entries, which is near 1
+for near-duplicates and near 0 for unrelated samples. Samples with fewer
+than --min-junctions junctions are not compared, and a band shared by more
+than --max-bucket-size samples yields no candidates, with a warning, so that
+one large group of look-alike samples can't produce billions of pairs.
+
+Junctions are identified by their line numbers, so signatures are comparable
+only among samples from the same junctions file. Signatures may be saved
+with --signatures and reused with --from-signatures to try other banding
+parameters.
+
+Output (tab-separated), one line per candidate pair with estimated Jaccard
+similarity of at least --min-similarity, in order of descending similarity:
+1. sample index of first sample
+2. project accession number of first sample
+3. run accession number of first sample
+4. number of junctions of first sample
+5-8. same as 1-4 for second sample
+9. estimated Jaccard similarity
+"""
+import gzip
+import itertools
+import multiprocessing
+import sys
+import numpy as np
+
+_UINT32_MAX = np.iinfo(np.uint32).max
+
+def hash_parameters(hash_count, seed=0):
+    """ Draws parameters of multiply-add-shift hash functions
+
+        hash_count: number of hash functions
+        seed: random seed; signatures are comparable only if computed with
+            the same hash functions
+
+        Return value: tuple (multipliers, addends), each a 1D uint64 NumPy
+            array of length hash_count
+    """
+    random_state = np.random.RandomState(seed)
+    multipliers = random_state.randint(
+            0, 1 << 62, size=hash_count, dtype=np.int64
+        ).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+    addends = random_state.randint(
+            0, 1 << 62, size=hash_count, dtype=np.int64
+        ).astype(np.uint64)
+    return multipliers, addends
+
+_parameters = None
+
+def _init_sketch(parameters):
+    """ Sets hash function parameters in a worker process """
+    global _parameters
+    _parameters = parameters
+
+def sketch_chunk(chunk):
+    """ Computes MinHash signatures over a chunk of junctions
+
+        chunk: tuple (index of first junction in chunk, list of
+            comma-separated lists of the indexes of samples expressing each
+            junction)
+
+        Return value: tuple (sorted 1D NumPy array of distinct sample
+            indexes in chunk, 2D uint32 NumPy array whose ith row is the
+            signature of the ith sample over junctions in chunk, 1D NumPy
+            array with number of junctions of each sample in chunk)
+    """
+    first_junction, sample_lists = chunk
+    multipliers, addends = _parameters
+    samples = np.fromstring(','.join(sample_lists), dtype=np.int64, sep=',')
+    sample_counts = np.fromiter(
+            (sample_list.count(',') + 1 for sample_list in sample_lists),
+            dtype=np.int64, count=len(sample_lists)
+        )
+    junctions = np.arange(
+            first_junction, first_junction + len(sample_lists),
+            dtype=np.uint64
+        )
+    # Hash every junction once, then gather hashes for its samples
+    hashes = (
+            (junctions[:, None] * multipliers[None, :] + addends[None, :])
+            >> np.uint64(32)
+        ).astype(np.uint32)
+    order = np.argsort(samples, kind='mergesort')
+    pair_hashes = hashes[np.repeat(
+            np.arange(len(sample_lists)), sample_counts
+        )[order]]
+    samples = samples[order]
+    starts = np.flatnonzero(
+            np.concatenate(([True], samples[1:] != samples[:-1]))
+        )
+    return (samples[starts], np.minimum.reduceat(pair_hashes, starts, axis=0),
+                np.diff(np.append(starts, samples.size)))
+
+def junction_chunks(junction_file, chunk_pairs):
+    """ Extracts sample lists of junctions in chunks
+
+        junction_file: gzipped junctions file with a comma-separated list of
+            sample indexes as field 7
+        chunk_pairs: approximate number of (junction, sample) pairs per chunk
+
+        Yield value: tuple (index of first junction in chunk, list of
+            comma-separated lists of sample indexes)
+    """
+    chunk, pairs, first_junction = [], 0, 0
+    with gzip.open(junction_file) as junction_stream:
+        for k, line in enumerate(junction_stream):
+            sample_list = line.split('\t', 7)[6]
+            chunk.append(sample_list)
+            pairs += sample_list.count(',') + 1
+            if pairs >= chunk_pairs:
+                yield first_junction, chunk
+                chunk, pairs, first_junction = [], 0, k + 1
+    if chunk:
+        yield first_junction, chunk
+
+def sample_signatures(junction_file, sample_count, hash_count=128, seed=0,
+                        num_processes=1, chunk_pairs=100000):
+    """ Computes MinHash signatures of samples' junction sets
+
+        junction_file: gzipped junctions file with a comma-separated list of
+            sample indexes as field 7; this is intropolis.v2.hg38.tsv.gz
+        sample_count: number of samples
+        hash_count: number of hash functions, i.e., length of signature
+        seed: seed for drawing hash functions
+        num_processes: number of processes sketching chunks simultaneously
+        chunk_pairs: approximate number of (junction, sample) pairs per
+            chunk; memory used per process is proportional to chunk_pairs *
+            hash_count
+
+        Return value: tuple (2D uint32 NumPy array whose ith row is the
+            signature of sample i, 1D NumPy array with number of junctions of
+            each sample); samples without junctions have signatures of all
+            2^32 - 1
+    """
+    parameters = hash_parameters(hash_count, seed=seed)
+    signatures = np.empty((sample_count, hash_count), dtype=np.uint32)
+    signatures.fill(_UINT32_MAX)
+    junction_counts = np.zeros(sample_count, dtype=np.int64)
+    chunks = junction_chunks(junction_file, chunk_pairs)
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes, initializer=_init_sketch,
+                                        initargs=(parameters,))
+        sketches = pool.imap_unordered(sketch_chunk, chunks)
+    else:
+        pool = None
+        _init_sketch(parameters)
+        sketches = itertools.imap(sketch_chunk, chunks)
+    try:
+        for k, (samples, chunk_signatures, counts) in enumerate(sketches):
+            if not k % 100:
+                print >>sys.stderr, (
+                        '\x1b[KSketched {} chunks...\r'.format(k)
+                    ),
+            if samples.size and samples[-1] >= sample_count:
+                raise RuntimeError(
+                        'Sample index {} is not in the id map.'.format(
+                                samples[-1]
+                            )
+                    )
+            signatures[samples] = np.minimum(
+                    signatures[samples], chunk_signatures
+                )
+            junction_counts[samples] += counts
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return signatures, junction_counts
+
+def candidate_pairs(signatures, band_count, samples=None,
+                        max_bucket_size=1000):
+    """ Finds pairs of samples whose signatures agree in at least one band
+
+        A bucket of n samples sharing a band yields n(n-1)/2 pairs, so
+        buckets larger than max_bucket_size, such as those of many
+        low-depth samples with the same few junctions, are skipped with a
+        warning rather than expanded.
+
+        signatures: 2D uint32 NumPy array of signatures, one per row; the
+            number of columns must be divisible by band_count
+        band_count: number of bands
+        samples: 1D NumPy array of indexes of rows to consider, or None for
+            all rows
+        max_bucket_size: max number of samples in a bucket whose pairs
+            are made candidates
+
+        Return value: tuple (1D NumPy array of first sample indexes, 1D NumPy
+            array of second sample indexes) of distinct pairs, where the
+            first index is less than the second
+    """
+    if samples is None:
+        samples = np.arange(signatures.shape[0])
+    hash_count = signatures.shape[1]
+    if hash_count % band_count:
+        raise RuntimeError(
+                'Number of hashes ({}) is not divisible by number of bands '
+                '({}).'.format(hash_count, band_count)
+            )
+    rows = hash_count // band_count
+    multipliers, _ = hash_parameters(rows, seed=band_count)
+    pairs = []
+    skipped, largest = 0, 0
+    for band in xrange(band_count):
+        # Combine a band's entries into one key; colliding keys only add
+        # candidates, which are scored later anyway
+        keys = (
+                signatures[samples, band * rows:(band + 1) * rows].astype(
+                        np.uint64
+                    ) * multipliers[None, :]
+            ).sum(axis=1, dtype=np.uint64)
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(
+                np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))
+            )
+        sizes = np.diff(np.append(starts, sorted_keys.size))
+        oversized = sizes > max_bucket_size
+        if oversized.any():
+            skipped += oversized.sum()
+            largest = max(largest, sizes.max())
+        expanded = (sizes > 1) & ~oversized
+        for start, size in zip(starts[expanded], sizes[expanded]):
+            bucket = np.sort(samples[order[start:start + size]])
+            first, second = np.triu_indices(size, 1)
+            pairs.append(
+                    (bucket[first].astype(np.int64) << 32) | bucket[second]
+                )
+    if skipped:
+        print >>sys.stderr, (
+                'Warning: skipped {} bucket(s) of more than {} samples '
+                '(largest: {}) whose samples share a band; their pairs are '
+                'not candidates. Raise --min-junctions to exclude samples '
+                'with few junctions, or raise --max-bucket-size.'
+            ).format(skipped, max_bucket_size, largest)
+    if not pairs:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pairs = np.unique(np.concatenate(pairs))
+    return pairs >> 32, pairs & 0xffffffff
+
+def estimated_similarities(signatures, first, second, block_size=100000):
+    """ Estimates Jaccard similarities of pairs of samples
+
+        signatures: 2D uint32 NumPy array of signatures, one per row
+        first: 1D NumPy array of first sample indexes
+        second: 1D NumPy array of second sample indexes
+        block_size: number of pairs to compare at once
+
+        Return value: 1D NumPy array of fractions of signature entries
+            shared by pairs
+    """
+    similarities = np.empty(first.size, dtype=np.float64)
+    for start in xrange(0, first.size, block_size):
+        end = start + block_size
+        similarities[start:end] = (
+                signatures[first[start:end]] == signatures[second[start:end]]
+            ).mean(axis=1)
+    return similarities
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--junctions', type=str, required=False,
+            default=None,
+            help='junctions file; this should be intropolis.v2.hg38.tsv.gz'
+        )
+    parser.add_argument('--idmap', type=str, required=True,
+            help=('map from sample indexes to SRA accession numbers; this '
+                  'should be intropolis.idmap.v2.hg38.tsv')
+        )
+    parser.add_argument('--hashes', type=int, required=False, default=128,
+            help='number of hash functions, i.e., length of a signature'
+        )
+    parser.add_argument('--bands', type=int, required=False, default=16,
+            help=('number of bands into which signatures are split; more '
+                  'bands find less similar pairs but yield more false '
+                  'candidates')
+        )
+    parser.add_argument('--seed', type=int, required=False, default=0,
+            help='seed for drawing hash functions'
+        )
+    parser.add_argument('--min-similarity', type=float, required=False,
+            default=0.9,
+            help='min estimated Jaccard similarity of a reported pair'
+        )
+    parser.add_argument('--min-junctions', type=int, required=False,
+            default=100,
+            help=('min number of junctions of a sample to be compared; '
+                  'samples with few junctions look alike without being '
+                  'duplicates')
+        )
+    parser.add_argument('--max-bucket-size', type=int, required=False,
+            default=1000,
+            help=('max number of samples sharing a band whose pairs are '
+                  'compared; larger buckets are skipped with a warning')
+        )
+    parser.add_argument('--chunk-pairs', type=int, required=False,
+            default=100000,
+            help=('number of (junction, sample) pairs sketched at once by a '
+                  'process')
+        )
+    parser.add_argument('--signatures', type=str, required=False,
+            default=None,
+            help='where to save signatures and junction counts as .npz'
+        )
+    parser.add_argument('--from-signatures', type=str, required=False,
+            default=None,
+            help=('.npz of signatures saved with --signatures; --junctions '
+                  'is not read')
+        )
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+            default=1,
+            help='maximum number of processes to run simultaneously'
+        )
+    args = parser.parse_args()
+    id_to_accessions = {}
+    with open(args.idmap) as idmap_stream:
+        for line in idmap_stream:
+            tokens = line.strip().split('\t')
+            id_to_accessions[int(tokens[0])] = (tokens[1], tokens[4])
+    if args.from_signatures is not None:
+        saved = np.load(args.from_signatures)
+        signatures, junction_counts = (saved['signatures'],
+                                        saved['junction_counts'])
+    elif args.junctions is None:
+        raise RuntimeError('Specify --junctions or --from-signatures.')
+    else:
+        signatures, junction_counts = sample_signatures(
+                args.junctions, max(id_to_accessions) + 1,
+                hash_count=args.hashes, seed=args.seed,
+                num_processes=args.num_processes,
+                chunk_pairs=args.chunk_pairs
+            )
+        if args.signatures is not None:
+            np.savez(args.signatures, signatures=signatures,
+                        junction_counts=junction_counts)
+    print >>sys.stderr, '\x1b[KFinding candidate pairs...'
+    first, second = candidate_pairs(
+            signatures, args.bands,
+            samples=np.flatnonzero(
+                    junction_counts >= max(args.min_junctions, 1)
+                ),
+            max_bucket_size=args.max_bucket_size
+        )
+    similarities = estimated_similarities(signatures, first, second)
+    print >>sys.stderr, (
+            '{} candidate pairs; {} with estimated similarity >= {}.'
+        ).format(first.size, (similarities >= args.min_similarity).sum(),
+                    args.min_similarity)
+    for i in np.argsort(-similarities, kind='mergesort'):
+        if similarities[i] < args.min_similarity:
+            break
+        print '\t'.join(map(str,
+                [first[i]] + list(id_to_accessions[first[i]])
+                + [junction_counts[first[i]], second[i]]
+                + list(id_to_accessions[second[i]])
+                + [junction_counts[second[i]], similarities[i]]
+            ))
@@ -3,10 +3,28 @@
 combine_studies.py
 
 Combines GTEx and SRA junctions.
+
+Sample indexes in each SRA batch's junctions are remapped to global indexes
+(written to sra_map.tsv) with a NumPy array per batch. Every input must be
+sorted by chromosome (bytewise), start position, and end position; SRA batch
+files may be sorted by chromosome and strand together, since each batch is
+read as two streams, one per strand. All streams are merged with a heap and
+written grouped by junction, so no temporary file or external sort is needed.
+Output is tab-separated:
+1. chromosome
+2. start position
+3. end position
+4. strand
+5. comma-separated list of GTEx sample indexes, or NA if none
+6. comma-separated list of corresponding GTEx coverages, or NA if none
+7. comma-separated list of SRA sample indexes, or NA if none
+8. comma-separated list of corresponding SRA coverages, or NA if none
 """
 import gzip
+import heapq
+import itertools
 import os
-from collections import defaultdict
+import numpy as np
 
 def stream_to_list(stream):
     """ Converts each line in a stream to a list and yields it.
@@ -18,6 +36,67 @@ def stream_to_list(stream):
     for line in stream:
         yield line.strip().split('\t')
 
+def check_sorted(junctions, junction_file):
+    """ Passes through junctions, checking that they are sorted
+
+        junctions: iterable of tuples whose first element is (chromosome,
+            start position, end position, strand)
+        junction_file: name of file from which junctions were read; used in
+            error message
+
+        Yield value: item from junctions
+    """
+    last_key = None
+    for junction in junctions:
+        if last_key is not None and junction[0] < last_key:
+            raise RuntimeError(
+                    ('Junction file "{}" is not sorted by chromosome, start '
+                     'position, and end position.').format(junction_file)
+                )
+        last_key = junction[0]
+        yield junction
+
+def gtex_junctions(gtex_file):
+    """ Reads junctions from GTEx
+
+        gtex_file: path to gzipped GTEx junction file
+
+        Yield value: tuple ((chromosome, start position, end position,
+            strand), 0, comma-separated sample indexes, comma-separated
+            coverages)
+    """
+    with gzip.open(gtex_file) as gtex_stream:
+        for tokens in stream_to_list(gtex_stream):
+            yield ((tokens[0], int(tokens[1]), int(tokens[2]), tokens[3]),
+                    0, tokens[6], tokens[7])
+
+def sra_junctions(sra_file, batch, strand, remap):
+    """ Reads junctions on one strand from an SRA batch
+
+        sra_file: path to gzipped SRA junction file for batch, whose first
+            field is chromosome followed by strand
+        batch: index of batch
+        strand: + or -; junctions on other strand are skipped
+        remap: NumPy array mapping sample indexes in batch to global sample
+            indexes
+
+        Yield value: tuple ((chromosome, start position, end position,
+            strand), batch + 1, comma-separated global sample indexes,
+            comma-separated coverages)
+    """
+    with gzip.open(sra_file) as sra_stream:
+        for tokens in stream_to_list(sra_stream):
+            if tokens[0][-1] != strand:
+                continue
+            start, end = int(tokens[1]), int(tokens[2])
+            if end <= start:
+                continue
+            samples = remap[
+                    np.fromstring(tokens[-2], dtype=np.int64, sep=',')
+                ]
+            yield ((tokens[0][:-1], start, end, strand), batch + 1,
+                    ','.join(map(str, samples.tolist())), tokens[-1])
+
 if __name__ == '__main__':
     import argparse
     # Print file's docstring if -h is invoked
@@ -29,30 +108,20 @@ if __name__ == '__main__':
             help='space-separated gzipped SRA junction files IN BATCH ORDER'
         )
     parser.add_argument('--gtex-junctions', type=str, required=True,
-            help='bid price for each m3.xlarge instance; this instance '
-                 'type is used for preprocessing data'
+            help='gzipped GTEx junction file output by combine_gtex.py'
         )
     parser.add_argument('--manifest-path', type=str, required=False,
             default=os.path.dirname(os.path.abspath(__file__)),
             help='path to manifest files for all of SRA job flow'
         )
-    parser.add_argument('--temp-dir', type=str, required=True,
-            help='path to some temporary directory'
-        )
     args = parser.parse_args()
-    import tempfile
-    temp_junction_path = tempfile.mkdtemp(dir=args.temp_dir)
-    import atexit
-    import shutil
-    atexit.register(shutil.rmtree, temp_junction_path)
 
-    all_junctions = os.path.join(temp_junction_path, 'all_junctions.tsv.gz')
     batch_count = len(args.sra_junctions)
-    index_to_index = [defaultdict(int) for _ in xrange(batch_count)]
+    remaps = []
     index_counter = 0
     with open('sra_map.tsv', 'w') as map_stream:
         for i in xrange(batch_count):
-            old_index_counter = 0
+            batch_start = index_counter
             with open(os.path.join(
                             args.manifest_path,
                             'sra_batch_{}.manifest'.format(i)
@@ -61,60 +130,39 @@ if __name__ == '__main__':
                     line = line.strip()
                     if not line or line[0] == '#':
                         continue
-                    index_to_index[i][str(old_index_counter)] \
-                        = str(index_counter)
                     print >>map_stream, '\t'.join([
                             str(index_counter), line.partition('\t')[0].split(
                                                     ':'
                                                 )[1]
                         ])
                     index_counter += 1
-                    old_index_counter += 1
-    with gzip.open(all_junctions, 'w') as temp_stream:
-        for i, sra_file in enumerate(args.sra_junctions):
-            with gzip.open(sra_file) as sra_stream:
-                for line in sra_stream:
-                    tokens = line.strip().split('\t')
-                    tokens[-2] = ','.join([index_to_index[i][j]
-                                            for j in tokens[-2].split(',')])
-                    if int(tokens[2]) > int(tokens[1]):
-                        print >>temp_stream, '\t'.join(
-                                [tokens[0][:-1], tokens[1], tokens[2],
-                                    tokens[0][-1], tokens[-2], tokens[-1], 's']
-                            )
-        with gzip.open(args.gtex_junctions) as gtex_stream:
-            for line in gtex_stream:
-                tokens = line.strip().split('\t')
-                print >>temp_stream, '\t'.join(tokens[:4] + tokens[6:] + ['g'])
-    import subprocess
-    sorted_file = os.path.join(temp_junction_path,
-                                'all_junctions.sorted.tsv.gz')
-    subprocess.check_call(
-        'gzip -cd {} | sort -k1,1 -k2,2n -k3,3n -T {} | gzip >{}'.format(
-                                all_junctions,
-                                temp_junction_path,
-                                sorted_file
-                            ), shell=True, bufsize=-1)
-    import itertools
-    with gzip.open(sorted_file) as sorted_stream:
-        for key, group in itertools.groupby(stream_to_list(sorted_stream),
-                                            lambda x: x[:4]):
-            gtex_samples = []
-            gtex_coverages = []
-            sra_samples = []
-            sra_coverages = []
-            for tokens in group:
-                if tokens[-1] == 'g':
-                    gtex_samples.append(tokens[-3])
-                    gtex_coverages.append(tokens[-2])
-                else:
-                    sra_samples.append(tokens[-3])
-                    sra_coverages.append(tokens[-2])
-            print '\t'.join(key + [','.join(gtex_samples)
-                                        if gtex_samples else 'NA',
-                                   ','.join(gtex_coverages)
-                                        if gtex_samples else 'NA',
-                                   ','.join(sra_samples)
-                                        if sra_samples else 'NA',
-                                   ','.join(sra_coverages)
-                                        if sra_samples else 'NA'])
+            remaps.append(np.arange(batch_start, index_counter))
+    streams = [check_sorted(gtex_junctions(args.gtex_junctions),
+                            args.gtex_junctions)]
+    for i, sra_file in enumerate(args.sra_junctions):
+        for strand in '+-':
+            streams.append(check_sorted(
+                    sra_junctions(sra_file, i, strand, remaps[i]), sra_file
+                ))
+    for key, group in itertools.groupby(heapq.merge(*streams),
+                                        lambda x: x[0]):
+        gtex_samples = []
+        gtex_coverages = []
+        sra_samples = []
+        sra_coverages = []
+        for _, source, samples, coverages in group:
+            if source == 0:
+                gtex_samples.append(samples)
+                gtex_coverages.append(coverages)
+            else:
+                sra_samples.append(samples)
+                sra_coverages.append(coverages)
+        print '\t'.join([key[0], str(key[1]), str(key[2]), key[3],
+                               ','.join(gtex_samples)
+                                    if gtex_samples else 'NA',
+                               ','.join(gtex_coverages)
+                                    if gtex_samples else 'NA',
+                               ','.join(sra_samples)
+                                    if sra_samples else 'NA',
+                               ','.join(sra_coverages)
+                                    if sra_samples else 'NA'])
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""
+fetch_biosamples.py
+
+Fetches NCBI Biosample metadata of SRA sample accession numbers with batched
+E-utilities requests, replacing the per-sample curl calls get_biosample_data.sh
+used to make. Accession numbers are read one per line from stdin or
+--accessions, and lines in the format xmlparse.py reads are written to stdout:
+
+1. SRA sample accession number
+2. (empty)
+3. <SampleData> element with the sample's Biosample XML
+
+Accession numbers are split into batches of --batch-size. For each batch, one
+esearch request finds the batch's Biosample UIDs and one esummary request
+fetches their summaries, each of which is assigned to the accession numbers
+in the batch it mentions. Batches are fetched concurrently by --threads
+threads that together send no more than --rate requests per second; NCBI
+allows 3 per second, or 10 with an API key. Failed requests are retried with
+exponential backoff.
+
+Summaries are appended to --cache as they are fetched, so an interrupted run
+can be resumed. On a rerun, only accession numbers missing from the cache,
+those for which no Biosample was found, and those whose Biosamples were
+modified since they were cached (found with batched esearch requests
+restricted to modification dates) are fetched. The cache is a tab-separated
+file with fields
+
+1. SRA sample accession number
+2. time fetched as YYYY/MM/DD HH:MM:SS
+3. Biosample UID, or NA if none was found
+4. <SampleData> element, or NA if no Biosample was found
+
+--eutils-url can point to a local server for testing.
+"""
+import os
+import re
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import xml.etree.ElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
+
+_eutils_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+
+class RateLimiter(object):
+    """ Spaces calls to wait() across threads at a fixed rate. """
+
+    def __init__(self, rate):
+        """
+            rate: maximum number of calls per second
+        """
+        self.interval = 1. / rate
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """ Blocks until the next call is permitted
+
+            No return value.
+        """
+        with self.lock:
+            now = time.time()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+class EUtilsClient(object):
+    """ Sends E-utilities requests with rate limiting and retries. """
+
+    def __init__(self, eutils_url=_eutils_url, rate=3, retries=5,
+                    api_key=None, email=None, timeout=120):
+        """
+            eutils_url: base URL of E-utilities
+            rate: maximum number of requests per second
+            retries: number of times to retry a failed request
+            api_key: NCBI API key or None
+            email: contact email address sent to NCBI or None
+            timeout: seconds to wait for a response
+        """
+        self.eutils_url = eutils_url.rstrip('/')
+        self.rate_limiter = RateLimiter(rate)
+        self.retries = retries
+        self.timeout = timeout
+        self.common = {'tool' : 'fetch_biosamples'}
+        if api_key is not None:
+            self.common['api_key'] = api_key
+        if email is not None:
+            self.common['email'] = email
+
+    def request(self, utility, **params):
+        """ POSTs a request, retrying on failure
+
+            utility: name of E-utility, like esearch
+            params: request parameters
+
+            Return value: ElementTree.Element of response
+        """
+        params.update(self.common)
+        data = urllib.urlencode(params)
+        url = '{}/{}.fcgi'.format(self.eutils_url, utility)
+        for attempt in xrange(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                response = urllib2.urlopen(url, data, timeout=self.timeout)
+                try:
+                    return ElementTree.fromstring(response.read())
+                finally:
+                    response.close()
+            except urllib2.HTTPError as e:
+                # Client errors other than rate limiting won't go away
+                if 400 <= e.code < 500 and e.code != 429:
+                    raise
+                error = e
+            except (urllib2.URLError, IOError, ElementTree.ParseError) as e:
+                error = e
+            if attempt < self.retries:
+                print >>sys.stderr, (
+                        '\x1b[K{} request failed ({}); retrying...'.format(
+                                utility, error
+                            )
+                    )
+                time.sleep(2 ** attempt)
+        raise RuntimeError(
+                '{} request failed after {} attempts: {}'.format(
+                        utility, self.retries + 1, error
+                    )
+            )
+
+    def search(self, accessions, modified_since=None):
+        """ Finds Biosample UIDs matching accession numbers
+
+            accessions: list of SRA sample accession numbers
+            modified_since: if not None, a date YYYY/MM/DD; only Biosamples
+                modified on or after it are found
+
+            Return value: list of Biosample UIDs
+        """
+        params = dict(db='biosample', term=' OR '.join(accessions),
+                        retmax=10 * len(accessions) + 100)
+        if modified_since is not None:
+            params.update(datetype='mdat', mindate=modified_since,
+                            maxdate='3000/12/31')
+        return [uid.text for uid in self.request(
+                        'esearch', **params
+                    ).iter('Id')]
+
+    def summaries(self, uids):
+        """ Fetches Biosample summaries
+
+            uids: list of Biosample UIDs
+
+            Return value: list of tuples (UID, Identifiers field of summary,
+                <SampleData> element as a string)
+        """
+        if not uids:
+            return []
+        response = self.request('esummary', db='biosample',
+                                    id=','.join(uids))
+        summaries = []
+        for summary in response.iter('DocumentSummary'):
+            sample_data = (summary.findtext('SampleData') or '').replace(
+                    '\n', ' '
+                ).replace('\t', ' ')
+            if isinstance(sample_data, unicode):
+                sample_data = sample_data.encode('utf-8')
+            summaries.append((summary.get('uid'),
+                                summary.findtext('Identifiers') or '',
+                                '<SampleData>{}</SampleData>'.format(
+                                        sample_data.strip()
+                                    )))
+        return summaries
+
+def fetch_batch(client, accessions):
+    """ Fetches Biosample data of a batch of accession numbers
+
+        client: EUtilsClient
+        accessions: list of SRA sample accession numbers
+
+        Return value: dictionary mapping each accession number to a list of
+            tuples (Biosample UID, <SampleData> element); the list is empty
+            if no Biosample was found
+    """
+    results = {accession : [] for accession in accessions}
+    patterns = [(accession, re.compile(r'\b{}\b'.format(re.escape(accession))))
+                    for accession in accessions]
+    for uid, identifiers, sample_data in client.summaries(
+                client.search(accessions)
+            ):
+        for accession, pattern in patterns:
+            if pattern.search(identifiers) or pattern.search(sample_data):
+                results[accession].append((uid, sample_data))
+    return results
+
+def read_cache(cache):
+    """ Reads cache of Biosample data
+
+        Later entries for an accession number replace earlier ones.
+
+        cache: path to cache file
+
+        Return value: dictionary mapping each accession number to a tuple
+            (time fetched, list of tuples (Biosample UID, <SampleData>
+            element))
+    """
+    cached = {}
+    if not os.path.exists(cache):
+        return cached
+    with open(cache) as cache_stream:
+        for line in cache_stream:
+            tokens = line.rstrip('\n').split('\t')
+            if len(tokens) != 4:
+                # Line truncated by an interrupted run
+                continue
+            accession, fetched, uid, sample_data = tokens
+            if accession not in cached or cached[accession][0] != fetched:
+                cached[accession] = (fetched, [])
+            if uid != 'NA':
+                cached[accession][1].append((uid, sample_data))
+    return cached
+
+def write_cache_entry(cache_stream, accession, fetched, entries):
+    """ Writes an accession number's Biosample data to the cache
+
+        cache_stream: file object for cache
+        accession: SRA sample accession number
+        fetched: time fetched as YYYY/MM/DD HH:MM:SS
+        entries: list of tuples (Biosample UID, <SampleData> element)
+
+        No return value.
+    """
+    for uid, sample_data in (entries or [('NA', 'NA')]):
+        print >>cache_stream, '\t'.join([accession, fetched, uid,
+                                            sample_data])
+
+def fetch_biosamples(accessions, cache, client, batch_size=200, threads=3):
+    """ Fetches Biosample data, updating cache
+
+        accessions: list of SRA sample accession numbers
+        cache: path to cache file
+        client: EUtilsClient
+        batch_size: number of accession numbers per request
+        threads: number of batches to fetch concurrently
+
+        Return value: dictionary as returned by read_cache() with the
+            accession numbers in accessions
+    """
+    cached = read_cache(cache)
+    accessions = sorted(set(accessions))
+    to_fetch = [accession for accession in accessions
+                    if accession not in cached or not cached[accession][1]]
+    pool = ThreadPool(threads)
+    try:
+        stale = [accession for accession in accessions
+                    if accession in cached and cached[accession][1]]
+        if stale:
+            # Refetch accession numbers whose Biosamples were modified
+            modified_since = min(cached[accession][0]
+                                    for accession in stale).split(' ')[0]
+            modified = set(
+                    uid for uids in pool.imap_unordered(
+                            lambda batch: client.search(
+                                    batch, modified_since=modified_since
+                                ),
+                            [stale[i:i+batch_size]
+                                for i in xrange(0, len(stale), batch_size)]
+                        ) for uid in uids
+                )
+            to_fetch.extend(
+                    accession for accession in stale
+                    if any(uid in modified
+                            for uid, _ in cached[accession][1])
+                )
+            to_fetch.sort()
+        print >>sys.stderr, (
+                '{} of {} accession numbers are cached; fetching {}.'.format(
+                        len(accessions) - len(to_fetch), len(accessions),
+                        len(to_fetch)
+                    )
+            )
+        with open(cache, 'a') as cache_stream:
+            for k, results in enumerate(pool.imap_unordered(
+                        lambda batch: fetch_batch(client, batch),
+                        [to_fetch[i:i+batch_size]
+                            for i in xrange(0, len(to_fetch), batch_size)]
+                    )):
+                fetched = time.strftime('%Y/%m/%d %H:%M:%S')
+                for accession in sorted(results):
+                    write_cache_entry(cache_stream, accession, fetched,
+                                        results[accession])
+                    cached[accession] = (fetched, results[accession])
+                cache_stream.flush()
+                print >>sys.stderr, (
+                        '\x1b[KFetched {} batches...\r'.format(k + 1)
+                    ),
+    finally:
+        pool.close()
+        pool.join()
+    # Compact cache so replaced entries don't accumulate
+    partial_cache = cache + '.partial'
+    with open(partial_cache, 'w') as cache_stream:
+        for accession in sorted(cached):
+            write_cache_entry(cache_stream, accession, cached[accession][0],
+                                cached[accession][1])
+    os.rename(partial_cache, cache)
+    return {accession : cached[accession] for accession in accessions}
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--accessions', type=str, required=False,
+            default=None,
+            help=('file with one SRA sample accession number per line; '
+                  'default is stdin')
+        )
+    parser.add_argument('--cache', type=str, required=False,
+            default='biosample_cache.tsv',
+            help='where to cache Biosample data'
+        )
+    parser.add_argument('--batch-size', type=int, required=False,
+            default=200,
+            help='number of accession numbers per request'
+        )
+    parser.add_argument('--threads', type=int, required=False, default=3,
+            help='number of batches to fetch concurrently'
+        )
+    parser.add_argument('--rate', type=float, required=False, default=3,
+            help='maximum number of requests per second'
+        )
+    parser.add_argument('--retries', type=int, required=False, default=5,
+            help='number of times to retry a failed request'
+        )
+    parser.add_argument('--api-key', type=str, required=False, default=None,
+            help='NCBI API key, which permits up to 10 requests per second'
+        )
+    parser.add_argument('--email', type=str, required=False, default=None,
+            help='contact email address to send to NCBI'
+        )
+    parser.add_argument('--eutils-url', type=str, required=False,
+            default=_eutils_url,
+            help='base URL of E-utilities'
+        )
+    args = parser.parse_args()
+    if args.accessions is None:
+        accessions = [line.strip() for line in sys.stdin if line.strip()]
+    else:
+        with open(args.accessions) as accession_stream:
+            accessions = [line.strip() for line in accession_stream
+                            if line.strip()]
+    client = EUtilsClient(eutils_url=args.eutils_url, rate=args.rate,
+                            retries=args.retries, api_key=args.api_key,
+                            email=args.email)
+    biosamples = fetch_biosamples(accessions, args.cache, client,
+                                    batch_size=args.batch_size,
+                                    threads=args.threads)
+    for accession in sorted(biosamples):
+        for _, sample_data in biosamples[accession][1]:
+            print '\t'.join([accession, '', sample_data])
+    print >>sys.stderr, '\x1b[KDone.'
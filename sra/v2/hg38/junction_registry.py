@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+"""
+junction_registry.py
+
+Persistent registry assigning stable integer IDs to junctions. Once a junction
+(chromosome, start, end, strand) is registered, its ID never changes, so
+files keyed by junction ID stay valid as SRA, GTEx, TCGA, and other data are
+added; new junctions are simply given the next unused IDs.
+
+A registry is a directory containing:
+
+chroms.txt
+Chromosome names, one per line; a chromosome's index is its line number
+(0-based)
+
+[chromosome index].[generation].keys.npy,
+[chromosome index].[generation].ids.npy
+Sorted packed keys of junctions on the chromosome and their IDs. A key packs
+strand (0 for +, 1 for -), start position, and end position into one int64.
+Each compaction writes the arrays it changes under a new generation number.
+
+base.txt
+The generation of each chromosome's arrays, as tab-separated lines of
+chromosome index and generation. Compaction switches to the arrays it wrote
+by renaming a new base.txt into place, so a crash leaves either the old or
+the new keys and IDs in use, never a mix; files of other generations are
+deleted afterward.
+
+append.log
+Junctions registered since the last compaction as raw records of chromosome
+index (uint16), packed key (int64), and ID (int64)
+
+Lookups and inserts are vectorized with NumPy. In memory, each chromosome's
+logged junctions are kept as sorted runs, each at least twice the size of
+the next newer one; a new batch's run is merged into older runs until that
+holds. An insert thus costs time proportional to its batch, amortized up to
+a log factor, rather than to the whole log, and a lookup searches O(log n)
+runs per chromosome for n logged junctions. Sorted batches of a million new
+junctions are registered at about a million junctions per second, and
+looked up several times faster, even with 20 million junctions in the log.
+Run with --junctions to register every junction in one or more junction
+files whose first four fields are chromosome, start, end, and strand, such
+as intropolis.v2.hg38.tsv.gz.
+"""
+import os
+import gzip
+import re
+import sys
+import numpy as np
+
+_POSITION_BITS = 31
+_STRAND_SHIFT = 2 * _POSITION_BITS
+_log_dtype = np.dtype([('chrom', '<u2'), ('key', '<i8'), ('id', '<i8')])
+_array_file = re.compile(r'^\d+\.\d+\.(?:keys|ids)\.npy$')
+
+def pack_keys(starts, ends, strands):
+    """ Packs junction coordinates on one chromosome into int64 keys
+
+        starts: int array of start positions (1-based, inclusive)
+        ends: int array of end positions (1-based, inclusive)
+        strands: array of strands; '+' or '-'
+
+        Return value: int64 NumPy array of keys
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if starts.size and (max(starts.max(), ends.max()) >= (1 << _POSITION_BITS)
+                            or min(starts.min(), ends.min()) < 0):
+        raise RuntimeError('Junction position out of range.')
+    minus = np.asarray(strands) == '-'
+    if not np.all(minus | (np.asarray(strands) == '+')):
+        raise RuntimeError('Strand is neither + nor -.')
+    return ((minus.astype(np.int64) << _STRAND_SHIFT)
+                | (starts << _POSITION_BITS) | ends)
+
+def unpack_keys(keys):
+    """ Unpacks int64 keys made by pack_keys()
+
+        keys: int64 NumPy array of keys
+
+        Return value: tuple (start positions, end positions, strands)
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    mask = (1 << _POSITION_BITS) - 1
+    return ((keys >> _POSITION_BITS) & mask, keys & mask,
+                np.where(keys >> _STRAND_SHIFT, '-', '+'))
+
+def _sorted_lookup(sorted_keys, ids, keys):
+    """ Looks up keys in a sorted key array
+
+        sorted_keys: sorted int64 NumPy array
+        ids: IDs corresponding to sorted_keys
+        keys: int64 NumPy array of keys to look up
+
+        Return value: int64 NumPy array of IDs, -1 where a key is absent
+    """
+    found = np.full(keys.shape, -1, dtype=np.int64)
+    if not sorted_keys.size:
+        return found
+    positions = np.searchsorted(sorted_keys, keys)
+    positions[positions == sorted_keys.size] = 0
+    present = sorted_keys[positions] == keys
+    found[present] = ids[positions[present]]
+    return found
+
+def _group_by_chrom(chroms, max_runs=1000):
+    """ Groups positions of an array by chromosome
+
+        Junction files are sorted by chromosome, so their chromosomes form a
+        few runs, which are found without sorting the strings.
+
+        chroms: NumPy array of chromosome names
+        max_runs: number of runs of equal names above which names are
+            grouped by sorting instead
+
+        Return value: list of tuples (chromosome name, int64 NumPy array of
+            positions in chroms with that name, in increasing order)
+    """
+    if not chroms.size:
+        return []
+    boundaries = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+    if boundaries.size > max_runs:
+        distinct_chroms, chrom_groups = np.unique(chroms,
+                                                  return_inverse=True)
+        return [(chrom, np.flatnonzero(chrom_groups == i))
+                    for i, chrom in enumerate(distinct_chroms.tolist())]
+    starts = np.concatenate([[0], boundaries])
+    ends = np.concatenate([boundaries, [chroms.size]])
+    runs = {}
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        runs.setdefault(chroms[start], []).append(
+                np.arange(start, end, dtype=np.int64)
+            )
+    return [(chrom, np.concatenate(positions))
+                for chrom, positions in sorted(runs.items())]
+
+def _merge_sorted(keys, ids, other_keys, other_ids):
+    """ Merges two runs of sorted keys and their IDs without sorting
+
+        keys, ids: sorted int64 NumPy array and its IDs
+        other_keys, other_ids: another sorted int64 NumPy array and its IDs
+
+        Return value: tuple (merged sorted keys, merged IDs)
+    """
+    size = keys.size + other_keys.size
+    other_positions = (np.searchsorted(keys, other_keys, side='right')
+                        + np.arange(other_keys.size))
+    from_other = np.zeros(size, dtype=bool)
+    from_other[other_positions] = True
+    merged_keys = np.empty(size, dtype=np.int64)
+    merged_ids = np.empty(size, dtype=np.int64)
+    merged_keys[other_positions], merged_ids[other_positions] = (
+            other_keys, other_ids
+        )
+    merged_keys[~from_other], merged_ids[~from_other] = keys, ids
+    return merged_keys, merged_ids
+
+class JunctionRegistry(object):
+    """ Maps (chromosome, start, end, strand) to stable junction IDs.
+
+        Compacted junctions are memory-mapped; junctions in the append log
+        are held in memory as sorted runs.
+    """
+
+    def __init__(self, registry_dir, max_log_size=20000000):
+        """
+            registry_dir: registry directory; created if it doesn't exist
+            max_log_size: number of junctions in the append log above
+                which insert() compacts the registry
+        """
+        self.registry_dir = registry_dir
+        self.max_log_size = max_log_size
+        try:
+            os.makedirs(registry_dir)
+        except OSError:
+            if not os.path.isdir(registry_dir):
+                raise
+        self.chroms = []
+        try:
+            with open(self._path('chroms.txt')) as chrom_stream:
+                self.chroms = [line.rstrip('\n') for line in chrom_stream]
+        except IOError:
+            pass
+        self._chrom_to_index = {
+                chrom : i for i, chrom in enumerate(self.chroms)
+            }
+        self._generations = {}
+        try:
+            with open(self._path('base.txt')) as base_stream:
+                for line in base_stream:
+                    chrom_index, generation = map(int, line.split('\t'))
+                    self._generations[chrom_index] = generation
+        except IOError:
+            if any(re.match(r'^\d+\.keys\.npy$', filename)
+                    for filename in os.listdir(registry_dir)):
+                raise RuntimeError(
+                        'Registry {} has arrays without generations; '
+                        'rebuild it.'.format(registry_dir)
+                    )
+        self._base = {}
+        self._size = 0
+        for i, generation in self._generations.items():
+            keys, ids = [
+                    np.load(self._array_path(i, generation, name),
+                            mmap_mode='r')
+                    for name in ['keys', 'ids']
+                ]
+            if keys.shape != ids.shape:
+                raise RuntimeError(
+                        'Keys and IDs of chromosome {} in registry {} have '
+                        'different lengths.'.format(
+                                self.chroms[i], registry_dir
+                            )
+                    )
+            self._base[i] = (keys, ids)
+            if ids.size:
+                self._size = max(self._size, int(ids.max()) + 1)
+        log_file = self._path('append.log')
+        log_size = (os.path.getsize(log_file) if os.path.exists(log_file)
+                        else 0)
+        if log_size % _log_dtype.itemsize:
+            # Drop partial record left by an interrupted write
+            with open(log_file, 'r+b') as log_stream:
+                log_stream.truncate(
+                        log_size - log_size % _log_dtype.itemsize
+                    )
+        self._log = {}
+        self._log_size = 0
+        if log_size:
+            self._add_to_log(np.fromfile(log_file, dtype=_log_dtype))
+
+    def _path(self, filename):
+        return os.path.join(self.registry_dir, filename)
+
+    def _array_path(self, chrom_index, generation, name):
+        """ Return value: path to keys or ids array of a chromosome """
+        return self._path('{}.{}.{}.npy'.format(chrom_index, generation,
+                                                name))
+
+    def _add_to_log(self, records):
+        """ Indexes records from append log in memory
+
+            records: NumPy array of dtype _log_dtype
+
+            No return value.
+        """
+        for chrom_index in np.unique(records['chrom']).tolist():
+            chrom_records = records[records['chrom'] == chrom_index]
+            order = np.argsort(chrom_records['key'], kind='mergesort')
+            runs = self._log.setdefault(chrom_index, [])
+            runs.append((chrom_records['key'][order],
+                            chrom_records['id'][order]))
+            # Merge runs geometrically so each record is merged O(log n)
+            # times and few runs are searched per lookup
+            while len(runs) > 1 and runs[-2][0].size <= 2 * runs[-1][0].size:
+                runs[-2:] = [_merge_sorted(*(runs[-2] + runs[-1]))]
+        self._log_size += records.size
+        if records.size:
+            self._size = max(self._size, int(records['id'].max()) + 1)
+
+    def _sorted_arrays(self, chrom_index):
+        """ Lists sorted key and ID arrays of a chromosome
+
+            chrom_index: index of chromosome
+
+            Return value: list of tuples (sorted keys, IDs): compacted
+                junctions first, then runs of the append log from oldest
+                to newest
+        """
+        return ([self._base[chrom_index]] if chrom_index in self._base
+                    else []) + self._log.get(chrom_index, [])
+
+    def __len__(self):
+        """ Return value: number of IDs assigned """
+        return self._size
+
+    def _lookup_chrom(self, chrom_index, keys):
+        """ Looks up packed keys on one chromosome
+
+            chrom_index: index of chromosome
+            keys: int64 NumPy array of packed keys
+
+            Return value: int64 NumPy array of IDs, -1 where absent
+        """
+        # Searching with sorted keys touches each array in order
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        found = np.full(keys.shape, -1, dtype=np.int64)
+        for sorted_keys, ids in self._sorted_arrays(chrom_index):
+            missing = np.flatnonzero(found == -1)
+            if not missing.size:
+                break
+            found[missing] = _sorted_lookup(sorted_keys, ids, keys[missing])
+        unsorted = np.empty_like(found)
+        unsorted[order] = found
+        return unsorted
+
+    def lookup(self, chroms, starts, ends, strands):
+        """ Looks up IDs of many junctions at once
+
+            chroms: array of chromosome names
+            starts: int array of start positions (1-based, inclusive)
+            ends: int array of end positions (1-based, inclusive)
+            strands: array of strands; '+' or '-'
+
+            Return value: int64 NumPy array of IDs, -1 for junctions not
+                registered
+        """
+        chroms = np.asarray(chroms)
+        starts, ends = np.asarray(starts), np.asarray(ends)
+        strands = np.asarray(strands)
+        found = np.full(chroms.shape, -1, dtype=np.int64)
+        for chrom, on_chrom in _group_by_chrom(chroms):
+            if chrom not in self._chrom_to_index:
+                continue
+            found[on_chrom] = self._lookup_chrom(
+                    self._chrom_to_index[chrom],
+                    pack_keys(starts[on_chrom], ends[on_chrom],
+                              strands[on_chrom])
+                )
+        return found
+
+    def insert(self, chroms, starts, ends, strands):
+        """ Registers many junctions at once
+
+            Junctions not yet registered get new IDs in order of first
+            appearance, so registering a sorted junction file numbers its new
+            junctions in sorted order.
+
+            chroms: array of chromosome names
+            starts: int array of start positions (1-based, inclusive)
+            ends: int array of end positions (1-based, inclusive)
+            strands: array of strands; '+' or '-'
+
+            Return value: int64 NumPy array of IDs of all junctions
+        """
+        chroms = np.asarray(chroms)
+        starts, ends = np.asarray(starts), np.asarray(ends)
+        strands = np.asarray(strands)
+        groups = _group_by_chrom(chroms)
+        for chrom, _ in groups:
+            if chrom not in self._chrom_to_index:
+                if len(self.chroms) >= np.iinfo(np.uint16).max:
+                    raise RuntimeError('Too many chromosomes in registry.')
+                with open(self._path('chroms.txt'), 'a') as chrom_stream:
+                    print >>chrom_stream, chrom
+                self._chrom_to_index[chrom] = len(self.chroms)
+                self.chroms.append(chrom)
+        found = np.full(chroms.shape, -1, dtype=np.int64)
+        # Junctions absent from registry, deduplicated on each chromosome
+        new_positions, new_keys, new_chroms, assignments = [], [], [], []
+        new_count = 0
+        for chrom, on_chrom in groups:
+            chrom_index = self._chrom_to_index[chrom]
+            keys = pack_keys(starts[on_chrom], ends[on_chrom],
+                                strands[on_chrom])
+            chrom_found = self._lookup_chrom(chrom_index, keys)
+            found[on_chrom] = chrom_found
+            missing = np.flatnonzero(chrom_found == -1)
+            if not missing.size:
+                continue
+            distinct_keys, first, inverse = np.unique(
+                    keys[missing], return_index=True, return_inverse=True
+                )
+            new_positions.append(on_chrom[missing[first]])
+            new_keys.append(distinct_keys)
+            new_chroms.append(
+                    np.full(distinct_keys.size, chrom_index, dtype=np.uint16)
+                )
+            assignments.append((on_chrom[missing], new_count + inverse))
+            new_count += distinct_keys.size
+        if not new_count:
+            return found
+        # New IDs follow order of first appearance in input
+        order = np.argsort(np.concatenate(new_positions), kind='mergesort')
+        new_ids = np.empty(new_count, dtype=np.int64)
+        new_ids[order] = np.arange(self._size, self._size + new_count)
+        for positions, indexes in assignments:
+            found[positions] = new_ids[indexes]
+        records = np.empty(new_count, dtype=_log_dtype)
+        records['chrom'] = np.concatenate(new_chroms)[order]
+        records['key'] = np.concatenate(new_keys)[order]
+        records['id'] = new_ids[order]
+        with open(self._path('append.log'), 'ab') as log_stream:
+            records.tofile(log_stream)
+        self._add_to_log(records)
+        if self._log_size > self.max_log_size:
+            self.compact()
+        return found
+
+    def compact(self):
+        """ Merges append log into sorted per-chromosome arrays
+
+            Arrays are written under a new generation, which replaces the
+            old one when base.txt is renamed into place.
+
+            No return value.
+        """
+        generation = max(self._generations.values() or [-1]) + 1
+        generations = dict(self._generations)
+        base = dict(self._base)
+        for chrom_index in self._log:
+            arrays = self._sorted_arrays(chrom_index)
+            keys = np.concatenate([keys for keys, _ in arrays])
+            ids = np.concatenate([ids for _, ids in arrays])
+            # A log left over from an interrupted compaction can repeat keys
+            keys, first = np.unique(keys, return_index=True)
+            ids = ids[first]
+            for name, array in [('keys', keys), ('ids', ids)]:
+                with open(self._array_path(chrom_index, generation, name),
+                            'wb') as array_stream:
+                    np.save(array_stream, array)
+                    array_stream.flush()
+                    os.fsync(array_stream.fileno())
+            generations[chrom_index] = generation
+            base[chrom_index] = tuple(
+                    np.load(self._array_path(chrom_index, generation, name),
+                            mmap_mode='r')
+                    for name in ['keys', 'ids']
+                )
+        base_file = self._path('base.txt')
+        with open(base_file + '.partial', 'w') as base_stream:
+            for chrom_index in sorted(generations):
+                print >>base_stream, '{}\t{}'.format(
+                        chrom_index, generations[chrom_index]
+                    )
+            base_stream.flush()
+            os.fsync(base_stream.fileno())
+        # The new generation takes effect here, all at once
+        os.rename(base_file + '.partial', base_file)
+        self._generations, self._base = generations, base
+        with open(self._path('append.log'), 'wb'):
+            pass
+        self._log = {}
+        self._log_size = 0
+        # Remove arrays of old generations and of interrupted compactions
+        current = set(
+                os.path.basename(self._array_path(chrom_index, generation,
+                                                    name))
+                for chrom_index, generation in generations.items()
+                for name in ['keys', 'ids']
+            )
+        for filename in os.listdir(self.registry_dir):
+            if _array_file.match(filename) and filename not in current:
+                os.remove(self._path(filename))
+
+    def junctions(self):
+        """ Lists all registered junctions in order of ID
+
+            Return value: tuple (indexes into self.chroms of chromosomes,
+                start positions, end positions, strands) of NumPy arrays,
+                each indexed by junction ID
+        """
+        chrom_indexes = np.zeros(self._size, dtype=np.uint16)
+        keys = np.zeros(self._size, dtype=np.int64)
+        for chrom_index in set(self._base) | set(self._log):
+            for chrom_keys, ids in self._sorted_arrays(chrom_index):
+                chrom_indexes[ids] = chrom_index
+                keys[ids] = chrom_keys
+        return (chrom_indexes,) + unpack_keys(keys)
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--registry', type=str, required=True,
+            help='registry directory; created if it doesn\'t already exist'
+        )
+    parser.add_argument('--junctions', type=str, nargs='+', required=False,
+            default=[],
+            help='gzipped junction files whose junctions should be registered'
+        )
+    parser.add_argument('--batch-size', type=int, required=False,
+            default=1000000,
+            help='number of junctions to register at once'
+        )
+    parser.add_argument('--compact', action='store_const', const=True,
+            default=False,
+            help='merge append log into sorted arrays when done'
+        )
+    args = parser.parse_args()
+    registry = JunctionRegistry(args.registry)
+    for junction_file in args.junctions:
+        with gzip.open(junction_file) as junction_stream:
+            batch = []
+            for line in junction_stream:
+                batch.append(line.split('\t', 4)[:4])
+                if len(batch) >= args.batch_size:
+                    registry.insert(*zip(*batch))
+                    batch = []
+            if batch:
+                registry.insert(*zip(*batch))
+        print >>sys.stderr, '{} junctions registered after {}.'.format(
+                len(registry), junction_file
+            )
+    if args.compact:
+        registry.compact()
@@ -25,7 +25,8 @@ A) A BED file assigning IDs to junctions. Columns are:
   1. chromosome
   2. start position (1-based, inclusive)
   3. end position (1-based, inclusive)
-  4. ID (integer) -- this is the same across all projects
+  4. ID (integer) -- this is the same across all projects, and if
+      --registry is specified, across releases
   5. the number 1000 (this is the score, and here just says use a dark color
                       in the UCSC genome browser)
   6. strand (+ or -)
@@ -35,17 +36,39 @@ B) A TSV file mapping junction IDs to sample IDs and their corresponding
   2. comma-separated list of IDs of samples in which junction is found
   3. comma-separated list of corresponding numbers of reads found to map across
       junction
+
+With --format sparse, the BED and TSV files are replaced by:
+A) junctions.npy, a table of all junctions indexed by junction ID with fields
+  chrom (index into chromosomes listed in junction_chroms.txt), start, end,
+  and strand
+B) for each project, a directory [project].junction_coverage containing a
+  compressed sparse column (CSC) junction x sample coverage matrix as
+  indptr.npy, indices.npy, and data.npy, along with junction_ids.npy and
+  sample_ids.npy giving the junction ID of each row and sample ID of each
+  column
+load_project() memory-maps a project's matrix, and load_junctions() the
+junction table.
+
+Both junction files must already be sorted by chromosome (bytewise), start
+position, and end position, as with LC_ALL=C sort -k1,1 -k2,2n -k3,3n. They
+are merged as they are read, and all projects' files are written in a single
+pass over the junctions; appends are buffered per project, and a bounded pool
+of file handles is kept open.
 """
 import os
 import gzip
+import glob
 import tempfile
-import subprocess
-import itertools
-from collections import defaultdict
 import shutil
 import atexit
+from array import array
+import heapq
+import itertools
+from collections import defaultdict, OrderedDict
 
 _gtex_project_id = 'SRP012682'
+_junction_dtype = [('chrom', '<u2'), ('start', '<u4'), ('end', '<u4'),
+                    ('strand', 'S1')]
 
 def stream_to_tokens(input_stream):
     """ Converts newline-separated TSV input stream into token generator
@@ -57,6 +80,352 @@ def stream_to_tokens(input_stream):
     for line in input_stream:
         yield line.strip().split('\t')
 
+def tagged_junctions(junction_file, tag):
+    """ Reads a sorted junction file, checking that it is sorted
+
+        junction_file: path to gzipped junction file sorted by chromosome
+            (bytewise), start position, end position, and strand
+        tag: tag to attach to each junction
+
+        Yield value: tuple ((chromosome, start position, end position,
+            strand), tag, tab-separated tokens from line)
+    """
+    last_key = None
+    with gzip.open(junction_file) as junction_stream:
+        for tokens in stream_to_tokens(junction_stream):
+            key = (tokens[0], int(tokens[1]), int(tokens[2]), tokens[3])
+            if last_key is not None and key < last_key:
+                raise RuntimeError(
+                        ('Junction file "{}" is not sorted; sort it with '
+                         'LC_ALL=C sort -k1,1 -k2,2n -k3,3n -k4,4.').format(
+                                junction_file
+                            )
+                    )
+            last_key = key
+            yield key, tag, tokens
+
+def grouped_junctions(gtex_junctions, sra_junctions):
+    """ Merges sorted GTEx and SRA junction files in a single stream
+
+        gtex_junctions: path to gzipped, sorted GTEx junction file
+        sra_junctions: path to gzipped, sorted SRA junction file
+
+        Yield value: tuple (first six tokens identifying junction, list
+            of tuples (source, tokens), where source is 'g' for GTEx and 's'
+            for SRA, and tokens are the tab-separated tokens of a line
+            from that source)
+    """
+    for key, group in itertools.groupby(
+                            heapq.merge(
+                                tagged_junctions(gtex_junctions, 'g'),
+                                tagged_junctions(sra_junctions, 's')
+                            ), lambda x: x[2][:6]
+                        ):
+        yield key, [(tag, tokens) for _, tag, tokens in group]
+
+def numbered_junctions(grouped, registry=None, batch_size=100000):
+    """ Assigns IDs to grouped junctions
+
+        grouped: iterable of (first six tokens identifying junction, group)
+            tuples as yielded by grouped_junctions()
+        registry: JunctionRegistry from junction_registry.py from which to
+            take IDs, registering junctions not yet in it; if None, junctions
+            are numbered in order starting at 0
+        batch_size: number of junctions to look up in registry at once
+
+        Yield value: tuple (junction ID, first six tokens identifying
+            junction, group)
+    """
+    if registry is None:
+        for junction_id, (key, group) in enumerate(grouped):
+            yield junction_id, key, group
+        return
+    while True:
+        batch = list(itertools.islice(grouped, batch_size))
+        if not batch:
+            break
+        junction_ids = registry.insert(
+                *zip(*[key[:4] for key, _ in batch])
+            ).tolist()
+        for junction_id, (key, group) in itertools.izip(junction_ids, batch):
+            yield junction_id, key, group
+
+class ProjectWriterPool(object):
+    """ Buffers appends to many per-project files with few open handles
+
+        Lines are buffered in memory per file. A file's buffer is written when
+        it exceeds max_file_buffer bytes, and the largest buffers are written
+        when all buffers together exceed max_buffer bytes. At most
+        max_open_files handles are kept open; the least recently used is
+        closed to make room for another, and reopened later for appending.
+        Any number of projects can thus be written in a single pass.
+    """
+
+    def __init__(self, output_dir, max_open_files=1000,
+                    max_buffer=1000000000, max_file_buffer=1000000):
+        """
+            output_dir: directory in which to write files
+            max_open_files: maximum number of file handles to keep open
+            max_buffer: maximum number of bytes to buffer across all files
+            max_file_buffer: maximum number of bytes to buffer per file
+        """
+        self.output_dir = output_dir
+        self.max_open_files = max_open_files
+        self.max_buffer = max_buffer
+        self.max_file_buffer = max_file_buffer
+        self._handles = OrderedDict()
+        self._buffers = defaultdict(list)
+        self._buffer_sizes = defaultdict(int)
+        self._buffered = 0
+        self._created = set()
+
+    def write(self, filename, line):
+        """ Appends a line to a file in output_dir
+
+            filename: basename of file
+            line: line to append, without newline character
+
+            No return value.
+        """
+        self._buffers[filename].append(line)
+        size = len(line) + 1
+        self._buffer_sizes[filename] += size
+        self._buffered += size
+        if self._buffer_sizes[filename] > self.max_file_buffer:
+            self._flush(filename)
+        if self._buffered > self.max_buffer:
+            for filename in sorted(self._buffer_sizes,
+                                    key=self._buffer_sizes.get,
+                                    reverse=True):
+                self._flush(filename)
+                if self._buffered <= self.max_buffer // 2:
+                    break
+
+    def _flush(self, filename):
+        """ Writes a file's buffer to disk
+
+            filename: basename of file
+
+            No return value.
+        """
+        if filename not in self._buffers:
+            return
+        try:
+            handle = self._handles.pop(filename)
+        except KeyError:
+            if len(self._handles) >= self.max_open_files:
+                self._handles.popitem(last=False)[1].close()
+            handle = open(
+                    os.path.join(self.output_dir, filename),
+                    'a' if filename in self._created else 'w'
+                )
+            self._created.add(filename)
+        # Most recently used handle goes last
+        self._handles[filename] = handle
+        handle.write('\n'.join(self._buffers.pop(filename)) + '\n')
+        self._buffered -= self._buffer_sizes.pop(filename)
+
+    def close(self):
+        """ Writes all buffers and closes all handles """
+        try:
+            for filename in self._buffers.keys():
+                self._flush(filename)
+        finally:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles.clear()
+
+def write_junction_table(output_dir, chroms, chrom_indexes, starts, ends,
+                            strands):
+    """ Writes table of all junctions indexed by junction ID
+
+        output_dir: directory in which to write junctions.npy and
+            junction_chroms.txt
+        chroms: list of chromosome names
+        chrom_indexes: indexes into chroms, one per junction
+        starts: start positions (1-based, inclusive)
+        ends: end positions (1-based, inclusive)
+        strands: strands ('+' or '-')
+
+        Each of chrom_indexes, starts, ends, and strands is an array.array
+        or a NumPy array.
+
+        No return value.
+    """
+    import numpy as np
+
+    def as_array(values, dtype):
+        if isinstance(values, array):
+            return np.frombuffer(values, dtype=dtype)
+        return np.asarray(values, dtype=dtype)
+
+    table = np.lib.format.open_memmap(
+            os.path.join(output_dir, 'junctions.npy'), mode='w+',
+            dtype=_junction_dtype, shape=(len(starts),)
+        )
+    table['chrom'] = as_array(chrom_indexes, np.uint16)
+    table['start'] = as_array(starts, np.uint32)
+    table['end'] = as_array(ends, np.uint32)
+    table['strand'] = as_array(strands, 'S1')
+    table.flush()
+    del table
+    with open(
+            os.path.join(output_dir, 'junction_chroms.txt'), 'w'
+        ) as chrom_stream:
+        for chrom in chroms:
+            print >>chrom_stream, chrom
+
+def coverage_to_csc(coverage_file, project_dir, sample_count,
+                        chunk_lines=100000):
+    """ Converts a project's junction coverage TSV to a CSC matrix on disk
+
+        Rows of the matrix are the project's junctions in the order of
+        coverage_file's lines, which is the order of the sorted input
+        junctions, and junction_ids.npy gives each row's junction ID. Without
+        --registry, IDs are assigned in that order, so they increase down the
+        rows; with --registry, they are the registry's IDs, which follow the
+        order in which junctions were first registered across all runs, so
+        they need not be sorted. Columns are the project's samples in order
+        of sample ID. The file is read twice: once to count nonzero entries
+        per sample and once to fill arrays memory-mapped from project_dir,
+        so memory use does not grow with the size of the project.
+
+        coverage_file: junction coverage TSV as described in this file's
+            docstring
+        project_dir: directory in which to write junction_ids.npy,
+            sample_ids.npy, indptr.npy, indices.npy, and data.npy
+        sample_count: number of samples across all projects
+        chunk_lines: number of lines to decode at once
+
+        No return value.
+    """
+    import numpy as np
+
+    def chunks():
+        """ Yields (junction IDs, per-line sample counts, samples,
+            coverages) arrays for chunk_lines lines at a time """
+        with open(coverage_file) as coverage_stream:
+            while True:
+                lines = [line.rstrip('\n').split('\t') for line in
+                            itertools.islice(coverage_stream, chunk_lines)]
+                if not lines:
+                    break
+                junction_ids, samples, coverages = zip(*lines)
+                yield (np.array(junction_ids, dtype=np.int64),
+                        np.fromiter((sample_list.count(',') + 1
+                                        for sample_list in samples),
+                                    dtype=np.int64, count=len(samples)),
+                        np.fromstring(
+                            ','.join(samples), dtype=np.int64, sep=','
+                        ),
+                        np.fromstring(
+                            ','.join(coverages), dtype=np.int64, sep=','
+                        ))
+
+    try:
+        os.makedirs(project_dir)
+    except OSError:
+        if not os.path.isdir(project_dir):
+            raise
+    column_counts = np.zeros(sample_count, dtype=np.int64)
+    junction_ids = []
+    for chunk_junction_ids, _, samples, _ in chunks():
+        junction_ids.append(chunk_junction_ids)
+        column_counts += np.bincount(samples, minlength=sample_count)
+    junction_ids = (np.concatenate(junction_ids) if junction_ids
+                        else np.zeros(0, dtype=np.int64))
+    sample_ids = np.flatnonzero(column_counts)
+    columns = np.full(sample_count, -1, dtype=np.int64)
+    columns[sample_ids] = np.arange(sample_ids.size)
+    nonzero_count = int(column_counts.sum())
+    index_dtype = np.int32 if nonzero_count < 2**31 else np.int64
+    np.save(os.path.join(project_dir, 'junction_ids.npy'), junction_ids)
+    np.save(os.path.join(project_dir, 'sample_ids.npy'), sample_ids)
+    indptr = np.zeros(sample_ids.size + 1, dtype=index_dtype)
+    np.cumsum(column_counts[sample_ids], out=indptr[1:])
+    np.save(os.path.join(project_dir, 'indptr.npy'), indptr)
+    indices = np.lib.format.open_memmap(
+            os.path.join(project_dir, 'indices.npy'), mode='w+',
+            dtype=index_dtype, shape=(nonzero_count,)
+        )
+    data = np.lib.format.open_memmap(
+            os.path.join(project_dir, 'data.npy'), mode='w+',
+            dtype=np.int32, shape=(nonzero_count,)
+        )
+    # Next free slot in each column; rows arrive in increasing order, so
+    # every column's row indices come out sorted
+    cursors = indptr[:-1].astype(np.int64)
+    first_row = 0
+    for chunk_junction_ids, per_line, samples, coverages in chunks():
+        rows = np.repeat(
+                np.arange(first_row, first_row + chunk_junction_ids.size),
+                per_line
+            )
+        first_row += chunk_junction_ids.size
+        chunk_columns = columns[samples]
+        order = np.argsort(chunk_columns, kind='mergesort')
+        sorted_columns = chunk_columns[order]
+        group_starts = np.flatnonzero(np.concatenate(
+                ([True], sorted_columns[1:] != sorted_columns[:-1])
+            ))
+        group_sizes = np.diff(np.append(group_starts, sorted_columns.size))
+        ranks = np.arange(sorted_columns.size) - np.repeat(
+                group_starts, group_sizes
+            )
+        slots = cursors[sorted_columns] + ranks
+        indices[slots] = rows[order]
+        data[slots] = coverages[order]
+        cursors[sorted_columns[group_starts]] += group_sizes
+    indices.flush()
+    data.flush()
+
+def load_junctions(output_dir):
+    """ Memory-maps table of all junctions written with --format sparse
+
+        output_dir: --output-dir of junctions_by_project.py
+
+        Return value: tuple (list of chromosome names, NumPy memmap of
+            records with fields chrom (index into list of chromosome names),
+            start, end, and strand, indexed by junction ID)
+    """
+    import numpy as np
+    with open(
+            os.path.join(output_dir, 'junction_chroms.txt')
+        ) as chrom_stream:
+        chroms = [line.strip() for line in chrom_stream]
+    return chroms, np.load(os.path.join(output_dir, 'junctions.npy'),
+                            mmap_mode='r')
+
+def load_project(srp, output_dir):
+    """ Memory-maps a project's junction x sample coverage matrix
+
+        Requires SciPy.
+
+        srp: project accession number, e.g. SRP012682 for GTEx
+        output_dir: --output-dir of junctions_by_project.py run with
+            --format sparse
+
+        Return value: tuple (array of global junction IDs, one per row;
+            array of sample IDs as in sample_ids.tsv, one per column;
+            scipy.sparse.csc_matrix of coverages)
+    """
+    import numpy as np
+    import scipy.sparse
+    project_dir = os.path.join(output_dir, srp + '.junction_coverage')
+    arrays = {
+            name : np.load(os.path.join(project_dir, name + '.npy'),
+                            mmap_mode='r')
+            for name in ['junction_ids', 'sample_ids', 'indptr', 'indices',
+                            'data']
+        }
+    return arrays['junction_ids'], arrays['sample_ids'], (
+            scipy.sparse.csc_matrix(
+                (arrays['data'], arrays['indices'], arrays['indptr']),
+                shape=(arrays['junction_ids'].size, arrays['sample_ids'].size),
+                copy=False
+            )
+        )
+
 if __name__ == '__main__':
     import argparse
     # Print file's docstring if -h is invoked
@@ -81,14 +450,31 @@ if __name__ == '__main__':
             help=('directory in which to dump all output files; created if '
                   'it doesn\'t already exist')
         )
-    parser.add_argument('--temp-dir', type=str, required=False,
+    parser.add_argument('--max-open-files', type=int, required=False,
+            default=1000,
+            help='maximum number of output file handles to keep open'
+        )
+    parser.add_argument('--buffer-size', type=int, required=False,
+            default=1000000000,
+            help=('maximum number of bytes of output to buffer in memory '
+                  'across all projects')
+        )
+    parser.add_argument('--format', type=str, required=False,
+            default='text', choices=['text', 'sparse'],
+            help=('text writes BED and TSV files per project; sparse writes '
+                  'a global junction table and a CSC matrix per project')
+        )
+    parser.add_argument('--registry', type=str, required=False,
             default=None,
-            help=('where to store temporary files; None if Python should '
-                  'decide')
+            help=('junction registry directory from junction_registry.py; '
+                  'if specified, junction IDs are taken from it, and new '
+                  'junctions are registered, so IDs are stable across '
+                  'releases. Otherwise, junctions are numbered in order')
         )
-    parser.add_argument('--projects-per-batch', type=int, required=False,
-            default=500,
-            help='1/2 maximum number of open file handles'
+    parser.add_argument('--temp-dir', type=str, required=False,
+            default=None,
+            help=('where to store temporary files when --format is sparse; '
+                  'None if Python should decide')
         )
     args = parser.parse_args()
 
@@ -98,46 +484,12 @@ if __name__ == '__main__':
     except OSError as e:
         if os.path.isdir(args.output_dir): pass
 
-    temp_dir = tempfile.mkdtemp(dir=args.temp_dir)
-    atexit.register(shutil.rmtree, temp_dir)
-    merged_junctions = os.path.join(temp_dir, 'merged_junctions.tsv')
-    merged_sorted_junctions = os.path.join(temp_dir,
-                                            'merged_sorted_junctions.tsv')
-    subprocess.check_output(
-        'gzip -cd {} | awk \'{{print $0 "\\tg"}}\' >>{}'.format(
-                                                    args.gtex_junctions,
-                                                    merged_junctions
-                                                ),
-                                executable='/bin/bash',
-                                shell=True)
-    subprocess.check_output(
-        'gzip -cd {} | awk \'{{print $0 "\\ts"}}\' >>{}'.format(
-                                                    args.sra_junctions,
-                                                    merged_junctions
-                                                ),
-                                executable='/bin/bash',
-                                shell=True)
-    subprocess.check_output('sort {}-k1,1 -k2,2n -k3,3n {} >{}'.format(
-                                                    '-T %s ' % args.temp_dir
-                                                    if args.temp_dir
-                                                    is not None else '', 
-                                                    merged_junctions,
-                                                    merged_sorted_junctions
-                                                ),
-                                executable='/bin/bash',
-                                shell=True
-        )
-
     '''Map SRA sample numbers to projects; note GTEx project number is always
     SRP012682, so we don't need to do the same thing for GTEx'''
     with open(args.sra_ids) as id_stream:
         id_to_srp = { tokens[0] : tokens[1] for tokens in
                         (line.strip().split('\t') for line in id_stream) }
 
-    srps = id_to_srp.values()
-    srp_batches = [srps[i:i+args.projects_per_batch]
-                    for i in xrange(0, len(srps), args.projects_per_batch)]
-    srp_batches[-1].append(_gtex_project_id)
     score = '1000'
 
     # Number by which to increment every GTEx sample id
@@ -160,135 +512,118 @@ if __name__ == '__main__':
                         [str(int(tokens[0]) + translation), _gtex_project_id,
                             tokens[1]]
                     )
-    for srp_batch in srp_batches:
-        # For storing file handles
-        project_bed_handles = {}
-        project_coverage_handles = {}
-        junction_id = 0
-        try:
-            srp_batch_set = set(srp_batch)
-            with open(merged_sorted_junctions) as merged_stream:
-                for key, group in itertools.groupby(
-                                    stream_to_tokens(merged_stream),
-                                    lambda x: x[:6]
-                                ):
-                    junction_id_string = str(junction_id)
-                    junction = '\t'.join(
-                            [key[0], key[1], key[2],
-                                junction_id_string, score, key[3]]
+    sparse = args.format == 'sparse'
+    if sparse:
+        # Coverage TSVs are intermediates converted to matrices at the end
+        coverage_dir = tempfile.mkdtemp(dir=args.temp_dir)
+        atexit.register(shutil.rmtree, coverage_dir)
+        chroms, chrom_to_index = [], {}
+        (chrom_indexes, starts, ends,
+            strands) = array('H'), array('I'), array('I'), array('c')
+    else:
+        coverage_dir = args.output_dir
+    writers = ProjectWriterPool(
+            coverage_dir, max_open_files=args.max_open_files,
+            max_buffer=args.buffer_size
+        )
+    if args.registry is not None:
+        from junction_registry import JunctionRegistry
+        registry = JunctionRegistry(args.registry)
+    else:
+        registry = None
+    try:
+        for junction_id, key, group in numbered_junctions(
+                    grouped_junctions(args.gtex_junctions,
+                                      args.sra_junctions),
+                    registry
+                ):
+            junction_id_string = str(junction_id)
+            if sparse and registry is None:
+                try:
+                    chrom_indexes.append(chrom_to_index[key[0]])
+                except KeyError:
+                    chrom_to_index[key[0]] = len(chroms)
+                    chroms.append(key[0])
+                    chrom_indexes.append(chrom_to_index[key[0]])
+                starts.append(int(key[1]))
+                ends.append(int(key[2]))
+                strands.append(key[3])
+            junction = '\t'.join(
+                    [key[0], key[1], key[2],
+                        junction_id_string, score, key[3]]
+                )
+            for source, tokens in group:
+                if source == 'g':
+                    if not sparse:
+                        writers.write(
+                                _gtex_project_id + '.junction_id.bed',
+                                junction
+                            )
+                    current_samples = [
+                                str(int(token) + translation)
+                                for token in tokens[6].split(',')
+                            ]
+                    writers.write(
+                            _gtex_project_id + '.junction_coverage.tsv',
+                            '\t'.join(
+                                    [junction_id_string,
+                                        ','.join(current_samples),
+                                        tokens[7]]
+                                )
                         )
-                    for tokens in group:
-                        if tokens[-1] == 'g':
-                            if _gtex_project_id not in srp_batch_set: continue
-                            try:
-                                print >>project_bed_handles[
-                                                _gtex_project_id
-                                            ], junction
-                            except KeyError:
-                                project_bed_handles[
-                                        _gtex_project_id
-                                    ] = open(
-                                        os.path.join(
-                                                args.output_dir,
-                                                _gtex_project_id
-                                                + '.junction_id.bed'
-                                            ), 'w'
-                                    )
-                                print >>project_bed_handles[
-                                                    _gtex_project_id
-                                                ], junction
-                            current_samples = [
-                                        str(int(token) + translation)
-                                        for token in tokens[-3].split(',')
-                                    ]
-                            try:
-                                print >>project_coverage_handles[
-                                        _gtex_project_id
-                                    ], '\t'.join(
-                                            [junction_id_string,
-                                                ','.join(current_samples),
-                                                tokens[-2]]
-                                        )
-                            except KeyError:
-                                project_coverage_handles[
-                                            _gtex_project_id
-                                        ] = open(os.path.join(
-                                                    args.output_dir,
-                                                    _gtex_project_id
-                                                + '.junction_coverage.tsv'
-                                            ), 'w'
-                                        )
-                                print >>project_coverage_handles[
-                                        _gtex_project_id
-                                    ], '\t'.join(
-                                            [junction_id_string,
-                                                ','.join(current_samples),
-                                                tokens[-2]]
-                                        )
-                        else:
-                            # SRA
-                            project_to_samples = defaultdict(list)
-                            project_to_coverages = defaultdict(list)
-                            for sample, coverage in zip(tokens[-3].split(','),
-                                                        tokens[-2].split(',')):
-                                project_to_samples[id_to_srp[sample]].append(
-                                        sample
-                                    )
-                                project_to_coverages[id_to_srp[sample]].append(
-                                        coverage
-                                    )
-                            for project in project_to_samples:
-                                if project not in srp_batch_set: continue
-                                try:
-                                    print >>project_bed_handles[project], (
-                                            junction
-                                        )
-                                except KeyError:
-                                    project_bed_handles[project] = open(
-                                            os.path.join(
-                                                args.output_dir,
-                                                project + '.junction_id.bed'
-                                            ), 'w'
-                                        )
-                                    print >>project_bed_handles[project], (
-                                            junction
-                                        )
-                                try:
-                                    print >>project_coverage_handles[
-                                            project
-                                        ], '\t'.join(
-                                             [junction_id_string,
-                                                ','.join(
-                                                    project_to_samples[project]
-                                                ),
-                                                ','.join(
-                                                project_to_coverages[project]
-                                            )]
-                                        )
-                                except KeyError:
-                                    project_coverage_handles[
-                                                project
-                                            ] = open(
-                                                os.path.join(
-                                                    args.output_dir,
-                                                    project
-                                                + '.junction_coverage.tsv'
-                                            ), 'w'
-                                        )
-                                    print >>project_coverage_handles[
-                                            project
-                                        ], '\t'.join(
-                                             [junction_id_string,
-                                                ','.join(
-                                                    project_to_samples[project]
-                                                ),
-                                                ','.join(
-                                                project_to_coverages[project]
-                                            )]
-                                        )
-                    junction_id += 1
-        finally:
-            for project in project_bed_handles:
-                project_bed_handles[project].close()
-            for project in project_coverage_handles:
-                project_coverage_handles[project].close()
+                else:
+                    # SRA
+                    project_to_samples = defaultdict(list)
+                    project_to_coverages = defaultdict(list)
+                    for sample, coverage in zip(tokens[6].split(','),
+                                                tokens[7].split(',')):
+                        project_to_samples[id_to_srp[sample]].append(
+                                sample
+                            )
+                        project_to_coverages[id_to_srp[sample]].append(
+                                coverage
+                            )
+                    for project in project_to_samples:
+                        if not sparse:
+                            writers.write(project + '.junction_id.bed',
+                                            junction)
+                        writers.write(
+                                project + '.junction_coverage.tsv',
+                                '\t'.join(
+                                    [junction_id_string,
+                                        ','.join(
+                                            project_to_samples[project]
+                                        ),
+                                        ','.join(
+                                            project_to_coverages[project]
+                                        )]
+                                )
+                            )
+    finally:
+        writers.close()
+    if sparse:
+        if registry is not None:
+            # IDs index the whole registry, not just these junctions
+            chroms = registry.chroms
+            chrom_indexes, starts, ends, strands = registry.junctions()
+        write_junction_table(args.output_dir, chroms, chrom_indexes, starts,
+                                ends, strands)
+        with open(
+                os.path.join(args.output_dir, 'sample_ids.tsv')
+            ) as sample_id_stream:
+            sample_count = max(
+                    int(line.partition('\t')[0])
+                    for line in sample_id_stream
+                ) + 1
+        for coverage_file in glob.glob(
+                    os.path.join(coverage_dir, '*.junction_coverage.tsv')
+                ):
+            coverage_to_csc(
+                    coverage_file,
+                    os.path.join(
+                        args.output_dir,
+                        os.path.basename(coverage_file)[:-len('.tsv')]
+                    ),
+                    sample_count
+                )
+            os.remove(coverage_file)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+"""
+sample_index.py
+
+Builds and reads an inverted index of a junctions file such as the output of
+combine_sra.py (intropolis.v2.hg38.tsv.gz), giving each sample's junctions
+and their coverages without a scan of the junctions file. Files with NA in
+the sample index or coverage fields, like combine_studies.py output, are
+rejected.
+
+A junction's row ID is its 0-based line number in the junctions file. The
+index is the transpose of the junction x sample coverage matrix in CSR form,
+so each sample's row IDs are sorted. It is a directory containing:
+
+indptr.npy
+int64 array of length (number of samples + 1); sample i's entries are at
+positions indptr[i] through indptr[i+1] - 1 of junction_ids.npy and
+coverages.npy
+
+junction_ids.npy, coverages.npy
+uint32 arrays of row IDs and coverages
+
+junctions.npy, junction_chroms.txt
+Table of junctions indexed by row ID in the format written by
+junctions_by_project.py --format sparse: records with fields chrom (index
+into junction_chroms.txt, one chromosome per line), start, end, and strand
+
+All arrays are memory-mapped when read, so fetching a sample's junctions
+touches only its slice of the index.
+
+Run with --build to build an index, which reads the junctions file twice:
+once to count each sample's junctions and write the junction table, and
+once to fill the index. Otherwise, the junctions of the samples specified
+by --samples are written to stdout as tab-separated lines with fields
+
+1. sample index
+2. run accession number if --idmap is specified, or NA
+3. chromosome
+4. start position (1-based, inclusive)
+5. end position (1-based, inclusive)
+6. strand
+7. coverage
+"""
+import gzip
+import os
+import sys
+import numpy as np
+
+_junction_dtype = [('chrom', '<u2'), ('start', '<u4'), ('end', '<u4'),
+                    ('strand', 'S1')]
+
+def _chunks(junction_file, chunk_pairs):
+    """ Reads a junctions file in chunks
+
+        junction_file: gzipped junctions file
+        chunk_pairs: approximate number of (junction, sample) pairs per
+            chunk
+
+        Yield value: tuple (row ID of first junction in chunk, list of lists
+            of tokens, one per junction)
+    """
+    chunk, pairs, first_row = [], 0, 0
+    with gzip.open(junction_file) as junction_stream:
+        for k, line in enumerate(junction_stream):
+            tokens = line.rstrip('\n').split('\t')
+            chunk.append(tokens)
+            pairs += tokens[6].count(',') + 1
+            if pairs >= chunk_pairs:
+                print >>sys.stderr, (
+                        '\x1b[KRead {} junctions...\r'.format(k + 1)
+                    ),
+                yield first_row, chunk
+                chunk, pairs, first_row = [], 0, k + 1
+    if chunk:
+        yield first_row, chunk
+
+def _decode(chunk):
+    """ Decodes sample indexes and coverages of a chunk of junctions
+
+        chunk: list of lists of tokens, one per junction
+
+        Return value: tuple (NumPy array of number of samples of each
+            junction, NumPy array of sample indexes, NumPy array of
+            coverages); RuntimeError is raised if any value can't be parsed
+    """
+    sample_counts = np.fromiter(
+            (tokens[6].count(',') + 1 for tokens in chunk),
+            dtype=np.int64, count=len(chunk)
+        )
+    samples = np.fromstring(
+            ','.join([tokens[6] for tokens in chunk]), dtype=np.int64,
+            sep=','
+        )
+    coverages = np.fromstring(
+            ','.join([tokens[7] for tokens in chunk]), dtype=np.int64,
+            sep=','
+        )
+    # np.fromstring() stops silently at the first value it can't parse
+    if samples.size != sample_counts.sum() or (
+            coverages.size != samples.size
+        ):
+        raise RuntimeError(
+                'Junctions starting with {}:{}-{} have {} sample indexes and '
+                '{} coverages, but {} were expected; fields 7 and 8 must be '
+                'comma-separated integers.'.format(
+                        chunk[0][0], chunk[0][1], chunk[0][2], samples.size,
+                        coverages.size, sample_counts.sum()
+                    )
+            )
+    return sample_counts, samples, coverages
+
+def build_sample_index(junction_file, index_dir, sample_count,
+                        chunk_pairs=50000000):
+    """ Builds inverted sample -> junction index of a junctions file
+
+        junction_file: gzipped junctions file with chromosome, start, end,
+            and strand as fields 1-4, a comma-separated list of sample
+            indexes as field 7, and a comma-separated list of coverages as
+            field 8
+        index_dir: directory in which to write index; it is created if it
+            does not exist
+        sample_count: number of samples
+        chunk_pairs: approximate number of (junction, sample) pairs to
+            decode at once; each takes about 40 bytes while decoded
+
+        No return value.
+    """
+    try:
+        os.makedirs(index_dir)
+    except OSError:
+        if not os.path.isdir(index_dir):
+            raise
+    # First pass: count each sample's junctions and record coordinates
+    entry_counts = np.zeros(sample_count, dtype=np.int64)
+    chroms, chrom_indexes = [], {}
+    tables = []
+    for _, chunk in _chunks(junction_file, chunk_pairs):
+        table = np.empty(len(chunk), dtype=_junction_dtype)
+        for i, tokens in enumerate(chunk):
+            try:
+                chrom_index = chrom_indexes[tokens[0]]
+            except KeyError:
+                chrom_index = chrom_indexes[tokens[0]] = len(chroms)
+                chroms.append(tokens[0])
+            table[i] = (chrom_index, int(tokens[1]), int(tokens[2]),
+                            tokens[3])
+        tables.append(table)
+        # _decode() raises if any sample index or coverage is unparseable
+        _, samples, _ = _decode(chunk)
+        if samples.size and samples.max() >= sample_count:
+            raise RuntimeError(
+                    'Sample index {} is not less than the number of samples '
+                    '({}).'.format(samples.max(), sample_count)
+                )
+        entry_counts += np.bincount(samples, minlength=sample_count)
+    table = np.concatenate(tables) if tables else np.empty(
+            0, dtype=_junction_dtype
+        )
+    del tables
+    if table.size > np.iinfo(np.uint32).max:
+        raise RuntimeError('Too many junctions for 32-bit row IDs.')
+    np.save(os.path.join(index_dir, 'junctions.npy'), table)
+    del table
+    with open(
+            os.path.join(index_dir, 'junction_chroms.txt'), 'w'
+        ) as chrom_stream:
+        for chrom in chroms:
+            print >>chrom_stream, chrom
+    indptr = np.zeros(sample_count + 1, dtype=np.int64)
+    np.cumsum(entry_counts, out=indptr[1:])
+    np.save(os.path.join(index_dir, 'indptr.npy'), indptr)
+    # Second pass: fill each sample's slice in order of row ID
+    junction_ids = np.lib.format.open_memmap(
+            os.path.join(index_dir, 'junction_ids.npy'), mode='w+',
+            dtype=np.uint32, shape=(indptr[-1],)
+        )
+    coverages = np.lib.format.open_memmap(
+            os.path.join(index_dir, 'coverages.npy'), mode='w+',
+            dtype=np.uint32, shape=(indptr[-1],)
+        )
+    cursors = indptr[:-1].copy()
+    for first_row, chunk in _chunks(junction_file, chunk_pairs):
+        sample_counts, samples, chunk_coverages = _decode(chunk)
+        if chunk_coverages.size and (
+                chunk_coverages.max() > np.iinfo(np.uint32).max
+            ):
+            raise RuntimeError('Coverage does not fit in 32 bits.')
+        rows = np.repeat(
+                np.arange(first_row, first_row + len(chunk), dtype=np.int64),
+                sample_counts
+            )
+        # A stable sort by sample keeps each sample's rows in order
+        order = np.argsort(samples, kind='mergesort')
+        samples = samples[order]
+        starts = np.flatnonzero(
+                np.concatenate(([True], samples[1:] != samples[:-1]))
+            )
+        group_sizes = np.diff(np.append(starts, samples.size))
+        destinations = (
+                np.repeat(cursors[samples[starts]] - starts, group_sizes)
+                + np.arange(samples.size)
+            )
+        junction_ids[destinations] = rows[order]
+        coverages[destinations] = chunk_coverages[order]
+        cursors[samples[starts]] += group_sizes
+    if not np.array_equal(cursors, indptr[1:]):
+        raise RuntimeError(
+                'Junctions file changed while the index was being built.'
+            )
+    junction_ids.flush()
+    coverages.flush()
+
+class SampleIndex(object):
+    """ Read-only view of an index written by build_sample_index(). """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.indptr = np.load(os.path.join(index_dir, 'indptr.npy'))
+        self.junction_ids = np.load(
+                os.path.join(index_dir, 'junction_ids.npy'), mmap_mode='r'
+            )
+        self.coverages = np.load(
+                os.path.join(index_dir, 'coverages.npy'), mmap_mode='r'
+            )
+        self.junctions = np.load(
+                os.path.join(index_dir, 'junctions.npy'), mmap_mode='r'
+            )
+        with open(
+                os.path.join(index_dir, 'junction_chroms.txt')
+            ) as chrom_stream:
+            self.chroms = [line.strip() for line in chrom_stream]
+
+    @property
+    def sample_count(self):
+        return self.indptr.size - 1
+
+    @property
+    def junction_count(self):
+        return self.junctions.size
+
+    def sample(self, sample):
+        """ Fetches a sample's junctions
+
+            sample: sample index
+
+            Return value: tuple (sorted NumPy array of row IDs, NumPy array
+                of coverages); both are memory-mapped views
+        """
+        start, end = self.indptr[sample], self.indptr[sample + 1]
+        return self.junction_ids[start:end], self.coverages[start:end]
+
+    def vectors(self, samples):
+        """ Fetches junction vectors of several samples
+
+            Requires SciPy.
+
+            samples: iterable of sample indexes
+
+            Return value: scipy.sparse.csr_matrix of coverages with one row
+                per sample, in the order given, and one column per junction
+                row ID
+        """
+        import scipy.sparse
+        samples = np.asarray(list(samples), dtype=np.int64)
+        lengths = self.indptr[samples + 1] - self.indptr[samples]
+        indptr = np.zeros(samples.size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=np.int64)
+        data = np.empty(indptr[-1], dtype=np.int64)
+        for i, sample in enumerate(samples):
+            junction_ids, coverages = self.sample(sample)
+            indices[indptr[i]:indptr[i + 1]] = junction_ids
+            data[indptr[i]:indptr[i + 1]] = coverages
+        return scipy.sparse.csr_matrix(
+                (data, indices, indptr),
+                shape=(samples.size, self.junction_count)
+            )
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--index-dir', type=str, required=True,
+            help='directory holding index'
+        )
+    parser.add_argument('--build', action='store_const', const=True,
+            default=False,
+            help='build index from --junctions'
+        )
+    parser.add_argument('--junctions', type=str, required=False,
+            default=None,
+            help=('junctions file to index; this should be '
+                  'intropolis.v2.hg38.tsv.gz')
+        )
+    parser.add_argument('--idmap', type=str, required=False, default=None,
+            help=('map from sample indexes to SRA accession numbers; this '
+                  'should be intropolis.idmap.v2.hg38.tsv. Required to build '
+                  'an index or to specify samples by run accession number')
+        )
+    parser.add_argument('--samples', type=str, required=False, nargs='+',
+            default=[],
+            help='sample indexes or run accession numbers to fetch'
+        )
+    parser.add_argument('--chunk-pairs', type=int, required=False,
+            default=50000000,
+            help=('number of (junction, sample) pairs to decode at once '
+                  'while building index')
+        )
+    args = parser.parse_args()
+    index_to_run = {}
+    if args.idmap is not None:
+        with open(args.idmap) as idmap_stream:
+            for line in idmap_stream:
+                tokens = line.strip().split('\t')
+                index_to_run[int(tokens[0])] = tokens[4]
+    if args.build:
+        if args.junctions is None or not index_to_run:
+            raise RuntimeError(
+                    'Building an index requires --junctions and --idmap.'
+                )
+        build_sample_index(args.junctions, args.index_dir,
+                            max(index_to_run) + 1,
+                            chunk_pairs=args.chunk_pairs)
+        print >>sys.stderr, '\x1b[KDone.'
+        sys.exit(0)
+    run_to_index = {run : index for index, run in index_to_run.items()}
+    index = SampleIndex(args.index_dir)
+    for sample in args.samples:
+        try:
+            sample_index = int(sample)
+        except ValueError:
+            try:
+                sample_index = run_to_index[sample]
+            except KeyError:
+                raise RuntimeError(
+                        'Run {} is not in the id map.'.format(sample)
+                    )
+        if not 0 <= sample_index < index.sample_count:
+            raise RuntimeError(
+                    'Sample index {} is not in the index.'.format(
+                            sample_index
+                        )
+                )
+        junction_ids, coverages = index.sample(sample_index)
+        junctions = index.junctions[junction_ids]
+        run = index_to_run.get(sample_index, 'NA')
+        for junction, coverage in zip(junctions, coverages):
+            print '\t'.join([str(sample_index), run,
+                                index.chroms[junction['chrom']],
+                                str(junction['start']), str(junction['end']),
+                                junction['strand'], str(coverage)])
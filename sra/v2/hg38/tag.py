@@ -7,35 +7,237 @@ variable for each SRA sample accession number: 1 means at least one tag from
 the cluster is present in the sample's metadata, and 0 means no tags from
 the cluster are present. Operates on output of xmlparse.py . Tags are provided
 in header line.
+
+Clusters are read from --clusters (by default, tag_clusters.tsv in this
+directory), so samples can be retagged with new clusters by editing that
+file. All clusters' expressions are compiled into one regular expression,
+with keywords free of metacharacters merged into a trie, so each line is
+scanned once; wherever it matches, each cluster's own expressions are
+checked at that position, so overlapping keywords like "hesc" tag every
+cluster they belong to. With --check, each line's tags are also verified
+against a separate search for each cluster. Chunks of lines are tagged in
+parallel if -p is more than 1.
 """
-import sys
+import itertools
+import multiprocessing
+import os
 import re
+import sys
+
+_tagger = None
+_check = False
+
+def read_clusters(cluster_file):
+    """ Reads keyword clusters
+
+        cluster_file: path to file with one cluster per line: a name
+            followed by tab-separated regular expressions; blank lines and
+            lines starting with # are ignored
+
+        Return value: list of tuples (cluster name, list of regular
+            expressions)
+    """
+    clusters = []
+    with open(cluster_file) as cluster_stream:
+        for line in cluster_stream:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'): continue
+            tokens = line.split('\t')
+            if len(tokens) < 2:
+                raise RuntimeError(
+                        'Cluster "{}" has no expressions.'.format(tokens[0])
+                    )
+            clusters.append((tokens[0], tokens[1:]))
+    return clusters
+
+# Expressions without metacharacters, which are merged into a trie
+_literal = re.compile(r'^[^\\.^$*+?{}\[\]|()]+$')
+
+def trie_regex(words):
+    """ Builds a regular expression matching any of a list of words
+
+        Words sharing a prefix share a branch, so at most one alternative is
+        tried per character of the string being searched.
+
+        words: list of strings
+
+        Return value: regular expression as a string
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+    def branch(node):
+        alternatives = [re.escape(char) + branch(node[char])
+                            for char in sorted(node) if char]
+        if not alternatives:
+            return ''
+        optional = '' in node
+        if len(alternatives) == 1 and not optional:
+            return alternatives[0]
+        pattern = '(?:' + '|'.join(alternatives) + ')'
+        return pattern + '?' if optional else pattern
+    return branch(trie)
+
+class ClusterTagger(object):
+    """ Finds all keyword clusters matching a string in one scan. """
+
+    def __init__(self, clusters):
+        """
+            clusters: list of tuples (cluster name, list of regular
+                expressions) as returned by read_clusters()
+        """
+        self.cluster_regexes = [
+                re.compile('|'.join(expressions))
+                for _, expressions in clusters
+            ]
+        expressions = sorted(set(
+                expression for _, cluster_expressions in clusters
+                for expression in cluster_expressions
+            ))
+        literals = [expression for expression in expressions
+                        if _literal.match(expression)]
+        others = [expression for expression in expressions
+                    if not _literal.match(expression)]
+        combined = '|'.join(([trie_regex(literals)] if literals else [])
+                            + others)
+        # Skip positions where no expression can start when that's known:
+        # only if every expression is a literal, possibly between \bs,
+        # since alternation or quantifiers let a match start elsewhere
+        first_chars = set(literal[0] for literal in literals)
+        for expression in others:
+            if expression.startswith('\\b'):
+                expression = expression[2:]
+            if expression.endswith('\\b') and not expression.endswith(
+                    '\\\\b'
+                ):
+                expression = expression[:-2]
+            if not expression or not _literal.match(expression):
+                first_chars = None
+                break
+            first_chars.add(expression[0])
+        if first_chars:
+            combined = '(?=[{}])(?:{})'.format(
+                    ''.join(re.escape(char) for char in sorted(first_chars)),
+                    combined
+                )
+        self.combined = re.compile(combined)
+
+    def tags(self, string):
+        """ Tags a string
+
+            string: string to tag
+
+            Return value: list with one element per cluster: True if any of
+                its expressions matches string, else False
+        """
+        found = [False] * len(self.cluster_regexes)
+        remaining = len(found)
+        position = 0
+        while remaining:
+            match = self.combined.search(string, position)
+            if match is None:
+                break
+            start = match.start()
+            # Find every cluster with an expression matching here
+            for i, cluster_regex in enumerate(self.cluster_regexes):
+                if not found[i] and cluster_regex.match(string, start):
+                    found[i] = True
+            remaining = found.count(False)
+            position = start + 1
+        return found
+
+    def checked_tags(self, string):
+        """ Tags a string, verifying the result against each cluster's own
+            expressions searched separately
+
+            string: string to tag
+
+            Return value: list as returned by tags()
+        """
+        found = self.tags(string)
+        expected = [cluster_regex.search(string) is not None
+                        for cluster_regex in self.cluster_regexes]
+        if found != expected:
+            raise RuntimeError(
+                    'Combined scan found tags {} but searching each cluster '
+                    'found {} in "{}".'.format(
+                            found, expected, string.rstrip('\n')
+                        )
+                )
+        return found
+
+def _init_tagger(clusters, check=False):
+    """ Compiles clusters in a worker process """
+    global _tagger, _check
+    _tagger = ClusterTagger(clusters)
+    _check = check
+
+def tag_chunk(lines):
+    """ Tags a chunk of lines
+
+        lines: list of lines of xmlparse.py output
+
+        Return value: list of lines prefixed with tab-separated tags, 1 or 0
+            per cluster
+    """
+    tags = _tagger.checked_tags if _check else _tagger.tags
+    return [''.join('1\t' if tag else '0\t'
+                        for tag in tags(line.lower())) + line
+                for line in lines]
+
+def line_chunks(stream, chunk_size):
+    """ Yield value: list of up to chunk_size lines from stream """
+    while True:
+        chunk = list(itertools.islice(stream, chunk_size))
+        if not chunk:
+            break
+        yield chunk
 
 if __name__ == '__main__':
-    # Define tag clusters; each variable is a different cluster of keywords
-    cell_line = set(['line:', 'cellline', 'cell line', 'a549', '\\bt24_',
-                        'geuv', 'hela', 'hesc', 'hepg2', 'hep g2'])
-    small_rna = set(['mirna', 'microrna', 'small rna', '\\bsrna'])
-    single_cell = set(['single-cell', 'single cell'])
-    fetal = set(['fetal', 'fetus'])
-    stem_cell = set(['hesc', 'stem cell' 'stem-cell', 'ipsc', 'pluripotent'])
-    primary = set(['patient', 'subject', 'primary tissue', 'donor'])
-    cancer = set(['tumor', 'cancer', 'oma\\b'])
-    polyA = set(['polya', 'poly-a'])
-    totalrna = set(['total rna', 'ribozero', 'ribo-zero', 'ribominus', 'ribo-minus'])
-    regexps = ['|'.join(cluster) for cluster
-    			in [cell_line, small_rna, single_cell, fetal, stem_cell,
-                    primary, cancer, polyA, totalrna]]
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clusters', type=str, required=False,
+            default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                 'tag_clusters.tsv'),
+            help='file defining keyword clusters'
+        )
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+            default=1,
+            help='maximum number of processes to run simultaneously'
+        )
+    parser.add_argument('--chunk-size', type=int, required=False,
+            default=10000,
+            help='number of lines tagged at once by a process'
+        )
+    parser.add_argument('--check', action='store_const', const=True,
+            default=False,
+            help=('verify tags against a separate search for each cluster; '
+                  'slower')
+        )
+    args = parser.parse_args()
+    clusters = read_clusters(args.clusters)
     original_header = sys.stdin.readline().strip().split('\t')
-    header = ['cell line', 'small rna', 'single cell', 'fetal',
-                'stem cell', 'primary', 'cancer', 'total RNA', 'polyA'
-                ] + original_header
+    header = [name for name, _ in clusters] + original_header
     print '\t'.join(header)
-    for line in sys.stdin:
-    	lower_line = line.lower()
-        for regexp in regexps:
-        	if re.search(regexp, lower_line):
-        		sys.stdout.write('1\t')
-        	else:
-        		sys.stdout.write('0\t')
-        sys.stdout.write(line)
\ No newline at end of file
+    chunks = line_chunks(sys.stdin, args.chunk_size)
+    if args.num_processes > 1:
+        pool = multiprocessing.Pool(args.num_processes,
+                                    initializer=_init_tagger,
+                                    initargs=(clusters, args.check))
+        tagged_chunks = pool.imap(tag_chunk, chunks)
+    else:
+        pool = None
+        _init_tagger(clusters, args.check)
+        tagged_chunks = itertools.imap(tag_chunk, chunks)
+    try:
+        for tagged_chunk in tagged_chunks:
+            sys.stdout.write(''.join(tagged_chunk))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -3,58 +3,110 @@
 xmlparse.py
 
 Parses XML in table created by get_biosample_data.sh so it's more readable.
-Requires https://github.com/martinblech/xmltodict .
-To install that, run "pip install xmltodict".
+Each line's <SampleData> element is read incrementally with iterparse,
+keeping only the Biosample dates, title, Ids, and Attributes, and chunks of
+lines are parsed in parallel if -p is more than 1. Output lines are written in
+input order.
 """
+import itertools
+import multiprocessing
 import sys
-import xmltodict
+from cStringIO import StringIO
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
-def silent_value(*args):
-    """ Returns value from dictionary or NA if there's a KeyError
+_header = ['sample', 'submission date', 'publication date', 'last update',
+           'title', 'ids', 'attributes']
 
-        args: dictionary followed by chain of keys; ex: 'a', 'hello',
-            'howareyou' translates to a['hello']['howareyou']
+def _text(element):
+    """ Return value: element's stripped text or empty string """
+    return (element.text or '').strip()
 
-        Return value: NA or value
+def parse_line(line):
+    """ Extracts fields from a line of get_biosample_data.sh's output
+
+        line: line with SRA sample accession number, an empty field, and a
+            <SampleData> element separated by tabs
+
+        Return value: tab-separated output line with fields in _header,
+            ASCII-encoded; missing values are NA
     """
-    try:
-        return eval(args[0] + ''.join('["%s"]' % arg for arg in args[1:]))
-    except KeyError:
-        return 'NA'
-
-print '\t'.join(
-        ['sample', 'submission date', 'publication date', 'last update',
-         'title', 'ids', 'attributes']
-    )
-for line in sys.stdin:
     sample, _, xml = line.strip().split('\t')
-    xml = xmltodict.parse(xml)
-    alt_sample_names = ';'.join([item.rpartition(';')[-1]
-                        for item in [
-                            ';'.join(i for el in db.items() for i in el)
-                                for db
-                                in xml['SampleData']['BioSample']['Ids']['Id']]
-                                if 'sample name' in item.lower()])
-    if not alt_sample_names: alt_sample_names = 'NA'
+    dates = ['NA', 'NA', 'NA']
+    title = 'NA'
+    alt_sample_names, attributes = [], []
+    path = []
+    for event, element in ElementTree.iterparse(StringIO(xml),
+                                                 events=('start', 'end')):
+        if event == 'start':
+            path.append(element.tag)
+            if path == ['SampleData', 'BioSample']:
+                dates = [element.get(date, 'NA')
+                            for date in ['submission_date',
+                                         'publication_date', 'last_update']]
+            continue
+        if path == ['SampleData', 'BioSample', 'Ids', 'Id']:
+            # Ids whose attributes or text mention a sample name
+            if 'sample name' in ';'.join(
+                    element.attrib.values() + [_text(element)]
+                ).lower():
+                alt_sample_names.append(_text(element))
+        elif path == ['SampleData', 'BioSample', 'Description', 'Title']:
+            title = _text(element) or 'NA'
+        elif path == ['SampleData', 'BioSample', 'Attributes', 'Attribute']:
+            attributes.append(':'.join([element.get('attribute_name', ''),
+                                        _text(element)]))
+        if len(path) > 2:
+            # Everything needed from element has been read
+            element.clear()
+        path.pop()
+    return u'\t'.join(
+            [sample.decode('utf-8')] + dates
+            + [title, ';'.join(alt_sample_names) or 'NA',
+               ';'.join(attributes) or 'NA']
+        ).encode('ascii', 'ignore')
+
+def parse_chunk(lines):
+    """ Return value: list of outputs of parse_line() for lines """
+    return [parse_line(line) for line in lines]
+
+def line_chunks(stream, chunk_size):
+    """ Yield value: list of up to chunk_size lines from stream """
+    while True:
+        chunk = list(itertools.islice(stream, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+            default=1,
+            help='maximum number of processes to run simultaneously'
+        )
+    parser.add_argument('--chunk-size', type=int, required=False,
+            default=1000,
+            help='number of lines parsed at once by a process'
+        )
+    args = parser.parse_args()
+    print '\t'.join(_header)
+    chunks = line_chunks(sys.stdin, args.chunk_size)
+    if args.num_processes > 1:
+        pool = multiprocessing.Pool(args.num_processes)
+        parsed_chunks = pool.imap(parse_chunk, chunks)
+    else:
+        pool = None
+        parsed_chunks = itertools.imap(parse_chunk, chunks)
     try:
-        attributes = ';'.join(
-                [':'.join([el['@attribute_name'], el['#text']])
-                    for el
-                    in xml['SampleData'][
-                                    'BioSample'
-                                ]['Attributes']['Attribute']])
-    except TypeError:
-        attributes = 'NA'
-    print ('\t'.join(
-        [sample,
-            silent_value('xml', 'SampleData',
-                         'BioSample', '@submission_date'),
-            silent_value('xml', 'SampleData',
-                         'BioSample', '@publication_date'),
-            silent_value('xml', 'SampleData',
-                         'BioSample', '@last_update'),
-            silent_value('xml', 'SampleData',
-                              'BioSample', 'Description', 'Title'),
-            alt_sample_names, attributes
-        ]).encode('ascii', 'ignore')
-    )
\ No newline at end of file
+        for parsed_chunk in parsed_chunks:
+            for parsed_line in parsed_chunk:
+                print parsed_line
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+"""
+junction_query.py
+
+Retrieves junctions lying entirely inside genes or genomic intervals from a
+junctions file like intropolis.v2.hg38.tsv.gz, replacing the per-gene
+grep/awk scans of alk.sh and tnf.sh. Any number of queries share a single
+sweep over the junctions, so hundreds of genes cost about as much as one.
+
+A junctions file is made seekable by running this script with
+--build-index, which writes a copy of it as a series of independent gzip
+members (still a valid gzip file) together with an index of the member
+holding each block of junctions. Queries on an indexed file decompress only
+members whose junctions could fall in a queried interval; queries on an
+unindexed file stream through it once.
+
+Genes are resolved by name or Ensembl ID from a GTF like
+ftp://ftp.ensembl.org/pub/release-83/gtf/homo_sapiens/
+Homo_sapiens.GRCh38.83.gtf.gz. Gene intervals are cached in a small
+tab-separated file when --gene-index is specified.
+
+A junction is returned for a query when both its start and end lie in the
+queried (1-based, closed) interval and, unless --any-strand is invoked, it
+is on the query's strand. Explicit intervals have the form
+[name=]chrom:start-end[:strand]; without a strand, junctions on both strands
+are returned.
+
+Output: for each query NAME, [out-dir]/NAME.tsv.gz, which contains
+the matching lines of the junctions file unchanged. For a query split at
+positions P1 < P2 < ... with --split NAME:P1,P2,..., junctions are further
+divided by start position into [out-dir]/NAME.[lo]-[hi].tsv.gz, where [lo]
+and [hi] bound the junction starts in the file. For example,
+--split ALK:29223529 separates ALK junctions as alk.sh does.
+"""
+import bisect
+import gzip
+import os
+import re
+import sys
+import zlib
+from collections import defaultdict
+import numpy as np
+
+_INDEX_SUFFIX = '.blocks.npz'
+
+def index_file(indexed_file):
+    """ Return value: path to index of an indexed junctions file """
+    return indexed_file + _INDEX_SUFFIX
+
+def build_index(junction_file, indexed_file, block_lines=20000,
+                    compress_level=6):
+    """ Writes seekable copy of a junctions file and its block index
+
+        A new gzip member is started every block_lines junctions and at
+        every change of chromosome. The index records each member's
+        chromosome, range of junction start positions, and byte range.
+
+        junction_file: gzipped junctions file with chromosome and start as
+            fields 1-2
+        indexed_file: where to write seekable copy; its index is written to
+            index_file(indexed_file)
+        block_lines: max number of junctions per gzip member
+        compress_level: zlib compression level
+
+        No return value.
+    """
+    chroms, chrom_indexes = [], {}
+    block_chroms, min_starts, max_starts, offsets, sizes = [], [], [], [], []
+    block, starts = [], []
+    offset = [0]
+
+    def flush_block(output_stream, chrom):
+        """ Compresses buffered lines as one gzip member """
+        if not block:
+            return
+        compressor = zlib.compressobj(
+                compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+        member = compressor.compress(''.join(block)) + compressor.flush()
+        output_stream.write(member)
+        try:
+            block_chroms.append(chrom_indexes[chrom])
+        except KeyError:
+            chrom_indexes[chrom] = len(chroms)
+            chroms.append(chrom)
+            block_chroms.append(chrom_indexes[chrom])
+        min_starts.append(min(starts))
+        max_starts.append(max(starts))
+        offsets.append(offset[0])
+        sizes.append(len(member))
+        offset[0] += len(member)
+        del block[:], starts[:]
+
+    last_chrom = None
+    with gzip.open(junction_file) as junction_stream, open(
+            indexed_file + '.partial', 'wb'
+        ) as output_stream:
+        for k, line in enumerate(junction_stream):
+            if not k % 1000000:
+                print >>sys.stderr, (
+                        '\x1b[KIndexed {} junctions...\r'.format(k)
+                    ),
+            chrom, start = line.split('\t', 2)[:2]
+            if chrom != last_chrom or len(block) >= block_lines:
+                flush_block(output_stream, last_chrom)
+                last_chrom = chrom
+            block.append(line)
+            starts.append(int(start))
+        flush_block(output_stream, last_chrom)
+    np.savez(
+            index_file(indexed_file) + '.partial.npz',
+            chroms=np.array(chroms, dtype=str),
+            chrom=np.array(block_chroms, dtype=np.uint16),
+            min_start=np.array(min_starts, dtype=np.int64),
+            max_start=np.array(max_starts, dtype=np.int64),
+            offset=np.array(offsets, dtype=np.int64),
+            size=np.array(sizes, dtype=np.int64)
+        )
+    os.rename(indexed_file + '.partial', indexed_file)
+    os.rename(index_file(indexed_file) + '.partial.npz',
+                index_file(indexed_file))
+
+def _chrom_name(chrom):
+    """ Converts an Ensembl chromosome name to a UCSC-style name """
+    if chrom.startswith('chr'):
+        return chrom
+    if chrom == 'MT':
+        return 'chrM'
+    return 'chr' + chrom
+
+def read_genes(gtf, gene_index=None):
+    """ Reads gene intervals from a GTF
+
+        gtf: path to GTF or gzipped GTF; may be None if gene_index exists
+        gene_index: if not None, a tab-separated cache of gene intervals; it
+            is read instead of the GTF if it is at least as new as the GTF
+            and written otherwise
+
+        Return value: dictionary mapping gene names and Ensembl gene IDs to
+            lists of tuples (gene ID, chromosome, 1-based start, 1-based end,
+            strand)
+    """
+    genes = []
+    if gene_index is not None and os.path.exists(gene_index) and (
+            gtf is None
+            or os.path.getmtime(gene_index) >= os.path.getmtime(gtf)
+        ):
+        with open(gene_index) as gene_stream:
+            for line in gene_stream:
+                tokens = line.rstrip('\n').split('\t')
+                genes.append((tokens[0], tokens[1], tokens[2],
+                                int(tokens[3]), int(tokens[4]), tokens[5]))
+    elif gtf is None:
+        raise RuntimeError('A GTF or an existing gene index is required.')
+    else:
+        with (gzip.open(gtf) if gtf.endswith('.gz') else open(gtf)) \
+                as gtf_stream:
+            for line in gtf_stream:
+                if line[0] == '#': continue
+                tokens = line.strip().split('\t')
+                if tokens[2] != 'gene': continue
+                attributes = dict(
+                        re.findall(r'(\S+) "([^"]*)"', tokens[8])
+                    )
+                gene_id = attributes['gene_id']
+                genes.append((gene_id, attributes.get('gene_name', gene_id),
+                                _chrom_name(tokens[0]), int(tokens[3]),
+                                int(tokens[4]), tokens[6]))
+        if gene_index is not None:
+            with open(gene_index + '.partial', 'w') as gene_stream:
+                for gene in genes:
+                    print >>gene_stream, '\t'.join(map(str, gene))
+            os.rename(gene_index + '.partial', gene_index)
+    gene_intervals = defaultdict(list)
+    for gene_id, gene_name, chrom, start, end, strand in genes:
+        gene_intervals[gene_id].append(
+                (gene_id, chrom, start, end, strand)
+            )
+        if gene_name != gene_id:
+            gene_intervals[gene_name].append(
+                    (gene_id, chrom, start, end, strand)
+                )
+    return gene_intervals
+
+def parse_interval(interval):
+    """ Parses an interval specified as [name=]chrom:start-end[:strand]
+
+        interval: interval string
+
+        Return value: tuple (name, chromosome, 1-based start, 1-based end,
+            strand or None if interval has no strand)
+    """
+    name, _, region = interval.rpartition('=')
+    match = re.match(r'^([^:]+):([\d,]+)-([\d,]+)(?::([+-]))?$', region)
+    if match is None:
+        raise RuntimeError(
+                'Interval "{}" does not have the form '
+                '[name=]chrom:start-end[:strand].'.format(interval)
+            )
+    chrom, start, end, strand = match.groups()
+    start, end = int(start.replace(',', '')), int(end.replace(',', ''))
+    if start > end:
+        raise RuntimeError(
+                'Interval "{}" starts after it ends.'.format(interval)
+            )
+    return (name or re.sub('[^a-zA-Z\d.+-]+', '_', region),
+                chrom, start, end, strand)
+
+def sweep_junctions(junction_file, queries):
+    """ Reads junctions matching queries in one pass over junction_file
+
+        junction_file: gzipped junctions file, indexed with build_index() or
+            not
+        queries: list of tuples (chromosome, 1-based start, 1-based end,
+            strand or None for either strand)
+
+        Yield value: tuple (list of indexes of matching queries, junction
+            line)
+    """
+    # Sort queries by start per chromosome; a junction can match only
+    # queries starting in [junction end - longest query, junction start]
+    by_chrom = defaultdict(list)
+    for i, (chrom, start, end, strand) in enumerate(queries):
+        by_chrom[chrom].append((start, end, strand, i))
+    chrom_queries = {}
+    for chrom in by_chrom:
+        by_chrom[chrom].sort()
+        chrom_queries[chrom] = (
+                [query[0] for query in by_chrom[chrom]],
+                by_chrom[chrom],
+                max(query[1] - query[0] for query in by_chrom[chrom])
+            )
+
+    def matches(lines):
+        for line in lines:
+            tokens = line.split('\t', 4)
+            try:
+                starts, chrom_query_list, longest = chrom_queries[tokens[0]]
+            except KeyError:
+                continue
+            start, end = int(tokens[1]), int(tokens[2])
+            matched = [
+                    i for query_start, query_end, strand, i
+                    in chrom_query_list[
+                        bisect.bisect_left(starts, end - longest):
+                        bisect.bisect_right(starts, start)
+                    ] if end <= query_end
+                    and (strand is None or strand == tokens[3])
+                ]
+            if matched:
+                yield matched, line
+
+    if not os.path.exists(index_file(junction_file)):
+        print >>sys.stderr, (
+                '\x1b[KNo index found for {}; scanning it in full.'.format(
+                        junction_file
+                    )
+            )
+        with gzip.open(junction_file) as junction_stream:
+            for match in matches(junction_stream):
+                yield match
+        return
+    index = np.load(index_file(junction_file))
+    chrom_names = [str(chrom) for chrom in index['chroms']]
+    block_chroms = index['chrom']
+    min_starts, max_starts = index['min_start'], index['max_start']
+    offsets, sizes = index['offset'], index['size']
+    # Select every member holding a junction that could match any query
+    wanted = np.zeros(offsets.size, dtype=bool)
+    for chrom_index, chrom in enumerate(chrom_names):
+        if chrom not in chrom_queries:
+            continue
+        in_chrom = block_chroms == chrom_index
+        for query_start, query_end, _, _ in chrom_queries[chrom][1]:
+            wanted |= in_chrom & (max_starts >= query_start) & (
+                    min_starts <= query_end
+                )
+    blocks = np.flatnonzero(wanted)
+    with open(junction_file, 'rb') as junction_stream:
+        for k, block in enumerate(blocks[np.argsort(offsets[blocks])]):
+            if not k % 100:
+                print >>sys.stderr, (
+                        '\x1b[KRead {}/{} blocks...\r'.format(k, blocks.size)
+                    ),
+            junction_stream.seek(offsets[block])
+            lines = zlib.decompress(
+                    junction_stream.read(sizes[block]), 16 + zlib.MAX_WBITS
+                ).splitlines(True)
+            for match in matches(lines):
+                yield match
+
+def query_junctions(junction_file, queries):
+    """ Retrieves junctions lying in each of many intervals
+
+        junction_file: gzipped junctions file, indexed with build_index() or
+            not, with chromosome, start, end, strand, start motif, and end
+            motif as fields 1-6, a comma-separated list of sample indexes as
+            field 7, and a comma-separated list of coverages as field 8; this
+            is intropolis.v2.hg38.tsv.gz or an indexed copy of it
+        queries: list of tuples (chromosome, 1-based start, 1-based end,
+            strand or None for either strand)
+
+        Return value: list, with one item per query, of lists of junctions
+            (chromosome, start, end, strand, start motif, end motif, NumPy
+            array of sample indexes, NumPy array of coverages) in the order
+            they appear in junction_file
+    """
+    results = [[] for _ in queries]
+    for matched, line in sweep_junctions(junction_file, queries):
+        tokens = line.rstrip('\n').split('\t')
+        junction = (tokens[0], int(tokens[1]), int(tokens[2]), tokens[3],
+                        tokens[4], tokens[5],
+                        np.fromstring(tokens[6], dtype=np.int64, sep=','),
+                        np.fromstring(tokens[7], dtype=np.int64, sep=','))
+        for i in matched:
+            results[i].append(junction)
+    return results
+
+def split_junctions(junctions, positions):
+    """ Divides junctions into sub-regions by start position
+
+        junctions: list of junctions as returned by query_junctions()
+        positions: sorted list of 1-based positions at which to split
+
+        Return value: list of len(positions) + 1 lists of junctions; the ith
+            holds junctions starting at or after positions[i-1] and before
+            positions[i]
+    """
+    parts = [[] for _ in xrange(len(positions) + 1)]
+    for junction in junctions:
+        parts[bisect.bisect_right(positions, junction[1])].append(junction)
+    return parts
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    # Add command-line arguments
+    parser.add_argument('--junctions', type=str, required=True,
+            help=('junctions file; this should be intropolis.v2.hg38.tsv.gz '
+                  'or a copy of it indexed with --build-index')
+        )
+    parser.add_argument('--build-index', type=str, required=False,
+            default=None,
+            help=('write indexed copy of --junctions to this path and exit; '
+                  'its index is written alongside it with extension '
+                  + _INDEX_SUFFIX)
+        )
+    parser.add_argument('--block-lines', type=int, required=False,
+            default=20000,
+            help='max number of junctions per block of an indexed copy'
+        )
+    parser.add_argument('--gtf', type=str, required=False, default=None,
+            help=('GTF from which genes are resolved; we used '
+                  'ftp://ftp.ensembl.org/pub/release-83/gtf/homo_sapiens/'
+                  'Homo_sapiens.GRCh38.83.gtf.gz')
+        )
+    parser.add_argument('--gene-index', type=str, required=False,
+            default=None,
+            help='where to cache gene intervals read from --gtf'
+        )
+    parser.add_argument('--genes', type=str, required=False, nargs='+',
+            default=[],
+            help='names or Ensembl IDs of genes to query'
+        )
+    parser.add_argument('--gene-list', type=str, required=False,
+            default=None,
+            help='file with one gene name or Ensembl ID per line to query'
+        )
+    parser.add_argument('--intervals', type=str, required=False, nargs='+',
+            default=[],
+            help=('intervals to query, each of the form '
+                  '[name=]chrom:start-end[:strand]')
+        )
+    parser.add_argument('--split', type=str, required=False, nargs='+',
+            default=[],
+            help=('split junctions of a query by start position; each '
+                  'argument has the form NAME:P1[,P2,...]')
+        )
+    parser.add_argument('--any-strand', action='store_const', const=True,
+            default=False,
+            help='return junctions on either strand for every query'
+        )
+    parser.add_argument('--out-dir', type=str, required=False, default='.',
+            help='directory in which to write output'
+        )
+    args = parser.parse_args()
+    if args.build_index is not None:
+        build_index(args.junctions, args.build_index,
+                        block_lines=args.block_lines)
+        print >>sys.stderr, '\x1b[KDone.'
+        sys.exit(0)
+    gene_names = list(args.genes)
+    if args.gene_list is not None:
+        with open(args.gene_list) as gene_stream:
+            gene_names.extend(
+                    line.strip() for line in gene_stream if line.strip()
+                )
+    names, queries = [], []
+    if gene_names:
+        gene_intervals = read_genes(args.gtf, gene_index=args.gene_index)
+        for gene in gene_names:
+            if gene not in gene_intervals:
+                raise RuntimeError(
+                        'Gene {} is not in the gene annotation.'.format(gene)
+                    )
+            loci = gene_intervals[gene]
+            for gene_id, chrom, start, end, strand in loci:
+                # Distinguish loci of a gene name found more than once
+                names.append(
+                        gene if len(loci) == 1 else '_'.join([gene, gene_id])
+                    )
+                queries.append((chrom, start, end, strand))
+    for interval in args.intervals:
+        name, chrom, start, end, strand = parse_interval(interval)
+        names.append(name)
+        queries.append((chrom, start, end, strand))
+    if not queries:
+        raise RuntimeError('Specify at least one gene or interval to query.')
+    if len(set(names)) != len(names):
+        raise RuntimeError('Query names must be distinct.')
+    if args.any_strand:
+        queries = [query[:3] + (None,) for query in queries]
+    splits = {}
+    for split in args.split:
+        name, _, positions = split.rpartition(':')
+        if name not in names:
+            raise RuntimeError(
+                    'Split query {} was not queried.'.format(name)
+                )
+        splits[name] = sorted(int(position.replace(',', ''))
+                                for position in positions.split(','))
+    try:
+        os.makedirs(args.out_dir)
+    except OSError:
+        if not os.path.isdir(args.out_dir):
+            raise
+    print >>sys.stderr, 'Querying {} intervals...'.format(len(queries))
+    output_streams = [
+            gzip.open(os.path.join(args.out_dir, query_name + '.tsv.gz'), 'w')
+            for query_name in names
+        ]
+    split_streams = {}
+    for i, name in enumerate(names):
+        if name not in splits:
+            continue
+        bounds = [queries[i][1]] + splits[name] + [queries[i][2] + 1]
+        split_streams[i] = [
+                gzip.open(os.path.join(
+                        args.out_dir, '{}.{}-{}.tsv.gz'.format(
+                                name, lower, upper - 1
+                            )
+                    ), 'w') for lower, upper in zip(bounds[:-1], bounds[1:])
+            ]
+    match_counts = [0] * len(queries)
+    try:
+        for matched, line in sweep_junctions(args.junctions, queries):
+            for i in matched:
+                output_streams[i].write(line)
+                match_counts[i] += 1
+                if i in split_streams:
+                    split_streams[i][
+                        bisect.bisect_right(
+                                splits[names[i]], int(line.split('\t', 2)[1])
+                            )
+                    ].write(line)
+    finally:
+        for output_stream in output_streams:
+            output_stream.close()
+        for streams in split_streams.values():
+            for output_stream in streams:
+                output_stream.close()
+    for name, match_count in zip(names, match_counts):
+        print >>sys.stderr, '\x1b[K{}: {} junctions'.format(
+                name, match_count
+            )
+    print >>sys.stderr, 'Done.'
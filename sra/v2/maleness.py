@@ -8,52 +8,175 @@ See arguments for requirements. Output:
 3. experiment accession number
 4. run accession number
 5. number of _annotated_ chrY junctions expressed
+
+Only chrY junctions are read: if --intropolis was indexed with
+junction_query.py's --build-index, just the blocks of chrY junctions are
+decompressed; otherwise the file is streamed once. Per-sample counts are
+accumulated with NumPy.
+
+If --sex is invoked, every sample in --ids is written, and the output has
+the additional fields
+6. total coverage of annotated chrY junctions
+7. total coverage of junctions in XIST (see --xist)
+8. score: log2((field 6 + 1) / (field 7 + 1))
+9. call: male if score exceeds a threshold, female if it does not, and NA
+    if fields 6 and 7 sum to less than --min-coverage
+
+The threshold is calibrated on the data: it is midway between the two
+clusters minimizing the total squared deviation of scores of samples with at
+least --min-coverage from their cluster means. It is written to stderr.
 """
-from collections import defaultdict
 import gzip
+import sys
+import numpy as np
+from junction_query import parse_interval, sweep_junctions
+
+def sex_coverages(intropolis, annotated, xist, sample_count):
+    """ Accumulates per-sample chrY and XIST junction counts and coverages
+
+        intropolis: path to intropolis.v2.hg38.tsv.gz or an indexed copy of
+            it
+        annotated: path to annotated_junctions.tsv.gz
+        xist: tuple (chromosome, 1-based start, 1-based end, strand or None)
+            delimiting XIST
+        sample_count: number of samples
+
+        Return value: tuple of NumPy arrays indexed by sample (number of
+            annotated chrY junctions, total coverage of annotated chrY
+            junctions, total coverage of junctions in XIST)
+    """
+    with gzip.open(annotated) as annotated_stream:
+        annotated_chrY_junctions = set(
+                [tuple(line.strip().split('\t')[1:])
+                    for line in annotated_stream if line.startswith('chrY\t')]
+            )
+    sample_lists, coverage_lists = [[], []], [[], []]
+    for matched, line in sweep_junctions(
+            intropolis, [('chrY', 1, 1 << 31, None), xist]
+        ):
+        (chrom, pos, end_pos, strand,
+            _, _, samples, coverages) = line.strip().split('\t')
+        if 0 in matched:
+            if (pos, end_pos, strand) not in annotated_chrY_junctions:
+                continue
+            sample_lists[0].append(samples)
+            coverage_lists[0].append(coverages)
+        else:
+            sample_lists[1].append(samples)
+            coverage_lists[1].append(coverages)
+    results = []
+    for k, (samples, coverages) in enumerate(
+            zip(sample_lists, coverage_lists)
+        ):
+        samples = np.fromstring(
+                ','.join(samples), dtype=np.int64, sep=','
+            )
+        coverages = np.fromstring(
+                ','.join(coverages), dtype=np.int64, sep=','
+            )
+        if samples.size and samples.max() >= sample_count:
+            raise RuntimeError(
+                    'Sample index {} is not in the id map.'.format(
+                            samples.max()
+                        )
+                )
+        if not k:
+            results.append(np.bincount(samples, minlength=sample_count))
+        results.append(np.bincount(
+                samples, weights=coverages, minlength=sample_count
+            ).astype(np.int64))
+    return tuple(results)
+
+def two_means_threshold(scores):
+    """ Splits scores into two clusters with least squared deviation
+
+        scores: 1D NumPy array of at least two scores
+
+        Return value: threshold midway between the clusters
+    """
+    scores = np.sort(scores)
+    score_count = scores.size
+    sums = np.cumsum(scores)
+    square_sums = np.cumsum(scores * scores)
+    left_sizes = np.arange(1, score_count)
+    right_sizes = score_count - left_sizes
+    left_sums = sums[:-1]
+    right_sums = sums[-1] - left_sums
+    costs = (
+            square_sums[:-1] - left_sums * left_sums / left_sizes
+            + (square_sums[-1] - square_sums[:-1])
+            - right_sums * right_sums / right_sizes
+        )
+    split = int(np.argmin(costs)) + 1
+    return (scores[split - 1] + scores[split]) / 2
 
 if __name__ == '__main__':
     import argparse
-    parser = argparse.ArgumentParser(description=__doc__, 
+    parser = argparse.ArgumentParser(description=__doc__,
             formatter_class=argparse.RawDescriptionHelpFormatter)
     parser.add_argument('--intropolis', required=True,
         help='path to intropolis.v2.hg38.tsv.gz, which contains all '
-             'junctions from the second run of Rail')
+             'junctions from the second run of Rail, or a copy of it '
+             'indexed by junction_query.py')
     parser.add_argument('--ids', required=True,
         help='path to intropolis.idmap.v2.hg38.tsv, which maps sample ids '
              'from intropolis to SRA accession numbers')
     parser.add_argument('--annotated', required=True,
         help='path to annotated junctions; this is annotated_junctions.tsv.gz '
              'and covers all annotations defined in annotation_definition.md')
+    parser.add_argument('--sex', action='store_const', const=True,
+        default=False,
+        help='call the sex of every sample; see above')
+    parser.add_argument('--xist', required=False,
+        default='chrX:73820651-73852753:-',
+        help='XIST interval in the form chrom:start-end[:strand]; the '
+             'default is from GENCODE for GRCh38')
+    parser.add_argument('--min-coverage', type=int, required=False,
+        default=10,
+        help='min total coverage of annotated chrY and XIST junctions for '
+             'a sample to be called')
     args = parser.parse_args()
 
-    with gzip.open(args.annotated) as annotated_stream:
-        annotated_junctions = [
-                line.strip().split('\t') for line in annotated_stream
-            ]
-
-    annotated_chrY_junctions = set(
-            [tuple(junction[1:]) for junction in annotated_junctions
-                if junction[0] == 'chrY']
-        )
-
-    male_samples = defaultdict(int)
-    with gzip.open(args.intropolis) as intropolis_stream:
-        for line in intropolis_stream:
-            (chrom, pos, end_pos, strand,
-                _, _, samples, _) = line.strip().split('\t')
-            if chrom != 'chrY': continue
-            if (pos, end_pos, strand) in annotated_chrY_junctions:
-                for sample in samples.split(','):
-                    male_samples[sample] += 1
-
     id_to_accession = {}
     with open(args.ids) as id_stream:
         for line in id_stream:
             tokens = line.strip().split('\t')
-            id_to_accession[tokens[0]] = '\t'.join(tokens[1:])
+            id_to_accession[int(tokens[0])] = '\t'.join(tokens[1:])
+    sample_count = max(id_to_accession) + 1
 
-    for sample, count in sorted(male_samples.items(),
-                                key=lambda x: x[1],
-                                reverse=True):
-        print '\t'.join([id_to_accession[sample], str(count)])
+    chrY_counts, chrY_coverages, xist_coverages = sex_coverages(
+            args.intropolis, args.annotated, parse_interval(args.xist)[1:],
+            sample_count
+        )
+
+    if not args.sex:
+        for sample in np.argsort(-chrY_counts, kind='mergesort'):
+            if not chrY_counts[sample]:
+                break
+            print '\t'.join([id_to_accession[sample],
+                                str(chrY_counts[sample])])
+        sys.exit(0)
+
+    scores = np.log2(
+            (chrY_coverages + 1.) / (xist_coverages + 1.)
+        )
+    callable_samples = chrY_coverages + xist_coverages >= args.min_coverage
+    if callable_samples.sum() < 2:
+        raise RuntimeError(
+                'Fewer than two samples have enough coverage to calibrate '
+                'calls.'
+            )
+    threshold = two_means_threshold(scores[callable_samples])
+    print >>sys.stderr, '\x1b[KScore threshold: {}'.format(threshold)
+    for sample in sorted(id_to_accession):
+        if not callable_samples[sample]:
+            call = 'NA'
+        elif scores[sample] > threshold:
+            call = 'male'
+        else:
+            call = 'female'
+        print '\t'.join([id_to_accession[sample],
+                            str(chrY_counts[sample]),
+                            str(chrY_coverages[sample]),
+                            str(xist_coverages[sample]),
+                            '{:.4f}'.format(scores[sample]), call])
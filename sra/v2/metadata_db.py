@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+"""
+metadata_db.py
+
+Loads SRA run metadata scattered across several files into one indexed SQLite
+database so scripts can fetch just the columns they need without reparsing
+the files. Sources are
+
+1. intropolis.idmap.v2.hg38.tsv: sample indexes
+2. hg38/SraRunInfo.csv: project, sample, experiment, and GSM accession
+    numbers; read counts; and paired-end status
+3. hg38/biosample_tags.tsv (optional): Biosample tags and dates, generated by
+    hg38/get_biosample_data.sh
+4. sra-all-fields-2015-9-13.txt (optional): SHARQ tissue and cell type
+5. auc.tsv (optional): AUCs, generated by AUC.sh
+6. counts.tsv.gz in each batch_* subdirectory of --sra-dir (optional):
+    numbers of reads Rail attempted to map and mapped, read by
+    batch_counts.py
+
+The database has a table runs with one row per run in SraRunInfo.csv and a
+table biosamples with one row per sample in biosample_tags.tsv, whose columns
+are the tag names of biosample_tags.tsv with spaces replaced by underscores.
+Query the view metadata, which joins them on sample accession number and has
+columns
+
+run, sample_index, project, sample, experiment, gsm, read_count (mates
+for paired-end runs), paired (1 or 0), tissue, cell_type, auc,
+reads_aligned, mapped_read_count, submission_date, publication_date,
+update_date, title, ids, attributes, and the tag columns
+
+Values missing from a source are NULL. Runs are indexed by run, sample index,
+project, sample, and experiment accession numbers. The table sources records
+the path, mtime, and size of each source the database was built from (for
+counts, the latest mtime and number of counts.tsv.gz files); default_store()
+rebuilds the database when any of these changes, or when a source that was
+absent has since been created.
+
+Run this script with --build to build a database; otherwise, the columns
+specified by --columns of the runs satisfying --where are written to stdout
+as tab-separated lines, with NA for NULL.
+"""
+import csv
+import os
+import re
+import sqlite3
+import sys
+from batch_counts import batch_count_files, read_batch_counts
+
+_run_columns = [
+        ('run', 'TEXT PRIMARY KEY'), ('sample_index', 'INTEGER'),
+        ('project', 'TEXT'), ('sample', 'TEXT'), ('experiment', 'TEXT'),
+        ('gsm', 'TEXT'), ('read_count', 'INTEGER'), ('paired', 'INTEGER'),
+        ('tissue', 'TEXT'), ('cell_type', 'TEXT'), ('auc', 'REAL'),
+        ('reads_aligned', 'INTEGER'), ('mapped_read_count', 'INTEGER')
+    ]
+
+_biosample_fields = ['submission_date', 'publication_date', 'update_date',
+                        'title', 'ids', 'attributes']
+
+def read_run_info(run_info):
+    """ Reads SraRunInfo.csv
+
+        run_info: path to SraRunInfo.csv
+
+        Yield value: tuple (run, project, sample, experiment, GSM accession
+            number or None, number of reads with mates counted separately,
+            1 if paired-end else 0)
+    """
+    with open(run_info) as run_stream:
+        run_stream.readline()
+        run_reader = csv.reader(run_stream, delimiter=',', quotechar='"')
+        for tokens in run_reader:
+            if not tokens or (len(tokens) == 1 and tokens[0] == ''): continue
+            if tokens[15] == 'PAIRED':
+                read_count, paired = int(tokens[3]) * 2, 1
+            elif tokens[15] == 'SINGLE':
+                read_count, paired = int(tokens[3]), 0
+            else:
+                raise RuntimeError(
+                        'Fail: {} is neither SINGLE nor PAIRED'.format(
+                                                                    tokens[15]
+                                                                )
+                    )
+            yield (tokens[0], tokens[20], tokens[24], tokens[10],
+                    tokens[29] or None, read_count, paired)
+
+_source_names = ['idmap', 'run_info', 'biosample_tags', 'sharq', 'auc',
+                    'sra_dir']
+
+def source_signature(name, path):
+    """ Identifies the state of a source of the metadata database
+
+        name: name of source from _source_names
+        path: path to source or None if it is not used
+
+        Return value: tuple (path, mtime, size); mtime and size are None if
+            path is None or does not exist. For sra_dir, mtime is the
+            latest mtime of its counts.tsv.gz files, and size is their
+            number.
+    """
+    if path is None:
+        return None, None, None
+    if name == 'sra_dir':
+        count_files = [count_file for count_file in batch_count_files(path)
+                        if os.path.exists(count_file)]
+        if not count_files:
+            return path, None, None
+        return path, max(os.path.getmtime(count_file)
+                            for count_file in count_files), len(count_files)
+    if not os.path.exists(path):
+        return path, None, None
+    return path, os.path.getmtime(path), os.path.getsize(path)
+
+def _column_name(tag):
+    """ Converts a header field of biosample_tags.tsv to a column name """
+    return re.sub(r'[^0-9a-z]+', '_', tag.strip().lower()).strip('_')
+
+def _declaration(columns):
+    """ Declares columns, given as tuples (name, type), of a table
+
+        Names are quoted because tags like "primary" are SQL keywords.
+    """
+    return ', '.join('"{}" {}'.format(*column) for column in columns)
+
+def build_metadata_db(db_file, idmap, run_info, biosample_tags=None,
+                        sharq=None, auc=None, sra_dir=None,
+                        num_processes=1, counts_cache=None):
+    """ Builds metadata database
+
+        db_file: path to database to write; it is written to a temporary
+            file that replaces db_file once complete
+        idmap: path to intropolis.idmap.v2.hg38.tsv
+        run_info: path to SraRunInfo.csv
+        biosample_tags: path to biosample_tags.tsv or None
+        sharq: path to SHARQ metadata sra-all-fields-2015-9-13.txt or None
+        auc: path to auc.tsv or None
+        sra_dir: directory with batch_* subdirectories of Rail-RNA output
+            or None
+        num_processes: number of processes reading counts.tsv.gz files
+            simultaneously
+        counts_cache: cache of counts as for batch_counts.py or None
+
+        No return value.
+    """
+    partial_file = db_file + '.partial'
+    if os.path.exists(partial_file):
+        os.remove(partial_file)
+    # Sources are identified before they're read so changes made during the
+    # build trigger a rebuild
+    signatures = [(name,) + source_signature(name, path)
+                    for name, path in zip(_source_names, [
+                            idmap, run_info, biosample_tags, sharq, auc,
+                            sra_dir
+                        ])]
+    connection = sqlite3.connect(partial_file)
+    connection.text_factory = str
+    cursor = connection.cursor()
+    cursor.execute('CREATE TABLE sources (name TEXT PRIMARY KEY, path TEXT, '
+                   'mtime REAL, size INTEGER)')
+    cursor.executemany('INSERT INTO sources VALUES (?, ?, ?, ?)', signatures)
+    cursor.execute(
+            'CREATE TABLE runs ({})'.format(_declaration(_run_columns))
+        )
+    cursor.executemany(
+            'INSERT INTO runs (run, project, sample, experiment, gsm, '
+            'read_count, paired) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            read_run_info(run_info)
+        )
+    with open(idmap) as idmap_stream:
+        cursor.executemany(
+                'UPDATE runs SET sample_index = ? WHERE run = ?',
+                ((int(tokens[0]), tokens[4]) for tokens in
+                    (line.strip().split('\t') for line in idmap_stream))
+            )
+    if sharq is not None:
+        with open(sharq) as sharq_stream:
+            sharq_stream.readline()
+            cursor.executemany(
+                    'UPDATE runs SET tissue = ?, cell_type = ? WHERE run = ?',
+                    ((tokens[5], tokens[6], tokens[0]) for tokens in
+                        csv.reader(sharq_stream, delimiter=',',
+                                    quotechar='"'))
+                )
+    if auc is not None:
+        with open(auc) as auc_stream:
+            cursor.executemany(
+                    'UPDATE runs SET auc = ? WHERE run = ?',
+                    ((float(tokens[1].strip()), tokens[0].split('.')[0])
+                        for tokens in
+                        (line.strip().split('\t') for line in auc_stream))
+                )
+    if sra_dir is not None:
+        cursor.executemany(
+                'UPDATE runs SET reads_aligned = ?, mapped_read_count = ? '
+                'WHERE run = ?',
+                ((reads_aligned, mapped_read_count, run)
+                    for run, reads_aligned, mapped_read_count
+                    in read_batch_counts(sra_dir,
+                                            num_processes=num_processes,
+                                            cache=counts_cache))
+            )
+    biosample_columns = [('sample', 'TEXT PRIMARY KEY')] + [
+            (field, 'TEXT') for field in _biosample_fields
+        ]
+    if biosample_tags is not None:
+        with open(biosample_tags) as biosample_stream:
+            header = biosample_stream.readline().rstrip('\n').split('\t')
+            # Tag columns precede the fields written by xmlparse.py
+            tag_count = len(header) - len(_biosample_fields) - 1
+            biosample_columns += [(_column_name(tag), 'INTEGER')
+                                    for tag in header[:tag_count]]
+            cursor.execute('CREATE TABLE biosamples ({})'.format(
+                    _declaration(biosample_columns)
+                ))
+            cursor.executemany(
+                    'INSERT OR REPLACE INTO biosamples VALUES ({})'.format(
+                            ', '.join(['?'] * len(biosample_columns))
+                        ),
+                    ([tokens[tag_count]] + tokens[tag_count+1:]
+                        + map(int, tokens[:tag_count])
+                        for tokens in
+                        (line.rstrip('\n').split('\t')
+                            for line in biosample_stream))
+                )
+    else:
+        cursor.execute('CREATE TABLE biosamples ({})'.format(
+                _declaration(biosample_columns)
+            ))
+    cursor.execute(
+            'CREATE VIEW metadata AS SELECT {} FROM runs '
+            'LEFT JOIN biosamples ON runs.sample = biosamples.sample'.format(
+                    ', '.join(['runs."{}"'.format(column)
+                                for column, _ in _run_columns]
+                              + ['biosamples."{}"'.format(column)
+                                    for column, _ in biosample_columns[1:]])
+                )
+        )
+    for column in ['sample_index', 'project', 'sample', 'experiment']:
+        cursor.execute(
+                'CREATE INDEX runs_{0} ON runs ({0})'.format(column)
+            )
+    connection.commit()
+    connection.close()
+    os.rename(partial_file, db_file)
+
+class MetadataStore(object):
+    """ Read-only queries of a database written by build_metadata_db(). """
+
+    def __init__(self, db_file):
+        if not os.path.exists(db_file):
+            raise RuntimeError(
+                    'Metadata database {} does not exist.'.format(db_file)
+                )
+        self.connection = sqlite3.connect(db_file)
+        self.connection.text_factory = str
+        self.columns = [
+                row[1] for row in self.connection.execute(
+                        'PRAGMA table_info(metadata)'
+                    )
+            ]
+
+    def sources(self):
+        """ Identifies the sources database was built from
+
+            Return value: dictionary mapping each source name to a tuple
+                (path, mtime, size) as returned by source_signature(), or
+                None if the database does not record its sources
+        """
+        try:
+            return {row[0] : tuple(row[1:]) for row in
+                        self.connection.execute(
+                                'SELECT name, path, mtime, size FROM sources'
+                            )}
+        except sqlite3.OperationalError:
+            return None
+
+    def _check_columns(self, columns):
+        """ Raises RuntimeError if any column is not in the metadata view """
+        for column in columns:
+            if column not in self.columns:
+                raise RuntimeError(
+                        'Column "{}" is not in the metadata database; valid '
+                        'columns are {}.'.format(
+                                column, ', '.join(self.columns)
+                            )
+                    )
+
+    def select(self, columns, **where):
+        """ Fetches columns of runs
+
+            columns: list of column names of the metadata view
+            where: column names mapped to values; only runs whose columns
+                equal all of the values are fetched
+
+            Return value: list of tuples, one per run in order of run
+                accession number, with the values of columns
+        """
+        self._check_columns(list(columns) + where.keys())
+        query = 'SELECT {} FROM metadata'.format(
+                ', '.join('"{}"'.format(column) for column in columns)
+            )
+        if where:
+            query += ' WHERE ' + ' AND '.join(
+                    '"{}" = ?'.format(column) for column in where
+                )
+        query += ' ORDER BY run'
+        return self.connection.execute(query, where.values()).fetchall()
+
+    def mapping(self, key, values, **where):
+        """ Maps a column to other columns
+
+            key: column name whose values are keys
+            values: column name or list of column names whose values are
+                values
+            where: as for select()
+
+            Return value: dictionary mapping each value of key to the value
+                of values if values is a column name or else a tuple of
+                values of columns in values
+        """
+        if isinstance(values, str):
+            return dict(self.select([key, values], **where))
+        return {row[0] : row[1:]
+                    for row in self.select([key] + list(values), **where)}
+
+    def close(self):
+        self.connection.close()
+
+def default_store(db_file=None, sra_dir=None, required=()):
+    """ Opens metadata database, building it if needed
+
+        Sources are the files at their paths in this repo, except that an
+        existing database at db_file keeps the paths of the sources it
+        records. The database is (re)built if it does not exist, if it
+        does not record its sources, or if any source has changed or been
+        created since it was built. Optional sources that do not exist are
+        skipped with a message.
+
+        db_file: path to database or None for metadata.sqlite in this
+            directory
+        sra_dir: directory with batch_* subdirectories of Rail-RNA output to
+            read counts from, or None
+        required: names from _source_names of optional sources that must
+            exist; RuntimeError is raised if any is absent. idmap and
+            run_info are always required.
+
+        Return value: MetadataStore
+    """
+    containing_dir = os.path.dirname(os.path.realpath(__file__))
+    paths = dict(zip(_source_names, [
+            os.path.join(containing_dir, 'intropolis.idmap.v2.hg38.tsv'),
+            os.path.join(containing_dir, 'hg38', 'SraRunInfo.csv'),
+            os.path.join(containing_dir, 'hg38', 'biosample_tags.tsv'),
+            os.path.join(containing_dir, 'sra-all-fields-2015-9-13.txt'),
+            os.path.join(containing_dir, 'auc.tsv'),
+            sra_dir
+        ]))
+    store = None
+    if db_file is None:
+        db_file = os.path.join(containing_dir, 'metadata.sqlite')
+    elif os.path.exists(db_file):
+        # Keep the sources of a database built elsewhere
+        store = MetadataStore(db_file)
+        for name, signature in (store.sources() or {}).items():
+            if signature[0] is not None and name in paths and (
+                    name != 'sra_dir' or sra_dir is None
+                ):
+                paths[name] = signature[0]
+    signatures = {name : source_signature(name, path)
+                    for name, path in paths.items()}
+    for name in ['idmap', 'run_info'] + list(required):
+        if signatures[name][1] is None:
+            raise RuntimeError(
+                    'Metadata source {} was not found at {}.'.format(
+                            name, paths[name]
+                        )
+                )
+    for name in _source_names:
+        if paths[name] is not None and signatures[name][1] is None:
+            print >>sys.stderr, (
+                    'Metadata source {} was not found at {}; skipping '
+                    'it.'.format(name, paths[name])
+                )
+            paths[name] = None
+            signatures[name] = (None, None, None)
+    if store is None and os.path.exists(db_file):
+        store = MetadataStore(db_file)
+    if store is not None:
+        if store.sources() == signatures:
+            return store
+        store.close()
+        print >>sys.stderr, (
+                'Sources of metadata database {} have changed.'.format(
+                        db_file
+                    )
+            )
+    print >>sys.stderr, 'Building metadata database {}...'.format(db_file)
+    build_metadata_db(db_file, *[paths[name] for name in _source_names])
+    return MetadataStore(db_file)
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', type=str, required=True,
+            help='path to metadata database'
+        )
+    parser.add_argument('--build', action='store_const', const=True,
+            default=False,
+            help='build database from the files below'
+        )
+    parser.add_argument('--idmap', type=str, required=False, default=None,
+            help='path to intropolis.idmap.v2.hg38.tsv'
+        )
+    parser.add_argument('--run-info', type=str, required=False,
+            default=None,
+            help='path to SraRunInfo.csv'
+        )
+    parser.add_argument('--biosample-tags', type=str, required=False,
+            default=None,
+            help='path to biosample_tags.tsv'
+        )
+    parser.add_argument('--sharq', type=str, required=False, default=None,
+            help='path to sra-all-fields-2015-9-13.txt'
+        )
+    parser.add_argument('--auc', type=str, required=False, default=None,
+            help='path to auc.tsv'
+        )
+    parser.add_argument('--sra-dir', type=str, required=False, default=None,
+            help=('path to SRA output files; this is where the batch_* '
+                  'subdirectories are')
+        )
+    parser.add_argument('--counts-cache', type=str, required=False,
+            default=None,
+            help='.npz file in which to cache counts read from --sra-dir'
+        )
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+            default=1,
+            help='maximum number of processes to run simultaneously'
+        )
+    parser.add_argument('--columns', type=str, required=False, nargs='+',
+            default=['run', 'sample_index', 'project'],
+            help='columns to write'
+        )
+    parser.add_argument('--where', type=str, required=False, nargs='+',
+            default=[],
+            help='conditions of the form COLUMN=VALUE that runs must satisfy'
+        )
+    args = parser.parse_args()
+    if args.build:
+        if args.idmap is None or args.run_info is None:
+            raise RuntimeError(
+                    'Building a database requires --idmap and --run-info.'
+                )
+        build_metadata_db(args.db, args.idmap, args.run_info,
+                            biosample_tags=args.biosample_tags,
+                            sharq=args.sharq, auc=args.auc,
+                            sra_dir=args.sra_dir,
+                            num_processes=args.num_processes,
+                            counts_cache=args.counts_cache)
+        sys.exit(0)
+    where = {}
+    for condition in args.where:
+        column, equals, value = condition.partition('=')
+        if not equals:
+            raise RuntimeError(
+                    'Condition "{}" is not of the form '
+                    'COLUMN=VALUE.'.format(condition)
+                )
+        where[column] = value
+    store = MetadataStore(args.db)
+    for row in store.select(args.columns, **where):
+        print '\t'.join('NA' if value is None else str(value)
+                            for value in row)
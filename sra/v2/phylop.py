@@ -2,83 +2,484 @@
 """
 phylop.py
 
-Computes mean phyloP scores +/- N bases from 3' and 5' splice sites for 
+Computes mean phyloP scores +/- N bases from 3' and 5' splice sites for
 annotated/unannotated junctions in >= K samples.
 
-Requires pyBigWig v0.2.7 (https://github.com/dpryan79/pyBigWig)
+The number of samples in which each splice site appears (its incidence) is
+computed in a single pass over the junctions file. Every (splice site, sample)
+pair is packed into one 64-bit integer, and pairs are deduplicated in NumPy
+arrays. When more pairs accumulate than --max-pairs, deduplicated runs are
+spilled to the temporary directory and merged back range by range, so
+memory stays bounded.
+
+Each chromosome's phyloP track is then memory-mapped from a cache of decoded
+bigWig values written by track_cache.py (see --cache-dir), and windows around
+all of the chromosome's splice sites are gathered and reduced with array
+operations.
+
+--extension and --min-samples each accept several values. Incidences are then
+computed once at the smallest --min-samples, windows are gathered once at the
+largest --extension, and one output file is written per combination.
+
+With -p > 1, chromosomes are scored in parallel, and each worker returns only
+per-incidence sums and counts for annotated/unannotated 5'/3' splice sites.
+
+Requires pyBigWig v0.2.7 (https://github.com/dpryan79/pyBigWig) and NumPy.
 """
 import gzip
+import itertools
+import multiprocessing
 import tempfile
 import atexit
 import shutil
-import multiprocessing
-import glob
-import time
-import itertools
-import shutil
 import sys
 import os
-import subprocess
 from collections import defaultdict
-import math
+import numpy as np
+from track_cache import ensure_cache, TrackCache
 
-def subprocess_wrapper(command):
-    """ Wraps subprocess.check_call so exceptions can be handled cleanly.
+# Bit layout of a packed splice site key, from most to least significant:
+# chromosome index, side (0 for left, 1 for right), strand (0 for +, 1 for -),
+# 1-based position. A (splice site, sample) pair shifts the site key left by
+# _SAMPLE_BITS and stores the sample index in the low bits.
+_POSITION_BITS = 28
+_STRAND_SHIFT = _POSITION_BITS
+_SIDE_SHIFT = _POSITION_BITS + 1
+_CHROM_SHIFT = _POSITION_BITS + 2
+_SAMPLE_BITS = 20
+_CHROM_BITS = 63 - _SAMPLE_BITS - _CHROM_SHIFT
 
-        command: command to run
+def _dedupe_pairs(pairs):
+    """ Sorts and removes duplicates from an array of packed pairs
 
-        Return value: 0 if successful; else error
+        pairs: 1D int64 NumPy array of packed (splice site, sample) pairs
+
+        Return value: sorted, unique 1D int64 NumPy array
     """
-    try:
-        subprocess.check_call(command, shell=True)
-    except subprocess.CalledProcessError as e:
-        return '"{}" returned exit code {}.'.format(command, e.returncode)
-    return 0
+    if not pairs.size:
+        return pairs
+    pairs.sort()
+    keep = np.empty(pairs.size, dtype=bool)
+    keep[0] = True
+    np.not_equal(pairs[1:], pairs[:-1], out=keep[1:])
+    return pairs[keep]
 
-def write_incidence_file(input_file, min_samples, sort_exe):
-    """ Writes number of samples in which each splice site is found
+def _count_sites(pairs):
+    """ Counts distinct samples per splice site from sorted, unique pairs
 
-        input_file: file with coordinate as first field and comma-separated
-            list of sample indexes as second field
+        pairs: sorted, unique 1D int64 NumPy array of packed pairs
+
+        Return value: tuple (sorted array of site keys, array of incidences)
+    """
+    sites = pairs >> _SAMPLE_BITS
+    if not sites.size:
+        return sites, np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(
+            np.concatenate(([True], sites[1:] != sites[:-1]))
+        )
+    return sites[starts], np.diff(np.append(starts, sites.size))
+
+def site_incidences(junction_file, min_samples, temp_dir,
+                    max_pairs=200000000, chunk_pairs=20000000):
+    """ Counts number of samples in which each splice site is found
+
+        A splice site is a (chromosome, side, strand, position) tuple, where
+        side is 'l' for a junction's start position and 'r' for its end
+        position. Sites are returned in order of decreasing incidence.
+
+        junction_file: path to gzipped junctions file with chromosome,
+            start, end, and strand as fields 1-4 and a comma-separated list of
+            sample indexes as field 7; this is intropolis.v2.hg38.tsv.gz
         min_samples: minimum number of samples in which splice site should
-            appear to be analyzed
-        sort_exe: path to sort executable
+            appear to be returned
+        temp_dir: where to spill deduplicated runs of pairs when more than
+            max_pairs are held in memory
+        max_pairs: maximum number of (splice site, sample) pairs to hold in
+            memory at once; each takes 8 bytes
+        chunk_pairs: number of pairs to decode before deduplicating
+
+        Return value: tuple (list of chromosome names, where a chromosome's
+            index in the list is the index packed into a site key; int64
+            NumPy array of site keys; int64 NumPy array of incidences)
+    """
+    chrom_indexes = {}
+    runs, run_files = [], []
+    held_pairs = [0]
+    keys, sample_lists = [], []
+    decoded_pairs = [0]
+
+    def flush_chunk():
+        """ Decodes buffered junctions into a deduplicated run of pairs """
+        if not keys:
+            return
+        samples = np.fromstring(
+                ','.join(sample_lists), dtype=np.int64, sep=','
+            )
+        if samples.size and samples.max() >= (1 << _SAMPLE_BITS):
+            raise RuntimeError(
+                    'Sample index {} does not fit in {} bits.'.format(
+                            samples.max(), _SAMPLE_BITS
+                        )
+                )
+        counts = np.fromiter(
+                (sample_list.count(',') + 1 for sample_list in sample_lists),
+                dtype=np.int64, count=len(sample_lists)
+            )
+        site_keys = np.array(keys, dtype=np.int64).reshape(-1, 2)
+        pairs = np.concatenate([
+                (np.repeat(site_keys[:, 0], counts) << _SAMPLE_BITS)
+                | samples,
+                (np.repeat(site_keys[:, 1], counts) << _SAMPLE_BITS)
+                | samples
+            ])
+        run = _dedupe_pairs(pairs)
+        runs.append(run)
+        held_pairs[0] += run.size
+        del keys[:], sample_lists[:]
+        decoded_pairs[0] = 0
+        if held_pairs[0] > max_pairs:
+            merged = _dedupe_pairs(np.concatenate(runs))
+            if merged.size > max_pairs // 2:
+                # Memory is tight; spill
+                run_file = os.path.join(
+                        temp_dir, 'pairs.{}.npy'.format(len(run_files))
+                    )
+                np.save(run_file, merged)
+                run_files.append(run_file)
+                del runs[:]
+                held_pairs[0] = 0
+            else:
+                runs[:] = [merged]
+                held_pairs[0] = merged.size
+
+    with gzip.open(junction_file) as junction_stream:
+        for k, line in enumerate(junction_stream):
+            if not k % 100000:
+                print >>sys.stderr, (
+                        'Processed {} junctions...\r'.format(k)
+                    ),
+            tokens = line.strip().split('\t')
+            try:
+                chrom_index = chrom_indexes[tokens[0]]
+            except KeyError:
+                chrom_index = chrom_indexes[tokens[0]] = len(chrom_indexes)
+                if chrom_index >= (1 << _CHROM_BITS):
+                    raise RuntimeError(
+                            'Too many chromosomes to pack into site keys.'
+                        )
+            if tokens[3] == '+':
+                site = chrom_index << _CHROM_SHIFT
+            elif tokens[3] == '-':
+                site = (chrom_index << _CHROM_SHIFT) | (1 << _STRAND_SHIFT)
+            else:
+                raise RuntimeError(
+                        'Strand {} is neither + nor -.'.format(tokens[3])
+                    )
+            keys.append(site | int(tokens[1]))
+            keys.append(site | (1 << _SIDE_SHIFT) | int(tokens[2]))
+            sample_lists.append(tokens[6])
+            decoded_pairs[0] += 2 * (tokens[6].count(',') + 1)
+            if decoded_pairs[0] >= chunk_pairs:
+                flush_chunk()
+        flush_chunk()
+    if run_files:
+        print >>sys.stderr, (
+                '\x1b[KMerging {} spilled runs of splice site/sample '
+                'pairs...'
+            ).format(len(run_files))
+        all_runs = [np.load(run_file, mmap_mode='r')
+                        for run_file in run_files] + runs
+        total_pairs = sum(run.size for run in all_runs)
+        # Split the key space at site boundaries so no site straddles parts
+        largest_run = max(all_runs, key=lambda run: run.size)
+        part_count = max(1, -(-total_pairs // max_pairs))
+        bounds = np.unique(
+                largest_run[
+                    np.linspace(
+                        0, largest_run.size, part_count, endpoint=False
+                    ).astype(np.int64)[1:]
+                ] >> _SAMPLE_BITS << _SAMPLE_BITS
+            )
+        bounds = [None] + bounds.tolist() + [None]
+        sites, incidences = [], []
+        for lower, upper in zip(bounds[:-1], bounds[1:]):
+            part = _dedupe_pairs(np.concatenate([
+                    run[
+                        (0 if lower is None
+                            else np.searchsorted(run, lower)):
+                        (run.size if upper is None
+                            else np.searchsorted(run, upper))
+                    ] for run in all_runs
+                ]))
+            part_sites, part_incidences = _count_sites(part)
+            sites.append(part_sites)
+            incidences.append(part_incidences)
+        del all_runs
+        for run_file in run_files:
+            os.remove(run_file)
+        sites = np.concatenate(sites)
+        incidences = np.concatenate(incidences)
+    else:
+        sites, incidences = _count_sites(
+                _dedupe_pairs(np.concatenate(runs)) if runs
+                else np.zeros(0, dtype=np.int64)
+            )
+    qualifying = incidences >= min_samples
+    sites, incidences = sites[qualifying], incidences[qualifying]
+    order = np.argsort(-incidences, kind='mergesort')
+    chroms = [None] * len(chrom_indexes)
+    for chrom, chrom_index in chrom_indexes.items():
+        chroms[chrom_index] = chrom
+    return chroms, sites[order], incidences[order]
+
+def decode_sites(chroms, sites):
+    """ Unpacks splice site keys
+
+        chroms: list of chromosome names as returned by site_incidences()
+        sites: iterable of site keys
+
+        Yield value: tuple (chromosome, 'l' or 'r', '+' or '-', 1-based
+            position)
+    """
+    position_mask = (1 << _POSITION_BITS) - 1
+    for site in sites:
+        site = int(site)
+        yield (chroms[site >> _CHROM_SHIFT],
+                'r' if (site >> _SIDE_SHIFT) & 1 else 'l',
+                '-' if (site >> _STRAND_SHIFT) & 1 else '+',
+                site & position_mask)
+
+def read_annotated_sites(annotation_file):
+    """ Reads annotated 5' and 3' splice sites
+
+        annotation_file: path to annotated_junctions.tsv.gz
+
+        Return value: dictionary mapping each chromosome to a tuple (sorted
+            int64 NumPy array of 0-based annotated 5' splice site positions,
+            sorted int64 NumPy array of 0-based annotated 3' splice site
+            positions)
+    """
+    annotated_5p, annotated_3p = defaultdict(list), defaultdict(list)
+    with gzip.open(annotation_file) as annotated_stream:
+        for line in annotated_stream:
+            tokens = line.strip().split('\t')
+            if tokens[3] == '+':
+                annotated_5p[tokens[0]].append(int(tokens[1]) - 1)
+                annotated_3p[tokens[0]].append(int(tokens[2]) - 1)
+            elif tokens[3] == '-':
+                annotated_3p[tokens[0]].append(int(tokens[1]) - 1)
+                annotated_5p[tokens[0]].append(int(tokens[2]) - 1)
+            else:
+                raise RuntimeError(
+                        'Invalid line in annotation file: "{}".'.format(line)
+                    )
+    return {
+            chrom : (np.unique(np.array(annotated_5p[chrom], dtype=np.int64)),
+                     np.unique(np.array(annotated_3p[chrom], dtype=np.int64)))
+            for chrom in set(annotated_5p) | set(annotated_3p)
+        }
+
+def score_windows(track, anchors, reverse, extension):
+    """ Gathers values in windows around splice sites
+
+        Value j in -extension, ..., extension - 1 of a window is at position
+        anchor + j on the + strand and anchor - j on the - strand.
+
+        track: 1D float32 NumPy array of per-base values for a chromosome
+        anchors: int64 NumPy array of 0-based positions at which to center
+            windows
+        reverse: boolean NumPy array that is True where a window is on the -
+            strand
+        extension: number of bases on either side of anchor to gather
+
+        Return value: float32 NumPy array with one row per anchor and
+            2 * extension columns; values outside the chromosome are NaN
+    """
+    starts = anchors - extension
+    starts[reverse] += 1
+    indexes = starts[:, None] + np.arange(2 * extension)
+    in_bounds = (indexes >= 0) & (indexes < track.shape[0])
+    windows = np.full(indexes.shape, np.nan, dtype=np.float32)
+    windows[in_bounds] = track[indexes[in_bounds]]
+    windows[reverse] = windows[reverse, ::-1]
+    return windows
+
+def score_chromosome(track, sides, strands, positions, levels, annotated,
+                        extension, level_count, chunk_size=200000):
+    """ Sums values around a chromosome's splice sites by incidence level
+
+        track: 1D float32 NumPy array of per-base values for the chromosome
+        sides: boolean NumPy array that is True for right splice sites
+        strands: boolean NumPy array that is True for splice sites on the -
+            strand
+        positions: int64 NumPy array of 0-based splice site positions
+        levels: int64 NumPy array giving each splice site's index among
+            distinct incidences in decreasing order; must be nondecreasing
+        annotated: boolean NumPy array that is True for annotated splice
+            sites
+        extension: number of bases on either side of splice site to study
+        level_count: number of distinct incidences
+        chunk_size: max number of windows to gather at once
+
+        Return value: tuple (sums, counts), where each is a NumPy array of
+            shape (2, 2, level_count, 2 * extension). The first index is
+            0 for unannotated and 1 for annotated splice sites, and the second
+            is 0 for 5' and 1 for 3' splice sites. sums holds summed non-NaN
+            values, and counts holds how many values were summed.
+    """
+    sums = np.zeros((2, 2, level_count, 2 * extension))
+    counts = np.zeros((2, 2, level_count, 2 * extension), dtype=np.int64)
+    # 5' sites are left on the + strand and right on the - strand
+    threep = sides != strands
+    # 3' windows start one base into the exon
+    anchors = positions + np.where(threep, np.where(strands, -1, 1), 0)
+    for start in xrange(0, positions.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        windows = score_windows(
+                track, anchors[chunk], strands[chunk], extension
+            )
+        present = ~np.isnan(windows)
+        windows[~present] = 0
+        for annotated_index in (0, 1):
+            for prime_index in (0, 1):
+                selected = np.flatnonzero(
+                        (annotated[chunk] == annotated_index)
+                        & (threep[chunk] == prime_index)
+                    )
+                if not selected.size:
+                    continue
+                selected_levels = levels[chunk][selected]
+                level_starts = np.flatnonzero(np.concatenate(
+                        ([True],
+                            selected_levels[1:] != selected_levels[:-1])
+                    ))
+                sums[annotated_index, prime_index,
+                        selected_levels[level_starts]] += np.add.reduceat(
+                            windows[selected], level_starts, dtype=np.float64
+                        )
+                counts[annotated_index, prime_index,
+                        selected_levels[level_starts]] += np.add.reduceat(
+                            present[selected], level_starts, dtype=np.int64
+                        )
+    return sums, counts
+
+def score_chromosome_sites(cache_dir, chrom, sites, levels,
+                            annotated_positions, extension, level_count):
+    """ Scores a chromosome's splice sites using a cached track
+
+        Meant to be run in a worker process; only the small sum and count
+        arrays are sent back to the parent.
+
+        cache_dir: directory with cache written by track_cache.py
+        chrom: chromosome name
+        sites: int64 NumPy array of the chromosome's site keys as returned
+            by site_incidences()
+        levels: int64 NumPy array giving each splice site's index among
+            distinct incidences in decreasing order; must be nondecreasing
+        annotated_positions: tuple (sorted int64 NumPy array of 0-based
+            annotated 5' splice site positions, sorted int64 NumPy array of
+            0-based annotated 3' splice site positions) on chrom
+        extension: number of bases on either side of splice site to study
+        level_count: number of distinct incidences
+
+        Return value: tuple (sums, counts) as returned by score_chromosome()
+    """
+    track = TrackCache(cache_dir).track(chrom)
+    sides = ((sites >> _SIDE_SHIFT) & 1).astype(bool)
+    strands = ((sites >> _STRAND_SHIFT) & 1).astype(bool)
+    positions = (sites & ((1 << _POSITION_BITS) - 1)) - 1
+    annotated_5p, annotated_3p = annotated_positions
+    annotated = np.where(
+            sides != strands,
+            np.in1d(positions, annotated_3p),
+            np.in1d(positions, annotated_5p)
+        )
+    return score_chromosome(
+            track, sides, strands, positions, levels, annotated, extension,
+            level_count
+        )
+
+def _score_chromosome_sites_star(task):
+    """ Unpacks arguments to score_chromosome_sites() for Pool.imap """
+    return score_chromosome_sites(*task)
+
+def write_means(output_stream, sums, counts, distinct_incidences):
+    """ Writes mean values around splice sites
+
+        For each distinct incidence K in decreasing order, lines K.3p and
+        K.5p give means over unannotated splice sites found in >= K samples.
+        Lines annotated.3p and annotated.5p give means over all annotated
+        splice sites studied. A pair of lines is omitted if any mean would
+        be undefined.
+
+        output_stream: where to write
+        sums: summed values as returned by score_chromosome()
+        counts: counts as returned by score_chromosome()
+        distinct_incidences: distinct incidences in decreasing order
 
         No return value.
     """
-    try:
-        prefix = '\t'.join(os.path.basename(input_file).split('.')[:-1])
-        with open(
-                input_file
-            ) as input_stream, open(
-                input_file + '.incidence', 'w'
-            ) as output_stream:
-            for key, group in itertools.groupby(
-                            input_stream, key=lambda x: x.split('\t')[0]
-                        ):
-                samples = set()
-                for line in group:
-                    samples.update(line.split('\t')[1].split(','))
-                sample_count = len(samples)
-                if sample_count >= min_samples:
-                    print >>output_stream, '\t'.join(
-                                            [str(len(samples)), prefix, key]
-                                        )
-        subprocess.check_call('{} -T {} -k1,1nr {} >{}'.format(
-                                        sort_exe,
-                                        os.path.dirname(input_file),
-                                        input_file + '.incidence',
-                                        input_file + '.incidence.sorted'
-                                    ), shell=True)
-        os.remove(input_file + '.incidence')
-    except Exception as e:
-        return e.message
-    return 0
+    cumulative_sums = np.cumsum(sums, axis=2)
+    cumulative_counts = np.cumsum(counts, axis=2)
+    labels = [str(incidence) for incidence in distinct_incidences]
+    rows = [(labels[i], cumulative_sums[0, :, i], cumulative_counts[0, :, i])
+                for i in xrange(len(labels))]
+    if labels:
+        rows.append(('annotated', cumulative_sums[1, :, -1],
+                                    cumulative_counts[1, :, -1]))
+    for label, row_sums, row_counts in rows:
+        if not row_counts.all():
+            continue
+        for prime_index, suffix in [(1, '.3p'), (0, '.5p')]:
+            print >>output_stream, '\t'.join([label + suffix] + [
+                    str(float(value) / count) for value, count in zip(
+                            row_sums[prime_index].tolist(),
+                            row_counts[prime_index].tolist()
+                        )
+                ])
+
+def write_sweep(out, sums, counts, distinct_incidences, extensions,
+                    min_samples):
+    """ Writes one file of mean values per parameter combination
+
+        sums and counts must cover the widest extension and the smallest
+        min_samples; every narrower window and higher threshold is sliced
+        from them.
+
+        out: output path if there is only one combination; otherwise,
+            basename to which '.extension_[E].min_samples_[K]' is appended
+        sums: summed values as returned by score_chromosome()
+        counts: counts as returned by score_chromosome()
+        distinct_incidences: distinct incidences in decreasing order
+        extensions: list of numbers of bases on either side of splice site
+        min_samples: list of min numbers of samples in which splice site
+            should appear to be analyzed
+
+        No return value.
+    """
+    widest = max(extensions)
+    for extension, min_sample_count in itertools.product(
+                sorted(set(extensions)), sorted(set(min_samples))
+            ):
+        if len(set(extensions)) == 1 and len(set(min_samples)) == 1:
+            out_file = out
+        else:
+            out_file = '{}.extension_{}.min_samples_{}'.format(
+                    out, extension, min_sample_count
+                )
+        level_count = sum(incidence >= min_sample_count
+                            for incidence in distinct_incidences)
+        window = slice(widest - extension, widest + extension)
+        with open(out_file, 'w') as output_stream:
+            write_means(output_stream,
+                        sums[:, :, :level_count, window],
+                        counts[:, :, :level_count, window],
+                        distinct_incidences[:level_count])
 
 if __name__ == '__main__':
     import argparse
     # Print file's docstring if -h is invoked
-    parser = argparse.ArgumentParser(description=__doc__, 
+    parser = argparse.ArgumentParser(description=__doc__,
                 formatter_class=argparse.RawDescriptionHelpFormatter)
     # Add command-line arguments
     parser.add_argument('--junctions', type=str, required=True,
@@ -100,304 +501,92 @@ if __name__ == '__main__':
     parser.add_argument('--out', type=str, required=True,
             help='output basename'
         )
-    parser.add_argument('--sort', type=str, required=False,
-            help='path to sort executable'
-        )
     parser.add_argument('-p', '--num-processes', type=int, required=False,
             default=1,
             help='maximum number of processes to run simultaneously'
         )
     parser.add_argument('--extension', type=int, required=False,
-            default=50,
-            help='number of bases on either side of splice site to study'
+            default=[50], nargs='+',
+            help=('number of bases on either side of splice site to study; '
+                  'specify more than one to write one output file per value')
         )
     parser.add_argument('--min-samples', type=int, required=False,
-            default=100,
+            default=[100], nargs='+',
             help=('min number of sample in which splice site should appear to '
-                  'be analyzed')
+                  'be analyzed; specify more than one to write one output '
+                  'file per value')
+        )
+    parser.add_argument('--max-pairs', type=int, required=False,
+            default=200000000,
+            help=('max number of (splice site, sample) pairs to hold in '
+                  'memory while computing splice site incidences; each takes '
+                  '8 bytes, and more are spilled to --temp-dir')
+        )
+    parser.add_argument('--cache-dir', type=str, required=False,
+            default=None,
+            help=('directory with values of --phylop-bw decoded by '
+                  'track_cache.py; it is built here if it is missing or '
+                  'stale. If unspecified, values are decoded to --temp-dir '
+                  'and discarded')
         )
     args = parser.parse_args()
     temp_dir = tempfile.mkdtemp(dir=args.temp_dir)
-    #atexit.register(shutil.rmtree, temp_dir, ignore_errors=True)
+    atexit.register(shutil.rmtree, temp_dir, ignore_errors=True)
     # First count number of samples in which each splice site is found
-    handles = {}
-    print >>sys.stderr, '\x1b[KDistributing splice sites across tasks...'
-    try:
-        with gzip.open(args.junctions) as junction_stream:
-            for k, line in enumerate(junction_stream):
-                print >>sys.stderr, (
-                        'Processed {} junctions...\r'.format(k)
-                    ),
-                tokens = line.strip().split('\t')
-                strand = tokens[3]
-                for left_or_right, index in [('l', 1), ('r', 2)]:
-                    try:
-                        print >>handles[(tokens[0], left_or_right
-                                                    + strand)], '\t'.join(
-                                                    [tokens[index],
-                                                        tokens[6]]
-                                                )
-                    except KeyError:
-                        handles[(tokens[0], left_or_right
-                                            + strand)] = open(
-                                            os.path.join(temp_dir,
-                                                    '.'.join([
-                                                        tokens[0],
-                                                        left_or_right,
-                                                        strand,
-                                                        'unsorted'
-                                                ])
-                                            ), 'w'
-                                        )
-                        print >>handles[(tokens[0], left_or_right
-                                                    + strand)], '\t'.join(
-                                                    [tokens[index],
-                                                        tokens[6]]
-                                                )
-    finally:
-        for handle in handles:
-            handles[handle].close()
-    pool = multiprocessing.Pool(args.num_processes)
-    return_values = []
-    to_sort = glob.glob(os.path.join(temp_dir, '*.unsorted'))
-    total_files = len(to_sort)
-    for unsorted_file in to_sort:
-        pool.apply_async(
-                subprocess_wrapper,
-                args=(
-                    '{sort_exe} -T {temp_dir} -k1,1 {unsorted} >{dest}'.format(
-                        sort_exe=args.sort,
-                        temp_dir=temp_dir,
-                        unsorted=unsorted_file,
-                        dest='.'.join(
-                                unsorted_file.split('.')[:-1] + ['sorted']
-                            )
-                    ),), callback=return_values.append
-            )
-    print >>sys.stderr, '\x1b[KDone. Sorting tasks...'
-    while len(return_values) < total_files:
-        print >>sys.stderr, '\x1b[K{}/{} tasks complete.\r'.format(
-                len(return_values),
-                total_files
-            ),
-        if not all([return_value == 0 for return_value in return_values]):
-            for return_value in return_values:
-                if return_value != 0:
-                    raise RuntimeError('Error during sorting: "{}".'.format(
-                                                return_value
-                                            ))
-        time.sleep(4)
-    if not all([return_value == 0 for return_value in return_values]):
-        for return_value in return_values:
-            if return_value != 0:
-                raise RuntimeError('Error during sorting: "{}".'.format(
-                                            return_value
-                                        ))
-    for unsorted_file in to_sort:
-        os.remove(unsorted_file)
-    print >>sys.stderr, (
-            '\x1b[KCompleted sorting. Computing splice site incidences...'
+    print >>sys.stderr, '\x1b[KComputing splice site incidences...'
+    chroms, sites, incidences = site_incidences(
+            args.junctions, min(args.min_samples), temp_dir,
+            max_pairs=args.max_pairs
         )
-    return_values = []
-    to_incidence = glob.glob(os.path.join(temp_dir, '*.sorted'))
-    total_files = len(to_incidence)
-    for sorted_file in to_incidence:
-        pool.apply_async(
-                write_incidence_file,
-                args=(sorted_file, args.min_samples, args.sort),
-                callback=return_values.append
-            )
-    while len(return_values) < total_files:
-        print >>sys.stderr, '\x1b[K{}/{} tasks complete.\r'.format(
-                len(return_values),
-                total_files
-            ),
-        if not all([return_value == 0 for return_value in return_values]):
-            for return_value in return_values:
-                if return_value != 0:
-                    raise RuntimeError('Error during incidence computation: '
-                                       '"{}".'.format(
-                                                return_value
-                                            ))
-        time.sleep(4)
-    if not all([return_value == 0 for return_value in return_values]):
-        for return_value in return_values:
-            if return_value != 0:
-                raise RuntimeError('Error during incidence computation: '
-                                   '"{}".'.format(
-                                            return_value
-                                        ))
-    pool.close()
-    pool.join()
-    allincidence = os.path.join(temp_dir, 'allincidence.temp')
-    print >>sys.stderr, '\x1b[KDone. Merging splice site incidence files...'
-    subprocess.check_call('{} -T {} -m -k1,1nr {} >{}'.format(
-                                args.sort,
-                                temp_dir,
-                                os.path.join(temp_dir, '*.incidence.sorted'),
-                                os.path.join(temp_dir, 'allincidence.temp')
-                            ), shell=True)
     print >>sys.stderr, '\x1b[KDone. Reading annotated splice sites...'
-    annotated_5p = set()
-    annotated_3p = set()
-    with gzip.open(args.annotation) as annotated_stream:
-        for line in annotated_stream:
-            tokens = line.strip().split('\t')
-            if tokens[3] == '+':
-                annotated_5p.add((tokens[0], int(tokens[1]) - 1))
-                annotated_3p.add((tokens[0], int(tokens[2]) - 1))
-            elif tokens[3] == '-':
-                annotated_3p.add((tokens[0], int(tokens[1]) - 1))
-                annotated_5p.add((tokens[0], int(tokens[2]) - 1))
-            else:
-                raise RuntimeError(
-                        'Invalid line in annotation file: "{}".'.format(line)
-                    )
-    unannotated_fivep_splice_site_counts = defaultdict(int)
-    unannotated_threep_splice_site_counts = defaultdict(int)
-    annotated_fivep_splice_site_counts = defaultdict(int)
-    annotated_threep_splice_site_counts = defaultdict(int)
-    from bx.bbi.bigwig_file import BigWigFile
-    bw = BigWigFile(open(args.phylop_bw, 'rb'))
+    annotated_sites = read_annotated_sites(args.annotation)
+    distinct_incidences, levels = np.unique(-incidences, return_inverse=True)
+    distinct_incidences = (-distinct_incidences).tolist()
+    chrom_indexes = sites >> _CHROM_SHIFT
+    extension = max(args.extension)
+    sums = np.zeros((2, 2, len(distinct_incidences), 2 * extension))
+    counts = np.zeros(sums.shape, dtype=np.int64)
+    cache = ensure_cache(
+            args.phylop_bw,
+            args.cache_dir or os.path.join(temp_dir, 'track_cache'),
+            num_processes=args.num_processes
+        )
+    chrom_sizes = cache.chroms()
     print >>sys.stderr, '\x1b[KDone. Computing/writing matrix elements...'
-    with open(
-            allincidence
-        ) as incidence_stream, open(
-            args.out, 'w'
-        ) as output_stream:
-        unannotated_line_counts = defaultdict(int)
-        annotated_line_counts = defaultdict(int)
-        splice_sites = 0
-        for key, group in itertools.groupby(
-                                incidence_stream, lambda x: x.split('\t')[0]
-                            ):
-            for line in group:
-                print >>sys.stderr, (
-                        'Processed {} splice sites...\r'.format(
-                                                                splice_sites
-                                                            )
-                    ),
-                splice_sites += 1
-                tokens = line.strip().split('\t')
-                _, chrom, left_or_right, strand, coordinate = tokens
-                coordinate = int(coordinate) - 1
-                if (left_or_right == 'l' and strand == '+'
-                    or left_or_right == 'r' and strand == '-'):
-                    # 5' site
-                    if (chrom, coordinate) in annotated_5p:
-                        fivep_splice_site_counts = (
-                                annotated_fivep_splice_site_counts
-                            )
-                        line_counts = annotated_line_counts
-                    else:
-                        fivep_splice_site_counts = (
-                                unannotated_fivep_splice_site_counts
-                            )
-                        line_counts = unannotated_line_counts
-                    if strand == '+':
-                        bwvals = bw.get_as_array(
-                                    chrom,
-                                    coordinate - args.extension,
-                                    coordinate + args.extension
-                                )
-                        if bwvals is None:
-                            continue
-                        for i, j in enumerate(
-                                        xrange(-args.extension, args.extension)
-                                    ):
-                            if not math.isnan(bwvals[i]):
-                                fivep_splice_site_counts[j] += bwvals[i]
-                                line_counts[j] += 1
-                    elif strand == '-':
-                        bwvals = bw.get_as_array(
-                                    chrom,
-                                    coordinate - (args.extension - 1),
-                                    coordinate + (args.extension + 1)
-                                )
-                        if bwvals is None:
-                            continue
-                        for i, j in enumerate(
-                                        xrange(-args.extension, args.extension)
-                                    ):
-                            if not math.isnan(bwvals[-i-1]):
-                                fivep_splice_site_counts[j] += bwvals[-i-1]
-                                line_counts[j] += 1
-                    else:
-                        raise RuntimeError(
-                                'Strand {} is neither + nor -.'.format(
-                                        strand
-                                    )
-                            )
-                else:
-                    # 3' site
-                    if (chrom, coordinate) in annotated_3p:
-                        threep_splice_site_counts = (
-                                annotated_threep_splice_site_counts
-                            )
-                        line_counts = annotated_line_counts
-                    else:
-                        threep_splice_site_counts = (
-                                unannotated_threep_splice_site_counts
-                            )
-                        line_counts = unannotated_line_counts
-                    if strand == '+':
-                        bwvals = bw.get_as_array(
-                                    chrom,
-                                    coordinate - (args.extension - 1),
-                                    coordinate + (args.extension + 1)
-                                )
-                        if bwvals is None:
-                            continue
-                        for i, j in enumerate(
-                                        xrange(-args.extension, args.extension)
-                                    ):
-                            if not math.isnan(bwvals[i]):
-                                threep_splice_site_counts[j] += bwvals[i]
-                                line_counts[j] += 1
-                    elif strand == '-':
-                        bwvals = bw.get_as_array(
-                                    chrom,
-                                    coordinate - args.extension,
-                                    coordinate + args.extension
-                                )
-                        if bwvals is None:
-                            continue
-                        for i, j in enumerate(
-                                        xrange(-args.extension, args.extension)
-                                    ):
-                            if not math.isnan(bwvals[-i-1]):
-                                threep_splice_site_counts[j] += bwvals[-i-1]
-                                line_counts[j] += 1
-            # Print only if we won't get a ZeroDivisionError
-            try:
-                print >>output_stream, '\t'.join([key + '.3p'] + [
-                            str(float(unannotated_threep_splice_site_counts[i])
-                                / unannotated_line_counts[i])
-                        for i in xrange(
-                            -args.extension, args.extension
-                        )])
-                print >>output_stream, '\t'.join([key + '.5p'] + [
-                            str(float(unannotated_fivep_splice_site_counts[i])
-                                / unannotated_line_counts[i])
-                        for i in xrange(
-                            -args.extension, args.extension
-                        )])
-            except ZeroDivisionError:
-                pass
-        try:
-            # Print only if we won't get a ZeroDivisionError
-            print >>output_stream, '\t'.join(['annotated.3p'] + [
-                        str(float(annotated_threep_splice_site_counts[i])
-                             / annotated_line_counts[i])
-                    for i in xrange(
-                        -args.extension, args.extension
-                    )])
-            print >>output_stream, '\t'.join(['annotated.5p'] + [
-                        str(float(annotated_fivep_splice_site_counts[i])
-                            / annotated_line_counts[i])
-                    for i in xrange(
-                        -args.extension, args.extension
-                    )])
-        except ZeroDivisionError:
-            pass
+    tasks = []
+    for chrom_index, chrom in enumerate(chroms):
+        if chrom not in chrom_sizes:
+            continue
+        on_chrom = np.flatnonzero(chrom_indexes == chrom_index)
+        if not on_chrom.size:
+            continue
+        tasks.append((
+                cache.cache_dir, chrom, sites[on_chrom], levels[on_chrom],
+                annotated_sites.get(
+                    chrom, (np.zeros(0, dtype=np.int64),) * 2
+                ), extension, len(distinct_incidences)
+            ))
+    if args.num_processes > 1:
+        pool = multiprocessing.Pool(args.num_processes)
+        results = pool.imap(_score_chromosome_sites_star, tasks)
+    else:
+        pool = None
+        results = itertools.imap(_score_chromosome_sites_star, tasks)
+    try:
+        # Merge in chromosome order so floating-point sums do not depend on
+        # number of processes
+        for k, (chrom_sums, chrom_counts) in enumerate(results):
+            sums += chrom_sums
+            counts += chrom_counts
+            print >>sys.stderr, (
+                    '\x1b[K{}/{} chromosomes scored.\r'.format(
+                            k + 1, len(tasks)
+                        )
+                ),
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    write_sweep(args.out, sums, counts, distinct_incidences,
+                args.extension, args.min_samples)
     print >>sys.stderr, '\x1b[KDone.'
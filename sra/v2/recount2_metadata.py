@@ -31,11 +31,14 @@ We ran
         >recount2_metadata.tsv
 
 Above, --sra-dir is the path to the directory with the batch_* subdirs.
+
+Specify --incomplete to also write the output of incomplete.py, which is the
+first 9 fields of the runs for which Rail did not align all reads, from the
+same read of the counts.tsv.gz files; sort it as above.
 """
-import os
-import csv
-import gzip
 from collections import defaultdict
+from metadata_db import default_store
+from batch_counts import read_batch_counts, reconcile_read_count
 
 if __name__ == '__main__':
     import argparse
@@ -44,71 +47,49 @@ if __name__ == '__main__':
     parser.add_argument('--sra-dir', required=True,
         help='path to SRA output files; this is where the batch_* '
              'subdirectories are')
+    parser.add_argument('--metadata-db', required=False, default=None,
+        help='metadata database built by metadata_db.py; it is built from '
+             'SraRunInfo.csv and the other metadata files in this '
+             'directory and its hg38 subdirectory if it does not exist '
+             'or any of them has changed; auc.tsv, biosample_tags.tsv, and '
+             'the SHARQ metadata must exist')
+    parser.add_argument('--counts-cache', required=False, default=None,
+        help='.npz file in which batch_counts.py caches read counts from '
+             'counts.tsv.gz files')
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+        default=1,
+        help='maximum number of processes reading counts.tsv.gz files '
+             'simultaneously')
+    parser.add_argument('--incomplete', required=False, default=None,
+        help='also write output of incomplete.py, unsorted, to this file')
     args = parser.parse_args()
-    containing_dir = os.path.dirname(os.path.realpath(__file__))
-    # Get mappings from srs to srr
-    srs_to_srr = defaultdict(list)
-    with open(os.path.join(containing_dir,
-                            'intropolis.idmap.v2.hg38.tsv')) as idmap_stream:
-        for line in idmap_stream:
-            tokens = line.strip().split('\t')
-            srs_to_srr[tokens[2]].append(tokens[4])
-    srr_to_submission_date = defaultdict(lambda: 'NA')
-    srr_to_publication_date = defaultdict(lambda: 'NA')
-    srr_to_update_date = defaultdict(lambda: 'NA')
-    # Get dates from biosample
-    with open(os.path.join(containing_dir,
-                            'hg38', 'biosample_tags.tsv')) as biosample_stream:
-        biosample_stream.readline()
-        for line in biosample_stream:
-            tokens = line.strip().split('\t')
-            for srr in srs_to_srr[tokens[9]]:
-                srr_to_submission_date[srr] = tokens[10]
-                srr_to_publication_date[srr] = tokens[11]
-                srr_to_update_date[srr] = tokens[12]
-    srr_to_tissue, srr_to_cell_type =  (defaultdict(lambda: 'NA'),
-                                            defaultdict(lambda: 'NA'))
-    with open(os.path.join(containing_dir,
-                            'sra-all-fields-2015-9-13.txt')) as sharq_stream:
-        sharq_stream.readline()
-        sharq_reader = csv.reader(sharq_stream, delimiter=',', quotechar='"')
-        for tokens in sharq_reader:
-            srr_to_tissue[tokens[0]] = tokens[5]
-            srr_to_cell_type[tokens[0]] = tokens[6]
-    srr_to_auc = defaultdict(lambda: 'NA')
-    with open(os.path.join(containing_dir, 'auc.tsv')) as auc_stream:
-        for line in auc_stream:
-            tokens = line.strip().split('\t')
-            srr_to_auc[tokens[0].split('.')[0]] = str(
-                            int(float(tokens[1].strip()))
-                        )
-    srr_to_read_count = {}
-    srr_to_line = {}
-    srr_to_paired_status = {}
-    srr_to_gsm = defaultdict(lambda: 'NA')
-    with open(os.path.join(containing_dir, 'hg38',
-                            'SraRunInfo.csv')) as run_stream:
-        run_stream.readline()
-        run_reader = csv.reader(run_stream, delimiter=',', quotechar='"')
-        for tokens in run_reader:
-            if not tokens or (len(tokens) == 1 and tokens[0] == ''): continue
-            srr_to_line[tokens[0]] = '\t'.join(
-                    [tokens[20], tokens[24], tokens[10], tokens[0]]
-                )
-            if tokens[29]:
-                srr_to_gsm[tokens[0]] = tokens[29]
-            if tokens[15] == 'PAIRED':
-                srr_to_read_count[tokens[0]] = int(tokens[3]) * 2
-                srr_to_paired_status[tokens[0]] = '1'
-            elif tokens[15] == 'SINGLE':
-                srr_to_read_count[tokens[0]] = int(tokens[3])
-                srr_to_paired_status[tokens[0]] = '0'
-            else:
-                raise RuntimeError(
-                        'Fail: {} is neither SINGLE nor PAIRED'.format(
-                                                                    tokens[15]
-                                                                )
-                    )
+    store = default_store(args.metadata_db,
+                            required=['biosample_tags', 'sharq', 'auc'])
+    srr_to_read_count, srr_to_line, srr_to_paired_status = {}, {}, {}
+    (srr_to_gsm, srr_to_tissue, srr_to_cell_type, srr_to_auc,
+        srr_to_submission_date, srr_to_publication_date,
+        srr_to_update_date) = [defaultdict(lambda: 'NA') for _ in xrange(7)]
+    for (run, project, sample, experiment, read_count, paired, gsm, tissue,
+            cell_type, auc, submission_date, publication_date,
+            update_date) in store.select(
+                ['run', 'project', 'sample', 'experiment', 'read_count',
+                    'paired', 'gsm', 'tissue', 'cell_type', 'auc',
+                    'submission_date', 'publication_date', 'update_date']
+            ):
+        srr_to_line[run] = '\t'.join([project, sample, experiment, run])
+        srr_to_read_count[run] = read_count
+        srr_to_paired_status[run] = str(paired)
+        for srr_to_value, value in [
+                (srr_to_gsm, gsm), (srr_to_tissue, tissue),
+                (srr_to_cell_type, cell_type),
+                (srr_to_submission_date, submission_date),
+                (srr_to_publication_date, publication_date),
+                (srr_to_update_date, update_date)
+            ]:
+            if value is not None:
+                srr_to_value[run] = value
+        if auc is not None:
+            srr_to_auc[run] = str(int(auc))
     print '\t'.join(['project', 'sample', 'experiment', 'run',
                         'read count as reported by SRA', 'reads aligned',
                         'proportion of reads reported by SRA aligned',
@@ -118,49 +99,34 @@ if __name__ == '__main__':
                         'Biosample submission date',
                         'Biosample publication date',
                         'Biosample update date', 'GSM'])
-    srr_to_mapped_reads = defaultdict(int)
-    for i in xrange(100):
-        with gzip.open(
-                os.path.join(args.sra_dir,
-                                'batch_{}'.format(i),
-                                'cross_sample_results',
-                                'counts.tsv.gz')
-            ) as count_stream:
-            count_stream.readline()
-            for line in count_stream:
-                srr = line.partition('\t')[0]
-                tokens = line.strip().split('\t')
-                read_count = int(tokens[-1].partition(',')[0])
-                srr_to_mapped_reads[srr] = int(tokens[-2].partition(',')[0])
-                mislabeled = False
-                try:
-                    ratio = float(read_count) / srr_to_read_count[srr]
-                    if ratio > 1:
-                        '''Mislabeled sample; whp recorded as SINGLE
-                        when PAIRED'''
-                        srr_to_read_count[srr] *= 2
-                        ratio = float(read_count) / srr_to_read_count[srr]
-                        srr_to_paired_status[srr] = '1'
-                        mislabeled = True
-                    elif ratio == 0.5:
-                        '''Mislabeled sample; whp recorded as PAIRED
-                        when SINGLE'''
-                        srr_to_read_count[srr] /= 2
-                        ratio = float(read_count) / srr_to_read_count[srr]
-                        srr_to_paired_status[srr] = '0'
-                        mislabeled = True
-                except ZeroDivisionError:
-                    ratio = 'NA'
-                print '\t'.join(map(str, [srr_to_line[srr],
-                                    srr_to_read_count[srr],
-                                    read_count, ratio,
-                                    srr_to_paired_status[srr],
-                                    '1' if mislabeled
-                                    else '0', srr_to_mapped_reads[srr],
-                                    srr_to_auc[srr],
-                                    srr_to_tissue[srr],
-                                    srr_to_cell_type[srr],
-                                    srr_to_submission_date[srr],
-                                    srr_to_publication_date[srr],
-                                    srr_to_update_date[srr],
-                                    srr_to_gsm[srr]]))
+    incomplete_header = [
+            'project', 'sample', 'experiment', 'run',
+            'read count as reported by SRA', 'reads aligned',
+            'proportion of reads reported by SRA aligned', 'paired-end',
+            'SRA misreported paired-end'
+        ]
+    if args.incomplete is not None:
+        incomplete_stream = open(args.incomplete, 'w')
+        print >>incomplete_stream, '\t'.join(incomplete_header)
+    for srr, read_count, mapped_read_count in read_batch_counts(
+                args.sra_dir, batch_count=100,
+                num_processes=args.num_processes, cache=args.counts_cache
+            ):
+        sra_read_count, ratio, paired, mislabeled = reconcile_read_count(
+                srr_to_read_count[srr], srr_to_paired_status[srr], read_count
+            )
+        fields = [srr_to_line[srr], sra_read_count, read_count, ratio,
+                    paired, '1' if mislabeled else '0']
+        print '\t'.join(map(str, fields + [
+                                mapped_read_count,
+                                srr_to_auc[srr],
+                                srr_to_tissue[srr],
+                                srr_to_cell_type[srr],
+                                srr_to_submission_date[srr],
+                                srr_to_publication_date[srr],
+                                srr_to_update_date[srr],
+                                srr_to_gsm[srr]]))
+        if args.incomplete is not None and read_count != sra_read_count:
+            print >>incomplete_stream, '\t'.join(map(str, fields))
+    if args.incomplete is not None:
+        incomplete_stream.close()
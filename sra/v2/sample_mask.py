@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+sample_mask.py
+
+Boolean masks over sample indexes for running analyses on filtered views of
+a junctions file like intropolis.v2.hg38.tsv.gz without writing filtered
+copies of it.
+
+A SampleMask starts with every sample in an id map such as
+intropolis.idmap.v2.hg38.tsv kept and is narrowed by any combination of
+
+1. exclusion lists: files like incomplete.tsv or hg38/excluded.txt from which
+    every run accession number ([SED]RR followed by digits) is read;
+2. project lists: projects to keep or to exclude;
+3. predicates: functions of a sample's (index, project, sample, experiment,
+    run) accession numbers, or boolean arrays over sample indexes.
+
+The mask is then applied while junctions are decoded: masked_junctions()
+yields each junction's sample indexes and coverages as NumPy arrays with
+masked samples dropped, skipping junctions left without samples.
+
+Run this script to write a mask as a .npy file, which load_mask() reads, and
+a summary of the samples kept to stderr.
+"""
+import itertools
+import re
+import sys
+import numpy as np
+
+_run_pattern = re.compile(r'\b[SED]RR\d+\b')
+
+def read_runs(run_file):
+    """ Reads run accession numbers from a list or table
+
+        The first run accession number on each line is read, so both plain
+        lists like hg38/excluded.txt and tables like incomplete.tsv may be
+        passed; lines without one, such as headers, are ignored.
+
+        run_file: path to file
+
+        Return value: set of run accession numbers
+    """
+    runs = set()
+    with open(run_file) as run_stream:
+        for line in run_stream:
+            match = _run_pattern.search(line)
+            if match is not None:
+                runs.add(match.group(0))
+    return runs
+
+class SampleMask(object):
+    """ Boolean mask over sample indexes of an id map.
+
+        Methods that narrow the mask return the SampleMask so calls can be
+        chained.
+    """
+
+    def __init__(self, idmap):
+        """
+            idmap: path to id map with sample index, project, sample,
+                experiment, and run accession numbers as tab-separated
+                fields; this is intropolis.idmap.v2.hg38.tsv
+        """
+        rows = []
+        with open(idmap) as idmap_stream:
+            for line in idmap_stream:
+                tokens = line.strip().split('\t')
+                rows.append((int(tokens[0]),) + tuple(tokens[1:5]))
+        self.sample_count = max(row[0] for row in rows) + 1
+        self.accessions = [None] * self.sample_count
+        self.projects = np.empty(self.sample_count, dtype=object)
+        self.runs = np.empty(self.sample_count, dtype=object)
+        for row in rows:
+            self.accessions[row[0]] = row
+            self.projects[row[0]] = row[1]
+            self.runs[row[0]] = row[4]
+        # Indexes absent from the id map are never kept
+        self.mask = np.zeros(self.sample_count, dtype=bool)
+        self.mask[[row[0] for row in rows]] = True
+
+    def exclude_runs(self, runs):
+        """ Excludes samples by run accession number
+
+            runs: iterable of run accession numbers
+
+            Return value: this SampleMask
+        """
+        self.mask &= ~np.in1d(self.runs, list(runs))
+        return self
+
+    def exclude_run_file(self, run_file):
+        """ Excludes samples whose runs are read from a file by read_runs()
+
+            run_file: path to file
+
+            Return value: this SampleMask
+        """
+        return self.exclude_runs(read_runs(run_file))
+
+    def keep_projects(self, projects):
+        """ Excludes samples outside projects
+
+            projects: iterable of project accession numbers
+
+            Return value: this SampleMask
+        """
+        self.mask &= np.in1d(self.projects, list(projects))
+        return self
+
+    def exclude_projects(self, projects):
+        """ Excludes samples in projects
+
+            projects: iterable of project accession numbers
+
+            Return value: this SampleMask
+        """
+        self.mask &= ~np.in1d(self.projects, list(projects))
+        return self
+
+    def require(self, predicate):
+        """ Excludes samples not satisfying a predicate
+
+            predicate: boolean array over sample indexes, or function that
+                takes a tuple (sample index, project, sample, experiment,
+                run) and returns True if the sample should be kept
+
+            Return value: this SampleMask
+        """
+        if callable(predicate):
+            predicate = np.fromiter(
+                    (accessions is not None and bool(predicate(accessions))
+                        for accessions in self.accessions),
+                    dtype=bool, count=self.sample_count
+                )
+        self.mask &= np.asarray(predicate, dtype=bool)
+        return self
+
+    def kept(self):
+        """ Return value: NumPy array of indexes of kept samples """
+        return np.flatnonzero(self.mask)
+
+    def save(self, mask_file):
+        """ Writes mask to a .npy file
+
+            mask_file: path to file
+
+            No return value.
+        """
+        np.save(mask_file, self.mask)
+
+def load_mask(mask_file):
+    """ Reads a mask written by SampleMask.save()
+
+        mask_file: path to .npy file
+
+        Return value: boolean NumPy array over sample indexes
+    """
+    return np.load(mask_file)
+
+def apply_mask(mask, sample_counts, samples, coverages):
+    """ Drops masked samples from decoded junctions
+
+        mask: boolean NumPy array over sample indexes; True means keep
+        sample_counts: NumPy array of number of samples of each junction
+        samples: NumPy array of concatenated sample indexes of junctions
+        coverages: NumPy array of coverages corresponding to samples
+
+        Return value: tuple (boolean NumPy array, one per junction, that is
+            True if any of the junction's samples are kept; number of kept
+            samples of each of those junctions; kept sample indexes;
+            coverages of kept samples)
+    """
+    if samples.size and samples.max() >= mask.size:
+        raise RuntimeError(
+                'Sample index {} is not covered by the mask.'.format(
+                        samples.max()
+                    )
+            )
+    kept = mask[samples]
+    junctions = np.repeat(np.arange(sample_counts.size), sample_counts)
+    kept_counts = np.bincount(
+            junctions[kept], minlength=sample_counts.size
+        )
+    nonempty = kept_counts > 0
+    return nonempty, kept_counts[nonempty], samples[kept], coverages[kept]
+
+def masked_junctions(junction_stream, mask, chunk_size=100000):
+    """ Decodes junctions, dropping masked samples
+
+        junction_stream: iterable over lines of junctions file with a
+            comma-separated list of sample indexes as field 7 and a
+            comma-separated list of coverages as field 8
+        mask: boolean NumPy array over sample indexes; True means keep
+        chunk_size: number of junctions to decode at once
+
+        Yield value: tuple (list of fields 1-6 of junction, NumPy array of
+            kept sample indexes, NumPy array of their coverages); junctions
+            without kept samples are skipped
+    """
+    while True:
+        chunk = [line.rstrip('\n').split('\t')
+                    for line in itertools.islice(junction_stream, chunk_size)]
+        if not chunk:
+            break
+        sample_counts = np.fromiter(
+                (tokens[6].count(',') + 1 for tokens in chunk),
+                dtype=np.int64, count=len(chunk)
+            )
+        nonempty, kept_counts, samples, coverages = apply_mask(
+                mask, sample_counts,
+                np.fromstring(','.join([tokens[6] for tokens in chunk]),
+                                dtype=np.int64, sep=','),
+                np.fromstring(','.join([tokens[7] for tokens in chunk]),
+                                dtype=np.int64, sep=',')
+            )
+        bounds = np.cumsum(kept_counts)[:-1]
+        for junction, junction_samples, junction_coverages in zip(
+                np.flatnonzero(nonempty), np.split(samples, bounds),
+                np.split(coverages, bounds)
+            ):
+            yield chunk[junction][:6], junction_samples, junction_coverages
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--idmap', type=str, required=True,
+            help=('map from sample indexes to SRA accession numbers; this '
+                  'should be intropolis.idmap.v2.hg38.tsv')
+        )
+    parser.add_argument('--exclude', type=str, required=False, nargs='+',
+            default=[],
+            help=('files listing runs to exclude, such as incomplete.tsv and '
+                  'hg38/excluded.txt')
+        )
+    parser.add_argument('--projects', type=str, required=False, nargs='+',
+            default=None,
+            help='projects to keep; by default, all projects are kept'
+        )
+    parser.add_argument('--exclude-projects', type=str, required=False,
+            nargs='+', default=[],
+            help='projects to exclude'
+        )
+    parser.add_argument('--out', type=str, required=True,
+            help='.npy file to which to write mask'
+        )
+    args = parser.parse_args()
+    sample_mask = SampleMask(args.idmap)
+    for exclude_file in args.exclude:
+        sample_mask.exclude_run_file(exclude_file)
+    if args.projects is not None:
+        sample_mask.keep_projects(args.projects)
+    sample_mask.exclude_projects(args.exclude_projects)
+    sample_mask.save(args.out)
+    kept = sample_mask.kept()
+    print >>sys.stderr, 'Kept {} samples from {} projects.'.format(
+            kept.size, len(set(sample_mask.projects[kept]))
+        )
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+track_cache.py
+
+Decodes a bigWig once into per-chromosome NumPy .npy files that per-base
+scoring code like phylop.py memory-maps. Output directory contains:
+
+manifest.json
+1. path, size, and mtime of source bigWig; a cache whose source no longer
+    matches is rebuilt by ensure_cache()
+2. dtype of stored values (float16 or float32)
+3. chromosome lengths and .npy file names
+
+[chromosome].npy
+Values at every 0-based position of the chromosome; positions without a
+value are NaN
+
+Since the cache is read through read-only memory maps, concurrent analyses
+share its pages.
+
+Requires pyBigWig v0.2.7 (https://github.com/dpryan79/pyBigWig) and NumPy.
+"""
+import json
+import multiprocessing
+import os
+import sys
+import numpy as np
+
+_MANIFEST = 'manifest.json'
+
+def _source_stats(bigwig):
+    """ Identifies a bigWig file so stale caches can be detected
+
+        bigwig: path to bigWig
+
+        Return value: dictionary with absolute path, size, and mtime of
+            bigwig
+    """
+    stat = os.stat(bigwig)
+    return {
+            'path' : os.path.abspath(bigwig),
+            'size' : stat.st_size,
+            'mtime' : int(stat.st_mtime)
+        }
+
+def decode_chrom(bigwig, chrom, length, track_file, dtype='float32',
+                    block_size=10000000):
+    """ Decodes a chromosome's bigWig values into a .npy file
+
+        The file is written under a temporary name and renamed when complete
+        so an interrupted run never leaves a partial track behind.
+
+        bigwig: path to bigWig
+        chrom: chromosome name
+        length: length of chromosome
+        track_file: .npy file to write
+        dtype: NumPy dtype of stored values
+        block_size: number of bases to decode at once
+
+        Return value: track_file
+    """
+    import pyBigWig
+    bw = pyBigWig.open(bigwig)
+    try:
+        partial_file = track_file + '.partial.npy'
+        track = np.lib.format.open_memmap(
+                partial_file, mode='w+', dtype=dtype, shape=(length,)
+            )
+        for start in xrange(0, length, block_size):
+            end = min(start + block_size, length)
+            track[start:end] = bw.values(chrom, start, end)
+        track.flush()
+        del track
+        os.rename(partial_file, track_file)
+    finally:
+        bw.close()
+    return track_file
+
+def _decode_chrom_star(task):
+    """ Unpacks arguments to decode_chrom() for Pool.imap_unordered """
+    return decode_chrom(*task)
+
+def build_cache(bigwig, cache_dir, dtype='float32', num_processes=1):
+    """ Decodes every chromosome of a bigWig into cache_dir
+
+        bigwig: path to bigWig
+        cache_dir: output directory; it is created if it does not exist
+        dtype: 'float16' or 'float32'
+        num_processes: number of chromosomes to decode simultaneously
+
+        No return value.
+    """
+    import pyBigWig
+    if dtype not in ('float16', 'float32'):
+        raise RuntimeError(
+                'Cache dtype must be float16 or float32, not {}.'.format(
+                        dtype
+                    )
+            )
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+    manifest_file = os.path.join(cache_dir, _MANIFEST)
+    if os.path.exists(manifest_file):
+        # Invalidate old cache before any track is overwritten
+        os.remove(manifest_file)
+    bw = pyBigWig.open(bigwig)
+    chrom_sizes = bw.chroms()
+    bw.close()
+    chroms = sorted(chrom_sizes)
+    tasks = [(bigwig, chrom, chrom_sizes[chrom],
+                os.path.join(cache_dir, chrom + '.npy'), dtype)
+                for chrom in chroms]
+    if num_processes > 1:
+        pool = multiprocessing.Pool(num_processes)
+        try:
+            for k, _ in enumerate(
+                    pool.imap_unordered(_decode_chrom_star, tasks)
+                ):
+                print >>sys.stderr, (
+                        '\x1b[K{}/{} chromosomes decoded.\r'.format(
+                                k + 1, len(tasks)
+                            )
+                    ),
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for k, task in enumerate(tasks):
+            decode_chrom(*task)
+            print >>sys.stderr, (
+                    '\x1b[K{}/{} chromosomes decoded.\r'.format(
+                            k + 1, len(tasks)
+                        )
+                ),
+    manifest = {
+            'source' : _source_stats(bigwig),
+            'dtype' : dtype,
+            'chroms' : {
+                chrom : {
+                    'length' : chrom_sizes[chrom],
+                    'file' : chrom + '.npy'
+                } for chrom in chroms
+            }
+        }
+    with open(manifest_file + '.partial', 'w') as manifest_stream:
+        json.dump(manifest, manifest_stream, indent=4, sort_keys=True)
+    os.rename(manifest_file + '.partial', manifest_file)
+
+def ensure_cache(bigwig, cache_dir, dtype='float32', num_processes=1):
+    """ Builds cache for a bigWig unless an up-to-date one exists
+
+        bigwig: path to bigWig
+        cache_dir: cache directory
+        dtype: 'float16' or 'float32'; used only if cache is (re)built
+        num_processes: number of chromosomes to decode simultaneously
+
+        Return value: TrackCache object
+    """
+    try:
+        cache = TrackCache(cache_dir)
+    except (IOError, OSError, ValueError):
+        cache = None
+    if cache is None or cache.source != _source_stats(bigwig):
+        print >>sys.stderr, (
+                '\x1b[KCaching decoded values of {} in {}...'.format(
+                        bigwig, cache_dir
+                    )
+            )
+        build_cache(bigwig, cache_dir, dtype=dtype,
+                    num_processes=num_processes)
+        cache = TrackCache(cache_dir)
+    return cache
+
+class TrackCache(object):
+    """ Read-only view of a cache written by build_cache(). """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, _MANIFEST)) as manifest_stream:
+            manifest = json.load(manifest_stream)
+        self.source = manifest['source']
+        self.dtype = np.dtype(str(manifest['dtype']))
+        self._chroms = manifest['chroms']
+
+    def chroms(self):
+        """ Return value: dictionary mapping chromosomes to lengths """
+        return {str(chrom) : info['length']
+                    for chrom, info in self._chroms.items()}
+
+    def __contains__(self, chrom):
+        return chrom in self._chroms
+
+    def track(self, chrom):
+        """ Memory-maps a chromosome's values
+
+            chrom: chromosome name
+
+            Return value: read-only 1D NumPy memmap; positions without a
+                value are NaN
+        """
+        return np.load(
+                os.path.join(self.cache_dir, self._chroms[chrom]['file']),
+                mmap_mode='r'
+            )
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bigwig', type=str, required=True,
+            help='bigWig to cache; e.g., hg38.phyloP100way.bw'
+        )
+    parser.add_argument('--cache-dir', type=str, required=True,
+            help='directory in which to write cache'
+        )
+    parser.add_argument('--dtype', type=str, required=False,
+            default='float32', choices=['float16', 'float32'],
+            help='type of stored values; float16 halves disk and memory use '
+                 'at the cost of precision'
+        )
+    parser.add_argument('-p', '--num-processes', type=int, required=False,
+            default=1,
+            help='maximum number of processes to run simultaneously'
+        )
+    parser.add_argument('--force', action='store_const', const=True,
+            default=False,
+            help='rebuild cache even if it is up to date'
+        )
+    args = parser.parse_args()
+    if args.force:
+        build_cache(args.bigwig, args.cache_dir, dtype=args.dtype,
+                    num_processes=args.num_processes)
+    else:
+        ensure_cache(args.bigwig, args.cache_dir, dtype=args.dtype,
+                     num_processes=args.num_processes)
+    print >>sys.stderr, '\x1b[KDone.'
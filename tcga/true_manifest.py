@@ -3,21 +3,43 @@
 true_manifest.py
 
 Replaces storage paths in dummy manifest files with temporary S3 URLs obtained
-from the CGC API. This script takes a single command-line argument: the path to
-a text file with a single line, the CGC authorization token, which is
-generated at https://cgc.sbgenomics.com/account/#developer .
+from the CGC API. --cgc-auth-token is the path to a text file with a single
+line, the CGC authorization token, which is generated at
+https://cgc.sbgenomics.com/account/#developer .
+
+Paths are resolved in chunks of --chunk-size, several chunks at a time over a
+pooled session, and failed requests are retried with exponential backoff. If
+--cache is specified, resolved URLs are stored there with their expiry times,
+which are read from the URLs' Expires or X-Amz-Date and X-Amz-Expires
+parameters, and only paths not in the cache or whose URLs expire within
+--min-lifetime seconds are resolved, so rerunning this script before a prep
+job refreshes just the stale URLs. The cache is saved even if some chunks
+fail, so a rerun resolves only what remains. It is a tab-separated file with
+fields
+
+1. storage path
+2. URL
+3. expiry time in seconds since the epoch
+
+--api-url can point to a local server for testing.
 
 Based on https://github.com/sbg/docs/blob/master/cgc/
 SPARQL/SPARQL_download_notebook.ipynb
 """
-import uuid
+import calendar
 import json
+import os
 import requests
 import sys
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
 
-def api(api_url, path, auth_token, method='GET', query=None, data=None):
+def api(session, api_url, path, auth_token, method='GET', query=None,
+        data=None):
     """ Performs request on CGC API
 
+        session: requests.Session
         api_url: base URI of API
         path: query path
         auth_token: CGC authorization token
@@ -25,47 +47,248 @@ def api(api_url, path, auth_token, method='GET', query=None, data=None):
         query: query string parameters
         data: POST data
 
-        Return value: requests response dictionary
+        Return value: tuple (HTTP status code, requests response dictionary)
     """
     data = (
         json.dumps(data) if isinstance(data, dict)
         or isinstance(data,list) else None
     )
     base_url = api_url
-    headers = { 
-        'X-SBG-Auth-Token': auth_token, 
-        'Accept': 'application/json', 
-        'Content-type': 'application/json', 
-    } 
+    headers = {
+        'X-SBG-Auth-Token': auth_token,
+        'Accept': 'application/json',
+        'Content-type': 'application/json',
+    }
 
-    response = requests.request(
+    response = session.request(
                   method, base_url + path, params=query,
                   data=data, headers=headers
-              ) 
-    print >>sys.stderr, "URL: ",  response.url
-    print >>sys.stderr, "RESPONSE CODE: ", response.status_code
-    response_dict = json.loads(response.content) if response.content else {} 
-    response_headers = dict(response.headers)
-    return response_dict
+              )
+    response_dict = json.loads(response.content) if response.content else {}
+    return response.status_code, response_dict
+
+def url_expiry(url, resolved, default_lifetime):
+    """ Finds when a presigned URL expires
+
+        url: presigned URL
+        resolved: time URL was obtained in seconds since the epoch
+        default_lifetime: lifetime in seconds to assume if URL doesn't
+            specify its expiry
+
+        Return value: expiry time in seconds since the epoch
+    """
+    query = urlparse.parse_qs(urlparse.urlparse(url).query)
+    try:
+        if 'Expires' in query:
+            return int(query['Expires'][0])
+        if 'X-Amz-Date' in query and 'X-Amz-Expires' in query:
+            return calendar.timegm(time.strptime(
+                    query['X-Amz-Date'][0], '%Y%m%dT%H%M%SZ'
+                )) + int(query['X-Amz-Expires'][0])
+    except ValueError:
+        pass
+    return int(resolved) + default_lifetime
+
+def read_cache(cache):
+    """ Reads cache of URLs
+
+        cache: path to cache file
+
+        Return value: dictionary mapping storage paths to tuples (URL,
+            expiry time in seconds since the epoch)
+    """
+    urls = {}
+    if cache is None or not os.path.exists(cache):
+        return urls
+    with open(cache) as cache_stream:
+        for line in cache_stream:
+            path, url, expiry = line.rstrip('\n').split('\t')
+            urls[path] = (url, int(expiry))
+    return urls
+
+def write_cache(cache, urls):
+    """ Writes cache of URLs
+
+        cache: path to cache file
+        urls: dictionary as returned by read_cache()
+
+        No return value.
+    """
+    partial_cache = cache + '.partial'
+    with open(partial_cache, 'w') as cache_stream:
+        for path in sorted(urls):
+            print >>cache_stream, '\t'.join(
+                    [path, urls[path][0], str(urls[path][1])]
+                )
+    os.rename(partial_cache, cache)
+
+def resolve_chunk(session, api_url, auth_token, paths, retries=5,
+                    default_lifetime=3600):
+    """ Obtains download URLs of a chunk of storage paths
+
+        session: requests.Session
+        api_url: base URI of API
+        auth_token: CGC authorization token
+        paths: list of storage paths
+        retries: number of times to retry a failed request
+        default_lifetime: lifetime in seconds to assume for a URL that
+            doesn't specify its expiry
+
+        Return value: dictionary mapping paths to tuples (URL, expiry time
+            in seconds since the epoch)
+    """
+    for attempt in xrange(retries + 1):
+        resolved = time.time()
+        try:
+            status_code, download_urls = api(
+                    session, api_url=api_url, auth_token=auth_token,
+                    path='action/files/get_download_url', method='POST',
+                    query=None, data=paths
+                )
+        except (requests.exceptions.RequestException, ValueError) as e:
+            error = str(e)
+        else:
+            if status_code == 200 and isinstance(download_urls, list) and (
+                    len(download_urls) == len(paths)
+                ) and all(download_urls):
+                return {path : (url, url_expiry(url, resolved,
+                                                default_lifetime))
+                            for path, url in zip(paths, download_urls)}
+            error = 'response code {}, {} of {} URLs'.format(
+                    status_code,
+                    len(download_urls) if isinstance(download_urls, list)
+                    else 0, len(paths)
+                )
+            # Client errors other than rate limiting won't go away
+            if 400 <= status_code < 500 and status_code != 429:
+                break
+        if attempt < retries:
+            print >>sys.stderr, (
+                    '\x1b[KResolving chunk failed ({}); retrying...'.format(
+                            error
+                        )
+                )
+            time.sleep(2 ** attempt)
+    raise RuntimeError(
+            'Resolving chunk starting with {} failed: {}'.format(
+                    paths[0], error
+                )
+        )
+
+def resolve_urls(paths, auth_token, api_url, cache=None, chunk_size=100,
+                    threads=4, retries=5, min_lifetime=3600,
+                    default_lifetime=3600):
+    """ Obtains download URLs of storage paths, reusing cached ones
+
+        paths: list of storage paths
+        auth_token: CGC authorization token
+        api_url: base URI of API
+        cache: path to cache file or None
+        chunk_size: number of paths per request
+        threads: number of requests to make simultaneously
+        retries: number of times to retry a failed request
+        min_lifetime: cached URLs expiring within this many seconds are
+            resolved again
+        default_lifetime: lifetime in seconds to assume for a URL that
+            doesn't specify its expiry
+
+        Return value: dictionary mapping paths to tuples (URL, expiry time
+            in seconds since the epoch)
+    """
+    urls = read_cache(cache)
+    deadline = time.time() + min_lifetime
+    stale = sorted(set(path for path in paths
+                        if path not in urls or urls[path][1] < deadline))
+    print >>sys.stderr, '{} of {} URLs are cached; resolving {}.'.format(
+            len(set(paths)) - len(stale), len(set(paths)), len(stale)
+        )
+    chunks = [stale[i:i+chunk_size]
+                for i in xrange(0, len(stale), chunk_size)]
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=threads)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    pool = ThreadPool(threads)
+    errors = []
+    def resolve(chunk):
+        try:
+            return resolve_chunk(session, api_url, auth_token, chunk,
+                                    retries=retries,
+                                    default_lifetime=default_lifetime)
+        except RuntimeError as e:
+            errors.append(str(e))
+            return {}
+    try:
+        for k, chunk_urls in enumerate(pool.imap_unordered(resolve, chunks)):
+            urls.update(chunk_urls)
+            print >>sys.stderr, (
+                    '\x1b[KResolved {} of {} chunks...\r'.format(
+                            k + 1, len(chunks)
+                        )
+                ),
+    finally:
+        pool.close()
+        pool.join()
+        session.close()
+        if cache is not None:
+            write_cache(cache, urls)
+    if errors:
+        raise RuntimeError(
+                '{} of {} chunks could not be resolved:\n{}'.format(
+                        len(errors), len(chunks), '\n'.join(errors)
+                    )
+            )
+    return urls
 
 if __name__ == '__main__':
     import argparse
     # Print file's docstring if -h is invoked
-    parser = argparse.ArgumentParser(description=__doc__, 
+    parser = argparse.ArgumentParser(description=__doc__,
                 formatter_class=argparse.RawDescriptionHelpFormatter)
     # Add command-line arguments
     parser.add_argument('--cgc-auth-token', type=str, required=True,
             help='path to text file containing CGC authorization token; '
         )
+    parser.add_argument('--api-url', type=str, required=False,
+            default='https://cgc-api.sbgenomics.com/v2/',
+            help='base URI of CGC API'
+        )
+    parser.add_argument('--cache', type=str, required=False, default=None,
+            help='where to cache URLs with their expiry times'
+        )
+    parser.add_argument('--chunk-size', type=int, required=False,
+            default=100,
+            help='number of storage paths per request'
+        )
+    parser.add_argument('--threads', type=int, required=False, default=4,
+            help='number of requests to make simultaneously'
+        )
+    parser.add_argument('--retries', type=int, required=False, default=5,
+            help='number of times to retry a failed request'
+        )
+    parser.add_argument('--min-lifetime', type=int, required=False,
+            default=3600,
+            help=('cached URLs expiring within this many seconds are '
+                  'resolved again')
+        )
+    parser.add_argument('--default-lifetime', type=int, required=False,
+            default=3600,
+            help=('lifetime in seconds to assume for URLs that do not '
+                  'specify their expiry')
+        )
     args = parser.parse_args()
-    base = 'https://cgc-api.sbgenomics.com/v2/'
     manifest = []
     for line in sys.stdin:
         manifest.append(line.strip().split('\t'))
-    download_urls = api(
-            api_url=base, auth_token=open(args.cgc_auth_token).read().strip(),
-            path='action/files/get_download_url', method='POST', query=None,
-            data=[tokens[0] for tokens in manifest]
+    urls = resolve_urls(
+            [tokens[0] for tokens in manifest],
+            auth_token=open(args.cgc_auth_token).read().strip(),
+            api_url=args.api_url, cache=args.cache,
+            chunk_size=args.chunk_size, threads=args.threads,
+            retries=args.retries, min_lifetime=args.min_lifetime,
+            default_lifetime=args.default_lifetime
         )
-    for i in xrange(len(download_urls)):
-        print '\t'.join([download_urls[i], manifest[i][1], manifest[i][2]])
+    for tokens in manifest:
+        print '\t'.join([urls[tokens[0]][0], tokens[1], tokens[2]])
+    print >>sys.stderr, '\x1b[KDone.'